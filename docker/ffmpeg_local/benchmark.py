@@ -0,0 +1,321 @@
+#! /usr/bin/env python
+
+"""Benchmark the stages of the conversion script on synthetic inputs.
+
+The inputs are generated with ffmpeg's lavfi testsrc2 and sine sources, so
+they are identical from run to run.  Each stage runs in a child process of
+its own, which makes its CPU time and peak memory (including those of the
+ffmpeg processes it starts) measurable on their own.  This runs outside of
+Docker, with ffmpeg, ffprobe and NumPy installed locally:
+
+    python3 benchmark.py run --suite quick --output before.json
+    python3 benchmark.py run --suite quick --output after.json
+    python3 benchmark.py compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import convert
+
+RESULTS_VERSION = 1
+
+# Each case is encoded with a keyframe every two seconds, like most camera
+# and web uploads.
+SUITES = {
+    'quick': [
+        {'name': '360p-h264-10s', 'width': 640, 'height': 360,
+         'duration': 10, 'rate': 30, 'codec': 'libx264'},
+        {'name': '720p-h264-10s', 'width': 1280, 'height': 720,
+         'duration': 10, 'rate': 30, 'codec': 'libx264'},
+    ],
+    'full': [
+        {'name': '360p-h264-60s', 'width': 640, 'height': 360,
+         'duration': 60, 'rate': 30, 'codec': 'libx264'},
+        {'name': '720p-mpeg4-60s', 'width': 1280, 'height': 720,
+         'duration': 60, 'rate': 30, 'codec': 'mpeg4'},
+        {'name': '1080p-h264-60s', 'width': 1920, 'height': 1080,
+         'duration': 60, 'rate': 30, 'codec': 'libx264'},
+        {'name': '1080p-vp9-30s', 'width': 1920, 'height': 1080,
+         'duration': 30, 'rate': 30, 'codec': 'libvpx-vp9'},
+        {'name': '720p-h264-600s', 'width': 1280, 'height': 720,
+         'duration': 600, 'rate': 30, 'codec': 'libx264'},
+    ],
+}
+
+# Arguments of the conversion script for the transcode stages.
+TRANSCODE_ARGS = ['--renditions', '240,480', '--chunks', '1']
+CHUNKED_ARGS = ['--renditions', '240,480', '--chunks', '4']
+
+# Relative increase of wall or CPU time that counts as a regression.
+DEFAULT_THRESHOLD = 0.10
+
+
+def generate_input(case, directory):
+    """Generate the input of a case, unless it has already been generated.
+    Enter: case: a case from SUITES.
+           directory: where generated inputs are kept.
+    Exit:  path: the path of the input."""
+    path = os.path.join(directory, '%s.mkv' % case['name'])
+    if os.path.exists(path):
+        return path
+
+    duration = str(case['duration'])
+    cmd = [convert.FFMPEG, '-v', 'error', '-y',
+           '-f', 'lavfi', '-i', 'testsrc2=size=%dx%d:rate=%d:duration=%s' % (
+               case['width'], case['height'], case['rate'], duration),
+           '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000:'
+           'duration=%s' % duration,
+           '-c:v', case['codec'], '-g', str(2 * case['rate']),
+           '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest',
+           '-fflags', '+bitexact', '-flags:v', '+bitexact',
+           '-flags:a', '+bitexact', path + '.tmp.mkv']
+    convert.log_command(cmd)
+    convert.check_exit_code(subprocess.call(cmd), cmd)
+    os.rename(path + '.tmp.mkv', path)
+    return path
+
+
+def output_bytes(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.startswith('input.'):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def stage_probe(input_file, work_dir):
+    meta = convert.summarize_probe(convert.probe(input_file))
+    return {'frames': meta['video'].get('frameCount')}
+
+
+def stage_transcode(input_file, work_dir, argv=TRANSCODE_ARGS):
+    os.symlink(input_file, os.path.join(
+        work_dir, 'input' + os.path.splitext(input_file)[1]))
+    convert.main(convert.parse_args(argv))
+    with open(os.path.join(work_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    return {'frames': meta['video'].get('frameCount')}
+
+
+def stage_chunked(input_file, work_dir):
+    return stage_transcode(input_file, work_dir, CHUNKED_ARGS)
+
+
+def stage_activity(input_file, work_dir):
+    meta = convert.summarize_probe(convert.probe(input_file))
+    activity = convert.activity_index(
+        input_file, meta,
+        os.path.join(work_dir, convert.ACTIVITY_INDEX_NAME))
+    return {'frames': activity['frames']}
+
+
+def stage_waveform(input_file, work_dir):
+    convert.waveform(
+        input_file, os.path.join(work_dir, convert.WAVEFORM_NAME))
+    return {}
+
+
+STAGES = [
+    ('probe', stage_probe),
+    ('transcode', stage_transcode),
+    ('chunked', stage_chunked),
+    ('activity', stage_activity),
+    ('waveform', stage_waveform),
+]
+
+
+def run_stage(func, input_file, work_dir, quiet=True):
+    """Run a stage in a child process with its own data directory.
+    Exit:  result: wall and CPU seconds, peak RSS in KiB, the size of the
+                   outputs in bytes, and what the stage itself reported."""
+    read_fd, write_fd = os.pipe()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 0
+        try:
+            convert.GIRDER_WORKER_DIR = work_dir
+            if quiet:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, 1)
+                os.dup2(devnull, 2)
+            report = func(input_file, work_dir)
+        except BaseException as exc:
+            report = {'error': repr(exc)}
+            code = 1
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(report, f)
+        os._exit(code)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        data = f.read()
+    _, status, usage = os.wait4(pid, 0)
+    wall = time.time() - start
+
+    report = json.loads(data) if data else {'error': 'no report'}
+    if status and 'error' not in report:
+        report['error'] = 'exit status %d' % status
+    result = {
+        'wall': round(wall, 3),
+        'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+        'maxRss': usage.ru_maxrss,
+        'outputBytes': output_bytes(work_dir),
+    }
+    if report.get('frames') and wall > 0:
+        result['fps'] = round(report['frames'] / wall, 1)
+    result.update(report)
+    return result
+
+
+def ffmpeg_version():
+    try:
+        output = subprocess.check_output(
+            [convert.FFMPEG, '-version'], universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.splitlines()[0]
+
+
+def run(args):
+    cases = SUITES[args.suite]
+    if args.case:
+        cases = [case for case in cases if case['name'] in args.case]
+    stages = [(name, func) for name, func in STAGES
+              if not args.stage or name in args.stage]
+    input_dir = args.input_dir or os.path.join(
+        tempfile.gettempdir(), 'girder_video_benchmark_inputs')
+    os.makedirs(input_dir, exist_ok=True)
+
+    results = []
+    for case in cases:
+        input_file = generate_input(case, input_dir)
+        for name, func in stages:
+            best = None
+            for _ in range(args.repeat):
+                work_dir = tempfile.mkdtemp(prefix='girder_video_benchmark_')
+                try:
+                    result = run_stage(
+                        func, input_file, work_dir, not args.verbose)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                if best is None or result['wall'] < best['wall']:
+                    best = result
+            best.update({'case': case['name'], 'stage': name})
+            results.append(best)
+            sys.stderr.write(
+                '%-16s %-10s %8.2fs wall %8.2fs cpu %8d KiB%s\n' % (
+                    case['name'], name, best['wall'], best['cpu'],
+                    best['maxRss'], ' ERROR %s' % best['error']
+                    if 'error' in best else ''))
+
+    document = {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'suite': args.suite,
+        'repeat': args.repeat,
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': convert.available_cpus(),
+            'ffmpeg': ffmpeg_version(),
+        },
+        'cases': cases,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=2)
+    return 0 if not any('error' in r for r in results) else 1
+
+
+def compare(args):
+    """Compare two results files and report the stages that got slower, or
+     used more memory, by more than the threshold.
+    Exit:  code: 1 if there is a regression, 0 otherwise."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    before = {(r['case'], r['stage']): r for r in baseline['results']}
+
+    regressions = 0
+    for result in current['results']:
+        old = before.get((result['case'], result['stage']))
+        if old is None or 'error' in old:
+            continue
+        if 'error' in result:
+            print('%-16s %-10s ERROR %s' % (
+                result['case'], result['stage'], result['error']))
+            regressions += 1
+            continue
+        changes = []
+        flagged = False
+        for key in ('wall', 'cpu', 'maxRss'):
+            if not old.get(key):
+                continue
+            change = (result[key] - old[key]) / float(old[key])
+            # Differences too small to measure reliably are not regressions.
+            noise = key != 'maxRss' and abs(result[key] - old[key]) < 0.05
+            if change > args.threshold and not noise:
+                flagged = True
+            changes.append('%s %+.1f%%' % (key, change * 100))
+        if flagged:
+            regressions += 1
+        print('%-16s %-10s %s%s' % (
+            result['case'], result['stage'], ', '.join(changes),
+            '  REGRESSION' if flagged else ''))
+    return 1 if regressions else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the video conversion pipeline.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser(
+        'run', help='run the benchmarks and write the results')
+    run_parser.add_argument(
+        '--suite', choices=sorted(SUITES), default='quick')
+    run_parser.add_argument(
+        '--case', action='append',
+        help='only run this case; may be repeated')
+    run_parser.add_argument(
+        '--stage', action='append', choices=[name for name, _ in STAGES],
+        help='only run this stage; may be repeated')
+    run_parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='number of runs of each stage; the fastest is kept')
+    run_parser.add_argument(
+        '--input-dir', help='where to keep the generated inputs')
+    run_parser.add_argument(
+        '--output', default='benchmark.json', help='results file to write')
+    run_parser.add_argument(
+        '--verbose', action='store_true',
+        help='show the output of the conversion script and of ffmpeg')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser(
+        'compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='relative increase that counts as a regression')
+    compare_parser.set_defaults(func=compare)
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    sys.exit(args.func(args))
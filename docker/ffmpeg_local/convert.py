@@ -1,36 +1,177 @@
 #! /usr/bin/env python
 
+import argparse
+import concurrent.futures
+import contextlib
 import glob
 import json
+import math
 import os.path
+import resource
+import shutil
+import struct
 import subprocess
 import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
 from re import compile
 
-GIRDER_WORKER_DIR = os.path.join('/', 'mnt', 'girder_worker', 'data')
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-RE_VIDEO_INFO = compile(r'''^\s+Stream #.+?: Video''')
-RE_AUDIO_INFO = compile(r'''^\s+Stream #.+?: Audio''')
-RE_DURATION_INFO = compile(r'''^\s+Duration: ''')
-RE_PROGRESS_INFO = compile(r'''^frame=([ 0-9]+)''')
+# The data directory shared with girder_worker; it can be overridden with
+# --data-dir or the environment to run the conversion outside of Docker, in
+# the worker's own process or for benchmarks.
+GIRDER_WORKER_DIR = os.environ.get(
+    'GIRDER_WORKER_DIR', os.path.join('/', 'mnt', 'girder_worker', 'data'))
+
+# ffmpeg writes machine-readable progress to stdout, and nothing but log
+# messages to stderr.
+PROGRESS_ARGS = ['-nostats', '-progress', 'pipe:1']
+PROGRESS_INTERVAL = 1.0
+PROGRESS_STEP = 1.0
 
 FFMPEG = 'ffmpeg'
+FFPROBE = 'ffprobe'
 
+# Per-stage timings and resource usage, written next to the metadata.
+METRICS_NAME = 'metrics.json'
 
-def duration_parse(durstr):
-    """Parse a duration of the form [[hh:]mm:]ss[.sss] and return a float
-     with the duration or None for failure to parse.
-    Enter: durstr: string with the duration.
-    Exit:  duration: duration in seconds."""
-    try:
-        durstr = durstr.strip().split(":")
-        dur = 0
-        for part in range(len(durstr)):
-            dur += float(durstr[-1-part])*(60**part)
-    except Exception:
-        return None
-    return dur
+# Options for inputs read over HTTP: reconnect when the connection drops
+# rather than failing a long transcode.
+HTTP_INPUT_ARGS = ['-reconnect', '1', '-reconnect_on_network_error', '1',
+                   '-reconnect_delay_max', '30']
+RE_URL_TOKEN = compile(r'''(token=)[^&'"\s]+''')
+
+RENDITION_NAME = 'source_%dp.%s'
+KEYFRAME_INDEX_NAME = 'source_%dp.keyframes'
+
+STORYBOARD_NAME = 'storyboard_%03d.jpg'
+STORYBOARD_INDEX_NAME = 'storyboard.vtt'
+STORYBOARD_TILE_WIDTH = 160
+# The thumbnails a chunk of a chunked transcode takes for the storyboard.
+STORYBOARD_CHUNK_NAME = 'storyboard.mkv'
+STORYBOARD_MAX_GRID = 10
+
+CHUNK_DIR = 'chunks'
+CHUNK_THREADS = 4
+
+# CPU bandwidth limits of the container, as set by cgroup v2 and v1.
+CGROUP_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+CHUNK_MIN_DURATION = 60
+DEFAULT_RENDITIONS = (240, 480, 720, 1080)
+
+# Long chunked transcodes upload every finished chunk, with a checkpoint
+# that lists them, so that a job that fails can be resumed by another one
+# which only encodes the missing chunks.  A checkpointed transcode has a
+# chunk at least every CHECKPOINT_SEGMENT_DURATION seconds.
+CHECKPOINT_NAME = 'checkpoint.json'
+CHECKPOINT_SEGMENT_NAME = 'checkpoint_%04d_%s'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_SEGMENT_DURATION = 300
+
+UPLOAD_CHUNK_SIZE = 64 * 1024 ** 2
+
+DASH_DIR = 'dash'
+DASH_MANIFEST_NAME = 'manifest.mpd'
+DASH_SEGMENT_DURATION = 4
+RE_DASH_SEGMENT = compile(r'''^chunk-(\d+)-(\d+)\.(webm|m4s)$''')
+RE_DASH_INIT = compile(r'''^init-(\d+)\.(webm|mp4)$''')
+
+# The activity index is computed from a small grayscale decode, sampled at
+# no more than ACTIVITY_RATE frames per second and read in batches.  A
+# frame whose mean absolute difference from the previous one exceeds both
+# ACTIVITY_CUT_THRESHOLD and ACTIVITY_CUT_RATIO times the mean over the
+# preceding ACTIVITY_CUT_WINDOW frames starts a new scene; cuts closer than
+# ACTIVITY_CUT_MIN_GAP seconds to the previous one are ignored.
+ACTIVITY_INDEX_NAME = 'activity.npy'
+ACTIVITY_WIDTH = 64
+ACTIVITY_HEIGHT = 36
+ACTIVITY_RATE = 10.0
+ACTIVITY_BATCH = 512
+ACTIVITY_CUT_THRESHOLD = 0.12
+ACTIVITY_CUT_RATIO = 4.0
+ACTIVITY_CUT_WINDOW = 20
+ACTIVITY_CUT_MIN_GAP = 0.5
+
+# Waveform peaks are computed from mono PCM at WAVEFORM_RATE samples per
+# second.  The finest level has one (min, max) pair per WAVEFORM_BUCKET
+# samples, and each further level merges WAVEFORM_FACTOR buckets of the
+# previous one, down to WAVEFORM_MIN_BUCKETS.  The file has a header with a
+# magic string, a format version, the sample rate and the number of levels;
+# each level follows as a header with its samples per bucket and bucket
+# count, then interleaved int8 (min, max) pairs.
+WAVEFORM_NAME = 'waveform.bin'
+WAVEFORM_RATE = 8000
+WAVEFORM_BUCKET = 64
+WAVEFORM_FACTOR = 4
+WAVEFORM_MIN_BUCKETS = 1024
+WAVEFORM_READ_BUCKETS = 4096
+WAVEFORM_MAGIC = b'GVWF'
+WAVEFORM_VERSION = 1
+WAVEFORM_HEADER = struct.Struct('<4sHIH')
+WAVEFORM_LEVEL_HEADER = struct.Struct('<II')
+
+# Encoding profiles describe the container and the encoders to use.  Keys
+# that a profile leaves out are taken from the defaults for its container.
+CONTAINER_DEFAULTS = {
+    'webm': {
+        'videoCodec': 'libvpx-vp9',
+        'audioCodec': 'libopus',
+        'crf': 5,
+        'quality': 'good',
+    },
+    'mp4': {
+        'videoCodec': 'libx264',
+        'audioCodec': 'aac',
+        'crf': 23,
+        'preset': 'medium',
+    },
+}
+DEFAULT_PROFILE = dict(CONTAINER_DEFAULTS['webm'], container='webm')
+
+# A source that browsers can already play in the profile's container is
+# remuxed into a rendition instead of being encoded again, unless the
+# profile's passthrough key is false.  The key may also be an object that
+# overrides these bounds: the codecs (as named by ffprobe) that may be
+# copied, the tallest source, the highest video bitrate as a multiple of
+# the target bitrate of a rendition of the source's height, and whether the
+# smaller renditions of the ladder are still encoded.
+PASSTHROUGH_DEFAULTS = {
+    'webm': {
+        'videoCodecs': ['vp8', 'vp9', 'av1'],
+        'audioCodecs': ['opus', 'vorbis'],
+    },
+    'mp4': {
+        'videoCodecs': ['h264'],
+        'audioCodecs': ['aac', 'mp3'],
+    },
+}
+PASSTHROUGH_MAX_HEIGHT = 1080
+PASSTHROUGH_MAX_BITRATE_SCALE = 2.0
+PASSTHROUGH_PIXEL_FORMATS = ('yuv420p', 'yuvj420p')
+
+MIME_TYPES = {
+    'webm': 'video/webm',
+    'mp4': 'video/mp4',
+    'm4s': 'video/iso.segment',
+}
+
+# Keyframe index layout: a header with a magic string, a format version and
+# the number of entries, followed by one little-endian record per keyframe of
+# (pts in seconds, byte offset in the file, frame number).
+KEYFRAME_INDEX_MAGIC = b'GVKI'
+KEYFRAME_INDEX_VERSION = 1
+KEYFRAME_INDEX_HEADER = struct.Struct('<4sHI')
+KEYFRAME_INDEX_RECORD = struct.Struct('<dqq')
 
 
 def check_exit_code(code, cmd):
@@ -39,143 +180,1813 @@ def check_exit_code(code, cmd):
             repr(cmd), code))
 
 
-def main():
-    input_file = next(glob.iglob(os.path.join(GIRDER_WORKER_DIR, 'input.*')))
+def parse_rate(ratestr):
+    """Parse a frame rate of the form num[/den] as reported by ffprobe.
+    Enter: ratestr: string with the rate.
+    Exit:  rate: rate as a float or None for failure to parse."""
+    try:
+        num, _, den = ratestr.partition('/')
+        rate = float(num) / float(den or 1)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+    return rate or None
+
+
+def parse_number(value, kind=float):
+    """Parse a numeric field as reported by ffprobe, which uses strings for
+     most numbers and 'N/A' for unknown values.
+    Enter: value: the value to parse.
+           kind: the numeric type to return.
+    Exit:  number: the parsed number or None for failure to parse."""
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
 
-    cmd = [FFMPEG, '-i', input_file]
-    sys.stdout.write(' '.join(('RUN:', repr(cmd))))
+
+def log_command(cmd):
+    # Input URLs carry a Girder token, which is kept out of the job log.
+    sys.stdout.write(RE_URL_TOKEN.sub(
+        r'\1...', ' '.join(('RUN:', repr(cmd)))))
     sys.stdout.write('\n')
     sys.stdout.flush()
 
+
+def is_url(input_file):
+    return input_file.startswith(('http://', 'https://'))
+
+
+def input_args(input_file):
+    """Enter: input_file: path or HTTP URL of an input.
+    Exit:  args: the ffmpeg arguments that open it."""
+    if is_url(input_file):
+        return HTTP_INPUT_ARGS + ['-i', input_file]
+    return ['-i', input_file]
+
+
+def probe(input_file):
+    """Read the container and stream metadata of a file with ffprobe.  Only
+     the headers are read, so this is cheap even for very large inputs.
+    Enter: input_file: path or URL of the file to probe.
+    Exit:  probe: the parsed ffprobe JSON with 'format' and 'streams'."""
+    cmd = [FFPROBE, '-v', 'error', '-print_format', 'json',
+           '-show_format', '-show_streams']
+    if is_url(input_file):
+        cmd.extend(HTTP_INPUT_ARGS)
+    cmd.append(input_file)
+    log_command(cmd)
+
     proc = subprocess.Popen(
             cmd,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
             universal_newlines=True)
 
-    meta = {'audio': {}, 'video': {}}
-    for line in proc.stderr:
-        if RE_VIDEO_INFO.match(line) and not meta['video'].get('width'):
-            for part in line.split(',')[1:]:
-                if 'x' in part and not meta['video'].get('width'):
-                    meta['video']['width'] = int(
-                            part.split('x')[0].split()[-1].strip())
+    output = proc.stdout.read()
+    proc.stdout.close()
+    check_exit_code(proc.wait(), cmd)
 
-                    meta['video']['height'] = int(
-                            part.strip().split('x')[1].split()[0].strip())
+    return json.loads(output)
 
-                elif ' fps' in part and not meta['video'].get('frameRate'):
-                    meta['video']['frameRate'] = float(
-                            part.split(' fps')[0].strip())
 
-                elif ' kb/s' in part and not meta['video'].get('bitRate'):
-                    meta['video']['bitRate'] = float(
-                            part.split(' kb/s')[0].strip())
+def summarize_probe(info):
+    """Build the summary metadata recorded in meta.json from the output of
+     probe().  The full probe output is kept under the 'probe' key.
+    Enter: info: the output of probe().
+    Exit:  meta: dictionary with 'audio', 'video', and 'duration' entries."""
+    meta = {'audio': {}, 'video': {}, 'probe': info}
 
-        if RE_AUDIO_INFO.match(line) and not meta['audio'].get('bitRate'):
-            for part in line.split(',')[1:]:
-                if ' kb/s' in part and not meta['audio'].get('bitRate'):
-                    meta['audio']['bitRate'] = float(
-                            part.split(' kb/s')[0].strip())
+    streams = info.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'
+                  and not s.get('disposition', {}).get('attached_pic')),
+                 None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'),
+                 None)
 
-                elif ' Hz' in part and not meta['audio'].get('sampleRate'):
-                    meta['audio']['sampleRate'] = (
-                            float(part.split(' Hz')[0].strip()))
+    duration = parse_number(info.get('format', {}).get('duration'))
+    if duration is not None:
+        meta['duration'] = duration
 
-        if RE_DURATION_INFO.match(line) and not meta.get('duration'):
-            meta['duration'] = duration_parse(
-                    line.split("Duration:", 1)[1].split(",")[0])
+    if video is not None:
+        meta['video']['codec'] = video.get('codec_name')
+        meta['video']['width'] = video.get('width')
+        meta['video']['height'] = video.get('height')
+        meta['video']['pixelFormat'] = video.get('pix_fmt')
 
-    proc.stderr.close()
-    check_exit_code([proc.wait(), 0][1], cmd)
+        frameRate = (parse_rate(video.get('avg_frame_rate')) or
+                     parse_rate(video.get('r_frame_rate')))
+        if frameRate:
+            meta['video']['frameRate'] = frameRate
 
-    cmd.extend(['-vcodec', 'copy', '-an', '-f', 'null', 'null'])
-    sys.stdout.write(' '.join(('RUN:', repr(cmd))))
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+        bitRate = parse_number(video.get('bit_rate'))
+        if bitRate is not None:
+            meta['video']['bitRate'] = bitRate / 1000.0
+
+        frameCount = parse_number(video.get('nb_frames'), int)
+        if not frameCount and frameRate and duration:
+            frameCount = int(round(frameRate * duration))
+        if frameCount:
+            meta['video']['frameCount'] = frameCount
+
+    if audio is not None:
+        meta['audio']['codec'] = audio.get('codec_name')
+
+        bitRate = parse_number(audio.get('bit_rate'))
+        if bitRate is not None:
+            meta['audio']['bitRate'] = bitRate / 1000.0
+
+        sampleRate = parse_number(audio.get('sample_rate'))
+        if sampleRate is not None:
+            meta['audio']['sampleRate'] = sampleRate
+
+    return meta
+
+
+def parse_renditions(value):
+    """Parse a comma-separated list of rendition heights.
+    Enter: value: string such as '240,480,720'.
+    Exit:  heights: sorted tuple of unique heights."""
+    heights = set()
+    for part in value.split(','):
+        part = part.strip()
+        if part:
+            heights.add(int(part.rstrip('p')))
+    return tuple(sorted(heights))
+
+
+def parse_profile(value):
+    """Parse an encoding profile given as a JSON object, filling in the
+     defaults of its container.
+    Enter: value: JSON string.
+    Exit:  profile: dictionary with at least container, videoCodec and
+                    audioCodec."""
+    profile = json.loads(value)
+    container = profile.get('container', DEFAULT_PROFILE['container'])
+    if container not in CONTAINER_DEFAULTS:
+        raise ValueError('unsupported container %r' % container)
+    result = dict(CONTAINER_DEFAULTS[container], container=container)
+    result.update(profile)
+    return result
+
+
+def select_renditions(heights, source_height, ext='webm'):
+    """Choose which renditions of the ladder to encode.  Renditions taller
+     than the source are not encoded; if the source is shorter than every
+     rendition, the smallest one is encoded at the source height instead.
+    Enter: heights: sorted rendition heights from the ladder.
+           source_height: height of the source video, or None if unknown.
+           ext: the container extension of the renditions.
+    Exit:  renditions: list of (name, height) tuples to encode."""
+    if not source_height:
+        return [(RENDITION_NAME % (h, ext), h) for h in heights]
+
+    renditions = [(RENDITION_NAME % (h, ext), h) for h in heights
+                  if h <= source_height]
+    if not renditions and heights:
+        renditions = [(RENDITION_NAME % (heights[0], ext), source_height)]
+    return renditions
+
+
+def rendition_bitrate(height, scale=1.0):
+    """Target bitrate for a rendition, scaled from 1000k at 480 lines."""
+    return '%dk' % max(100, int(scale * 1000 * (height / 480.0) ** 1.5))
+
+
+def passthrough_config(profile):
+    """Exit:  config: the passthrough bounds of a profile, with the defaults of
+                   its container filled in, or None if passthrough is
+                   disabled."""
+    value = profile.get('passthrough', True)
+    if not value:
+        return None
+    config = dict(PASSTHROUGH_DEFAULTS[profile['container']],
+                  maxHeight=PASSTHROUGH_MAX_HEIGHT,
+                  maxBitRateScale=PASSTHROUGH_MAX_BITRATE_SCALE,
+                  encodeLadder=True)
+    if isinstance(value, dict):
+        config.update(value)
+    return config
+
+
+def source_video_bitrate(meta):
+    """Exit:  bitrate: the video bitrate of the source in kb/s, estimated from
+                    the overall bitrate when the stream does not record
+                    one, or None."""
+    if meta['video'].get('bitRate'):
+        return meta['video']['bitRate']
+    total = parse_number(meta['probe'].get('format', {}).get('bit_rate'))
+    if total is None:
+        return None
+    return total / 1000.0 - (meta['audio'].get('bitRate') or 0)
+
+
+def passthrough_reason(meta, profile, config, heights):
+    """Decide whether the source can be remuxed into a rendition instead of
+     being encoded: its codecs must be playable in the profile's container,
+     and its height and bitrate within the bounds of the passthrough config.
+    Enter: meta: the metadata from summarize_probe.
+           config: the config from passthrough_config, or None.
+           heights: the rendition heights of the ladder.
+    Exit:  reason: None if it can be remuxed, or why not."""
+    video, audio = meta['video'], meta['audio']
+    if config is None:
+        return 'disabled by the profile'
+    if video.get('codec') not in config['videoCodecs']:
+        return 'video codec %s' % video.get('codec')
+    if audio and audio.get('codec') not in config['audioCodecs']:
+        return 'audio codec %s' % audio.get('codec')
+    if video.get('pixelFormat') not in PASSTHROUGH_PIXEL_FORMATS:
+        return 'pixel format %s' % video.get('pixelFormat')
+    height = video.get('height')
+    if not height or height > config['maxHeight'] or height > max(heights):
+        return 'height %s' % height
+    bitrate = source_video_bitrate(meta)
+    limit = config['maxBitRateScale'] * parse_number(rendition_bitrate(
+        height, profile.get('bitRateScale', 1.0)).rstrip('k'))
+    if bitrate is None or bitrate > limit:
+        return 'video bitrate %s kb/s' % (
+            bitrate if bitrate is None else int(bitrate))
+    return None
+
+
+def remux_command(input_file, name, has_audio=True):
+    """Build an ffmpeg command that copies the first video and audio streams
+     of the input into a rendition without re-encoding them."""
+    cmd = [FFMPEG, '-v', 'error'] + input_args(input_file) + [
+        '-map', '0:v:0']
+    if has_audio:
+        cmd.extend(['-map', '0:a:0'])
+    cmd.extend(['-c', 'copy'] + muxer_args(name) +
+               [os.path.join(GIRDER_WORKER_DIR, name)])
+    return cmd
+
+
+def video_codec_args(profile, height, threads, spec=':v'):
+    """ffmpeg arguments that configure the video encoder of a rendition.
+    Enter: profile: the encoding profile.
+           height: the height of the rendition.
+           threads: the number of threads the encoder may use.
+           spec: the stream specifier the options apply to.
+    Exit:  args: list of ffmpeg arguments."""
+    codec = profile['videoCodec']
+    bitrate = rendition_bitrate(height, profile.get('bitRateScale', 1.0))
+    args = ['-c' + spec, codec, '-threads' + spec, str(threads)]
+    if profile.get('crf') is not None:
+        args.extend(['-crf' + spec, str(profile['crf'])])
+
+    if codec == 'libvpx-vp9':
+        # Tile columns are given as a log2 and each must be at least 256
+        # pixels wide; row based multithreading lets libvpx use more than
+        # one thread per tile column.
+        width = height * 16 // 9
+        tile_columns = min(6, int(math.log(max(1, width // 256), 2)))
+        args.extend([
+            '-b' + spec, bitrate,
+            '-quality' + spec, profile.get('quality', 'good'),
+            '-row-mt' + spec, '1',
+            '-tile-columns' + spec, str(tile_columns)])
+        if profile.get('speed') is not None:
+            args.extend(['-cpu-used' + spec, str(profile['speed'])])
+    elif codec == 'libx264':
+        args.extend([
+            '-preset' + spec, profile.get('preset', 'medium'),
+            '-maxrate' + spec, bitrate,
+            '-bufsize' + spec, '%dk' % (2 * int(bitrate[:-1])),
+            '-pix_fmt' + spec, 'yuv420p'])
+    else:
+        args.extend(['-b' + spec, bitrate])
+    return args
+
+
+def muxer_args(name):
+    """ffmpeg arguments that make a rendition seekable with few range
+     requests: the WebM cues, or the MP4 moov atom, are written at the start
+     of the file instead of the end, so a player knows where to seek
+     without first fetching the tail.
+    Enter: name: the file name of the rendition.
+    Exit:  args: list of ffmpeg arguments."""
+    ext = os.path.splitext(name)[1]
+    if ext == '.webm':
+        return ['-cues_to_front', '1']
+    if ext == '.mp4':
+        return ['-movflags', '+faststart']
+    return []
+
+
+def audio_codec_args(profile):
+    args = ['-c:a', profile['audioCodec']]
+    if profile.get('audioBitRate'):
+        args.extend(['-b:a', str(profile['audioBitRate'])])
+    return args
+
+
+def storyboard_layout(meta, max_sheets, max_size):
+    """Plan the storyboard sprite sheets for a video.  Thumbnails are taken
+     at a fixed interval chosen so that the whole video fits in at most
+     max_sheets sheets, each no larger than max_size pixels on a side.
+    Enter: meta: the metadata from summarize_probe.
+           max_sheets: the maximum number of sheets to write.
+           max_size: the maximum width and height of a sheet.
+    Exit:  layout: dictionary describing the storyboard, or None if the
+                   video is too small to lay out."""
+    width = meta['video'].get('width')
+    height = meta['video'].get('height')
+    if not width or not height or max_sheets < 1:
+        return None
+
+    tile_width = min(STORYBOARD_TILE_WIDTH, width, max_size)
+    tile_height = max(2, int(round(tile_width * height / width / 2.0)) * 2)
+    columns = min(STORYBOARD_MAX_GRID, max_size // tile_width)
+    rows = min(STORYBOARD_MAX_GRID, max_size // tile_height)
+    if columns < 1 or rows < 1:
+        return None
+
+    duration = meta.get('duration') or 0
+    interval = max(1, int(math.ceil(
+        duration / float(columns * rows * max_sheets))))
+    return {
+        'interval': interval,
+        'tileWidth': tile_width,
+        'tileHeight': tile_height,
+        'columns': columns,
+        'rows': rows,
+        'maxSheets': max_sheets,
+    }
+
+
+def storyboard_filter(layout):
+    return 'fps=1/%d,scale=%d:%d,tile=%dx%d' % (
+        layout['interval'], layout['tileWidth'], layout['tileHeight'],
+        layout['columns'], layout['rows'])
+
+
+def storyboard_output(label, layout):
+    """ffmpeg arguments writing the storyboard branch as numbered JPEGs."""
+    return [
+        '-map', label, '-c:v', 'mjpeg', '-q:v', '5',
+        '-frames:v', str(layout['maxSheets']),
+        '-f', 'image2', '-start_number', '1',
+        os.path.join(GIRDER_WORKER_DIR, STORYBOARD_NAME)]
+
+
+def write_storyboard_index(layout, duration, path):
+    """Write a WebVTT file that maps time ranges to storyboard tiles using
+     media fragments (sheet.jpg#xywh=x,y,w,h), as used by most players.
+    Exit:  sheets: the number of sheets the index refers to."""
+    per_sheet = layout['columns'] * layout['rows']
+    interval = layout['interval']
+    tiles = 0
+    while (os.path.exists(os.path.join(
+            GIRDER_WORKER_DIR, STORYBOARD_NAME % (tiles // per_sheet + 1)))
+            and tiles * interval < (duration or 0)):
+        tiles += 1
+
+    def timestamp(seconds):
+        return '%02d:%02d:%06.3f' % (
+            seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+    with open(path, 'w') as f:
+        f.write('WEBVTT\n')
+        for tile in range(tiles):
+            sheet, pos = divmod(tile, per_sheet)
+            f.write('\n%s --> %s\n%s#xywh=%d,%d,%d,%d\n' % (
+                timestamp(tile * interval),
+                timestamp(min((tile + 1) * interval, duration)),
+                STORYBOARD_NAME % (sheet + 1),
+                pos % layout['columns'] * layout['tileWidth'],
+                pos // layout['columns'] * layout['tileHeight'],
+                layout['tileWidth'], layout['tileHeight']))
+    return (tiles + per_sheet - 1) // per_sheet
+
+
+def chunk_storyboard(layout, start, end):
+    """Plan the storyboard thumbnails of one chunk of a chunked transcode.
+     A thumbnail is taken every interval seconds of the source, as in a
+     single transcode; each chunk takes the ones that fall within it from
+     its own decode, and they are tiled into sheets once every chunk is
+     done.  The last frame of a chunk is held so that a thumbnail due
+     between it and the next chunk still gets a frame.
+    Enter: layout: layout from storyboard_layout.
+           start, end: the times of the source the chunk spans.
+    Exit:  chain: the filter chain taking the chunk's thumbnails, or None if
+                  the chunk has none.
+           count: the number of thumbnails."""
+    interval = layout['interval']
+    first = int(math.ceil(round(start / float(interval), 6)))
+    count = int(math.ceil(round(end / float(interval), 6))) - first
+    if count <= 0:
+        return None, 0
+    chain = ('setpts=PTS-STARTPTS+%.6f/TB,'
+             'tpad=stop_mode=clone:stop_duration=%d,'
+             'fps=1/%d:start_time=%.6f,scale=%d:%d' % (
+                 start, interval, interval, first * interval,
+                 layout['tileWidth'], layout['tileHeight']))
+    return chain, count
+
+
+def split_graph(renditions, storyboard=None, storyboard_chain=None):
+    """Build a filter graph that splits the decoded video once per rendition
+     and scales each branch.  If a storyboard layout is given, one more
+     branch tiles thumbnails into sprite sheets from the same decode.
+    Enter: renditions: list of (name, height) tuples from select_renditions.
+           storyboard: layout from storyboard_layout, or None.
+           storyboard_chain: a filter chain for the storyboard branch to use
+                             instead of one made from a layout, or None.
+    Exit:  graph: the filter graph string.
+           labels: the output label of each rendition's branch.
+           storyboard_label: the output label of the storyboard, or None."""
+    if storyboard and not storyboard_chain:
+        storyboard_chain = storyboard_filter(storyboard)
+    labels = ['v%d' % i for i in range(len(renditions))]
+    branches = labels + (['sb'] if storyboard_chain else [])
+    graph = ['[0:v:0]split=%d%s' % (
+        len(branches), ''.join('[%s]' % l for l in branches))]
+    for label, (_, height) in zip(labels, renditions):
+        graph.append('[%s]scale=-2:%d[%so]' % (label, height, label))
+
+    storyboard_label = None
+    if storyboard_chain:
+        graph.append('[sb]%s[sbo]' % storyboard_chain)
+        storyboard_label = '[sbo]'
+    return ';'.join(graph), ['[%so]' % l for l in labels], storyboard_label
+
+
+def transcode_command(input_file, renditions, profile, has_audio=True,
+                      storyboard=None):
+    """Build a single ffmpeg command that decodes the input once and splits
+     the decoded video into one encoder per rendition.  The encoders run
+     concurrently, so they share the available CPUs.
+    Enter: input_file: path or URL of the input.
+           renditions: list of (name, height) tuples from select_renditions.
+           profile: the encoding profile.
+           has_audio: whether to map the first audio stream.
+           storyboard: layout from storyboard_layout, or None.
+    Exit:  cmd: the ffmpeg command as a list."""
+    graph, labels, storyboard_label = split_graph(renditions, storyboard)
+    threads = max(1, available_cpus() // max(1, len(renditions)))
+
+    cmd = [FFMPEG] + input_args(input_file) + ['-filter_complex', graph]
+    for label, (name, height) in zip(labels, renditions):
+        cmd.extend(['-map', label])
+        if has_audio:
+            cmd.extend(['-map', '0:a:0'] + audio_codec_args(profile))
+        cmd.extend(video_codec_args(profile, height, threads))
+        cmd.extend(muxer_args(name))
+        cmd.append(os.path.join(GIRDER_WORKER_DIR, name))
+    if storyboard_label:
+        cmd.extend(storyboard_output(storyboard_label, storyboard))
+    return cmd
+
+
+def dash_command(input_file, renditions, profile, has_audio=True,
+                 storyboard=None):
+    """Build an ffmpeg command that encodes every rendition into a single
+     segmented DASH presentation, with WebM or fragmented MP4 segments
+     depending on the profile's container.  Keyframes are forced on segment
+     boundaries so that all representations can be switched between.
+    Enter: input_file: path or URL of the input.
+           renditions: list of (name, height) tuples from select_renditions.
+           profile: the encoding profile.
+           has_audio: whether to map the first audio stream.
+           storyboard: layout from storyboard_layout, or None.
+    Exit:  cmd: the ffmpeg command as a list."""
+    graph, labels, storyboard_label = split_graph(renditions, storyboard)
+    threads = max(1, available_cpus() // max(1, len(renditions)))
+    webm = profile['container'] == 'webm'
+
+    cmd = [FFMPEG] + input_args(input_file) + ['-filter_complex', graph]
+    for label in labels:
+        cmd.extend(['-map', label])
+    if has_audio:
+        cmd.extend(['-map', '0:a:0'] + audio_codec_args(profile))
+
+    for index, (_, height) in enumerate(renditions):
+        cmd.extend(video_codec_args(
+            profile, height, threads, spec=':v:%d' % index))
+
+    cmd.extend([
+        '-force_key_frames',
+        'expr:gte(t,n_forced*%d)' % DASH_SEGMENT_DURATION,
+        '-f', 'dash',
+        '-dash_segment_type', 'webm' if webm else 'mp4',
+        '-seg_duration', str(DASH_SEGMENT_DURATION),
+        '-use_template', '1',
+        '-use_timeline', '1',
+        '-init_seg_name',
+        'init-$RepresentationID$.%s' % ('webm' if webm else 'mp4'),
+        '-media_seg_name',
+        'chunk-$RepresentationID$-$Number%%05d$.%s' % (
+            'webm' if webm else 'm4s'),
+        '-adaptation_sets',
+        'id=0,streams=v id=1,streams=a' if has_audio else 'id=0,streams=v',
+        os.path.join(GIRDER_WORKER_DIR, DASH_DIR, DASH_MANIFEST_NAME)])
+    if storyboard_label:
+        cmd.extend(storyboard_output(storyboard_label, storyboard))
+    return cmd
+
+
+class GirderUploader(object):
+    """Minimal client for Girder's upload API, used to publish files to the
+     item while the job is still running."""
+
+    def __init__(self, api_url, token, item_id):
+        self.api_url = api_url.rstrip('/')
+        self.token = token
+        self.item_id = item_id
+
+    def request(self, method, path, params=None, data=None):
+        url = '%s/%s' % (self.api_url, path)
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        req = urllib.request.Request(url, data=data, method=method)
+        req.add_header('Girder-Token', self.token)
+        if data is not None:
+            req.add_header('Content-Type', 'application/octet-stream')
+        with urllib.request.urlopen(req) as resp:
+            return json.loads(resp.read().decode('utf8'))
+
+    def send(self, upload, path):
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(UPLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                upload = self.request('POST', 'file/chunk', {
+                    'uploadId': upload['_id'], 'offset': offset}, data)
+                offset += len(data)
+        return upload
+
+    def upload(self, path, name, mime_type):
+        """Create a new file in the item from the contents of a local file.
+        Exit:  file: the created file document."""
+        upload = self.request('POST', 'file', {
+            'parentType': 'item', 'parentId': self.item_id, 'name': name,
+            'size': os.path.getsize(path), 'mimeType': mime_type,
+            'reference': 'videoPlugin'})
+        return self.send(upload, path)
+
+    def replace(self, file_id, path):
+        """Replace the contents of an existing file."""
+        upload = self.request('PUT', 'file/%s/contents' % file_id, {
+            'size': os.path.getsize(path), 'reference': 'videoPlugin'})
+        return self.send(upload, path)
+
+    def download(self, file_id, path):
+        """Download a file to a local path."""
+        req = urllib.request.Request(
+            '%s/file/%s/download' % (self.api_url, file_id))
+        req.add_header('Girder-Token', self.token)
+        with urllib.request.urlopen(req) as resp, open(path, 'wb') as f:
+            shutil.copyfileobj(resp, f)
+
+
+class SegmentPublisher(threading.Thread):
+    """Watch the DASH output directory while ffmpeg is running and upload
+     each segment as soon as it is complete.  A segment is complete once the
+     muxer has started the next segment of the same representation; the
+     manifest is re-uploaded after every batch of new segments so that
+     clients can start playing before the transcode finishes."""
+
+    def __init__(self, uploader, directory, interval=2):
+        super(SegmentPublisher, self).__init__()
+        self.daemon = True
+        self.uploader = uploader
+        self.directory = directory
+        self.interval = interval
+        self.published = set()
+        self.manifest_id = None
+        self.done = threading.Event()
+
+    def complete_files(self, final):
+        names = sorted(os.listdir(self.directory))
+        latest = {}
+        for name in names:
+            m = RE_DASH_SEGMENT.match(name)
+            if m:
+                rep, number = m.group(1), int(m.group(2))
+                latest[rep] = max(latest.get(rep, number), number)
+
+        ready = []
+        for name in names:
+            if name in self.published or name.endswith('.tmp'):
+                continue
+            m = RE_DASH_INIT.match(name)
+            if m and (final or m.group(1) in latest):
+                ready.append(name)
+            m = RE_DASH_SEGMENT.match(name)
+            if m and (final or int(m.group(2)) < latest[m.group(1)]):
+                ready.append(name)
+        return ready
+
+    def publish(self, final=False):
+        ready = self.complete_files(final)
+        for name in ready:
+            self.uploader.upload(
+                os.path.join(self.directory, name), name,
+                MIME_TYPES[name.rsplit('.', 1)[-1]])
+            self.published.add(name)
+
+        manifest = os.path.join(self.directory, DASH_MANIFEST_NAME)
+        if (ready or final) and os.path.exists(manifest):
+            if self.manifest_id is None:
+                self.manifest_id = self.uploader.upload(
+                    manifest, DASH_MANIFEST_NAME,
+                    'application/dash+xml')['_id']
+            else:
+                self.uploader.replace(self.manifest_id, manifest)
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as exc:
+                sys.stderr.write('segment upload failed: %r\n' % (exc, ))
+                sys.stderr.flush()
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+    def finish(self):
+        self.stop()
+        self.publish(final=True)
+
+
+def checkpoint_fingerprint(meta, renditions, profile):
+    """Exit:  fingerprint: what a checkpoint must have been made with to be
+                       resumed: the size and duration of the input, the
+                       renditions and the encoding profile."""
+    return {
+        'size': meta['probe'].get('format', {}).get('size'),
+        'duration': meta.get('duration'),
+        'renditions': [[name, height] for name, height in renditions],
+        'profile': profile,
+    }
+
+
+class Checkpoint(object):
+    """The state of a chunked transcode, kept in the item while it advances:
+     the probed metadata of the input, the number of chunks, the chunks the
+     input was split into and, for each finished chunk, the ids of its
+     encoded renditions, which are uploaded as soon as the chunk is done.  A
+     job that resumes from a checkpoint skips the probe, downloads the
+     finished chunks and only encodes the ones that are missing."""
+
+    def __init__(self, uploader, fingerprint, file_id=None, state=None):
+        self.uploader = uploader
+        self.file_id = file_id
+        self.path = os.path.join(GIRDER_WORKER_DIR, CHUNK_DIR, CHECKPOINT_NAME)
+        self.lock = threading.Lock()
+        if not state or state.get('version') != CHECKPOINT_VERSION or \
+                state.get('fingerprint') != fingerprint:
+            state = {'version': CHECKPOINT_VERSION,
+                     'fingerprint': fingerprint,
+                     'count': None, 'chunks': [], 'completed': {}}
+        self.state = state
+        self.restored = 0
+
+    @staticmethod
+    def read(uploader, file_id):
+        """Download the state of the checkpoint of an earlier job.
+        Exit:  state: the state of the checkpoint, or None if it cannot be
+                      read."""
+        chunk_dir = os.path.join(GIRDER_WORKER_DIR, CHUNK_DIR)
+        os.makedirs(chunk_dir, exist_ok=True)
+        path = os.path.join(chunk_dir, CHECKPOINT_NAME)
+        try:
+            uploader.download(file_id, path)
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError, urllib.error.URLError) as exc:
+            sys.stderr.write('cannot resume from checkpoint %s: %r\n' % (
+                file_id, exc))
+            sys.stderr.flush()
+        return None
+
+    @classmethod
+    def open(cls, uploader, fingerprint, probed, file_id=None, state=None):
+        """Start the checkpoint of a transcode, resuming the one of an
+         earlier job if its state is given.  A checkpoint made with a
+         different input or different parameters is started over.
+        Enter: probed: the metadata from summarize_probe, recorded so that a
+                       resumed job need not probe the input again.
+               file_id: the id of the checkpoint to resume from, or None.
+               state: the state of that checkpoint, from read(), or None."""
+        os.makedirs(os.path.join(GIRDER_WORKER_DIR, CHUNK_DIR), exist_ok=True)
+        checkpoint = cls(uploader, fingerprint, file_id, state)
+        checkpoint.state['probe'] = probed
+        return checkpoint
+
+    @staticmethod
+    def recorded_probe(state, input_size=None):
+        """Exit:  meta: the metadata of the input recorded in the state of a
+                      checkpoint, or None if it has none or the size of the
+                      input does not match it."""
+        meta = (state or {}).get('probe')
+        if not meta or not isinstance(meta.get('probe'), dict):
+            return None
+        size = parse_number(meta['probe'].get('format', {}).get('size'), int)
+        if input_size is not None and size != input_size:
+            return None
+        return meta
+
+    def plan(self, chunks):
+        """Record the chunks the input was split into.  Finished chunks are
+         forgotten if the split does not match the one they were made from."""
+        names = [os.path.basename(chunk) for chunk in chunks]
+        with self.lock:
+            if self.state['chunks'] != names:
+                self.state['chunks'] = names
+                self.state['completed'] = {}
+            self.save()
+
+    def restore(self, index, chunk, renditions):
+        """Download the encoded renditions of a chunk finished by an earlier
+         job.
+        Exit:  done: the frames and output time of the chunk, or None if it
+                     has to be encoded."""
+        done = self.state['completed'].get(str(index))
+        if not done or any(
+                name not in done['files'] for name, _ in renditions):
+            return None
+        for name, _ in renditions:
+            self.uploader.download(
+                done['files'][name], chunk_output(chunk, name))
+        with self.lock:
+            self.restored += 1
+        return done
+
+    def record(self, index, chunk, renditions, frames, out_time):
+        """Upload the encoded renditions of a chunk and add them to the
+         checkpoint."""
+        files = {}
+        for name, _ in renditions:
+            files[name] = self.uploader.upload(
+                chunk_output(chunk, name), CHECKPOINT_SEGMENT_NAME % (
+                    index, name), 'application/octet-stream')['_id']
+        with self.lock:
+            self.state['completed'][str(index)] = {
+                'files': files, 'frames': frames, 'outTime': out_time}
+            self.save()
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        if self.file_id is None:
+            self.file_id = self.uploader.upload(
+                self.path, CHECKPOINT_NAME, 'application/json')['_id']
+        else:
+            self.uploader.replace(self.file_id, self.path)
+
+
+def keyframe_index(path):
+    """List the keyframes of the first video stream of a file.  Only packet
+     headers are read; nothing is decoded.
+    Enter: path: path of the file to index.
+    Exit:  keyframes: list of (pts, byte offset, frame number) tuples."""
+    cmd = [FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,pos,flags',
+           '-print_format', 'csv=print_section=0', path]
+    log_command(cmd)
 
     proc = subprocess.Popen(
             cmd,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
             universal_newlines=True)
 
-    calcdur = None
-    calcframe = None
+    keyframes = []
+    frame = 0
+    for line in proc.stdout:
+        fields = line.strip().split(',')
+        if len(fields) < 3:
+            continue
+        pts, pos, flags = fields[:3]
+        if 'K' in flags:
+            pts = parse_number(pts)
+            pos = parse_number(pos, int)
+            if pts is not None and pos is not None:
+                keyframes.append((pts, pos, frame))
+        frame += 1
 
-    for line in proc.stderr:
-        if line.startswith('frame=') and ' time=' in line:
-            calcframe = int(line.split("frame=")[1].split()[0])
-            calcdur = duration_parse(line.split(" time=")[1].split()[0])
+    proc.stdout.close()
+    check_exit_code(proc.wait(), cmd)
+    return keyframes
 
-    if calcdur:
-        meta['duration'] = calcdur
-        meta['video']['frameCount'] = calcframe
-        meta['video']['frameRate'] = float(calcframe)/calcdur
 
-    proc.stderr.close()
-    check_exit_code([proc.wait(), 0][1], cmd)
+def write_keyframe_index(keyframes, path):
+    with open(path, 'wb') as f:
+        f.write(KEYFRAME_INDEX_HEADER.pack(
+            KEYFRAME_INDEX_MAGIC, KEYFRAME_INDEX_VERSION, len(keyframes)))
+        for record in keyframes:
+            f.write(KEYFRAME_INDEX_RECORD.pack(*record))
 
-    # TODO(opadron): work out multiple quality versions (-crf 30).
-    cmd = [
-        FFMPEG, '-i', input_file, '-vf', 'scale=640x480', '-quality', 'good',
-        '-threads', '16', '-c:v', 'libvpx-vp9', '-crf', '5',
-        '-b:v', '1000k', '-c:a', 'libopus', os.path.join(GIRDER_WORKER_DIR,
-        'source.webm')]
 
-    sys.stdout.write(' '.join(('RUN:', repr(cmd))))
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+def expected_outputs(args):
+    """List every file the job's output specs expect to find."""
+    ext = args.profile['container']
+    outputs = ['meta.json', METRICS_NAME]
+    if args.storyboard_sheets:
+        outputs.append(STORYBOARD_INDEX_NAME)
+        outputs.extend(STORYBOARD_NAME % (i + 1)
+                       for i in range(args.storyboard_sheets))
+    if not args.segmented:
+        for height in args.renditions:
+            outputs.append(RENDITION_NAME % (height, ext))
+            outputs.append(KEYFRAME_INDEX_NAME % height)
+    if args.activity_index:
+        outputs.append(ACTIVITY_INDEX_NAME)
+    if args.waveform:
+        outputs.append(WAVEFORM_NAME)
+    return outputs
+
+
+def cgroup_cpu_quota():
+    """Read the CPU bandwidth limit of the container, as set by docker run
+     --cpus or a Kubernetes CPU limit.
+    Exit:  quota: the number of CPUs worth of time the container may use, or
+                  None if it is not limited."""
+    try:
+        with open(CGROUP_CPU_MAX) as f:
+            quota, period = f.read().split()[:2]
+    except (IOError, OSError, ValueError):
+        try:
+            with open(CGROUP_CPU_QUOTA) as f:
+                quota = f.read().strip()
+            with open(CGROUP_CPU_PERIOD) as f:
+                period = f.read().strip()
+        except (IOError, OSError):
+            return None
+    quota, period = parse_number(quota), parse_number(period)
+    if not quota or quota < 0 or not period:
+        return None
+    return quota / period
+
+
+def available_cpus():
+    """Number of CPUs this process may run on, honoring container limits set
+     through the CPU affinity mask or the cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, int(math.ceil(quota)))
+    return max(1, cpus)
+
+
+def plan_chunks(meta, requested, min_duration):
+    """Decide how many chunks to split the input into.
+    Enter: meta: the metadata from summarize_probe.
+           requested: requested number of chunks; 0 to choose one from the
+                      available CPUs and 1 to disable chunking.
+           min_duration: videos shorter than this many seconds are never
+                         chunked automatically.
+    Exit:  chunks: the number of chunks, 1 for a single transcode."""
+    duration = meta.get('duration') or 0
+    if requested:
+        return max(1, requested)
+    if duration < min_duration:
+        return 1
+    workers = max(1, available_cpus() // CHUNK_THREADS)
+    # A few more chunks than workers evens out chunks of unequal cost, but
+    # chunks shorter than CHUNK_MIN_DURATION are not worth their overhead.
+    return max(1, min(workers * 2, int(duration // CHUNK_MIN_DURATION)))
+
+
+def read_progress(stream):
+    """Parse the output of ffmpeg's -progress option.
+    Enter: stream: text stream of key=value lines, in blocks that each end
+                   with a progress key.
+    Exit:  yields a dictionary of the fields of each block."""
+    block = {}
+    for line in stream:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        block[key] = value
+        if key == 'progress':
+            yield block
+            block = {}
+
+
+def progress_fields(block):
+    """Extract the frame count and output time from a block of ffmpeg
+     progress.  out_time_ms is in microseconds despite its name, and is
+     used where out_time_us is not available.
+    Exit:  frame: frames written, or None.
+           out_time: seconds of output written, or None."""
+    frame = parse_number(block.get('frame'), int)
+    out_time = None
+    for key in ('out_time_us', 'out_time_ms'):
+        value = parse_number(block.get(key), int)
+        if value is not None and value >= 0:
+            out_time = value / 1e6
+            break
+    return frame, out_time
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressReporter(object):
+    """Aggregate the progress of one ffmpeg process, or of concurrently
+     encoding chunks, into the progress stream read by girder_worker.  Each
+     report becomes a job update on the server, so reports are coalesced:
+     one is written at most every interval seconds, and only once the
+     encode has advanced by step percent since the previous one.  Progress
+     is measured in milliseconds of output when the duration is known and
+     in frames otherwise."""
+
+    def __init__(self, prog, duration=None, frame_count=None,
+                 interval=PROGRESS_INTERVAL, step=PROGRESS_STEP,
+                 message='transcoding video'):
+        self.prog = prog
+        self.duration = duration
+        self.total = int(duration * 1000) if duration else frame_count
+        self.interval = interval
+        self.step = step
+        self.message = message
+        self.frames = {}
+        self.times = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_time = None
+        self.last_current = None
+
+    def update(self, stream, block):
+        """Record a block of ffmpeg progress from one of the processes."""
+        frame, out_time = progress_fields(block)
+        with self.lock:
+            if frame is not None:
+                self.frames[stream] = frame
+            if out_time is not None:
+                self.times[stream] = out_time
+            if not self.total:
+                return
+            now = time.time()
+            current = self.current()
+            if self.last_time is not None and (
+                    now - self.last_time < self.interval or
+                    (current - self.last_current) * 100.0 <
+                    self.step * self.total):
+                return
+            self.write(self.summary(now), current)
+            self.last_time = now
+            self.last_current = current
+
+    def finish(self, message):
+        """Report the encode as complete."""
+        with self.lock:
+            if self.total:
+                self.write(message, self.total)
+
+    def current(self):
+        if self.duration:
+            current = int(sum(self.times.values()) * 1000)
+        else:
+            current = sum(self.frames.values())
+        return min(current, self.total)
+
+    def summary(self, now):
+        """Exit:  message: the progress message, with the percentage done,
+                  the encoding rate in frames per second, the speed as a
+                  multiple of real time, and the estimated time left."""
+        elapsed = max(now - self.start, 1e-3)
+        parts = ['%d%%' % (100 * self.current() // self.total)]
+        frames = sum(self.frames.values())
+        if frames:
+            parts.append('%.1f fps' % (frames / elapsed))
+        media_time = sum(self.times.values())
+        if self.duration and media_time:
+            speed = media_time / elapsed
+            parts.append('%.2fx' % speed)
+            parts.append('ETA %s' % format_duration(
+                max(0, self.duration - media_time) / speed))
+        return '%s: %s' % (self.message, ', '.join(parts))
+
+    def write(self, message, current):
+        json.dump({
+            'message': message,
+            'total': self.total,
+            'current': current
+        }, self.prog)
+        self.prog.flush()
+
+    @property
+    def frame(self):
+        with self.lock:
+            return sum(self.frames.values()) or None
+
+
+def run_with_progress(cmd, progress, stream=0):
+    """Run an ffmpeg command, feeding its progress to a reporter.  Its log
+     messages go straight to stderr.
+    Exit:  code: the exit code of the process."""
+    cmd = cmd[:1] + PROGRESS_ARGS + cmd[1:]
+    log_command(cmd)
+
+    proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            universal_newlines=True)
+    for block in read_progress(proc.stdout):
+        progress.update(stream, block)
+    proc.stdout.close()
+    return proc.wait()
+
+
+def split_input(input_file, count, duration):
+    """Split the video stream of the input into chunks without re-encoding.
+     The segment muxer only cuts at keyframes, so every chunk can be decoded
+     on its own.
+    Exit:  chunks: sorted list of chunk paths.
+           starts: the time of the source each chunk starts at."""
+    chunk_dir = os.path.join(GIRDER_WORKER_DIR, CHUNK_DIR)
+    os.makedirs(chunk_dir, exist_ok=True)
+    list_path = os.path.join(chunk_dir, 'input.csv')
+
+    cmd = [FFMPEG, '-v', 'error'] + input_args(input_file) + [
+           '-map', '0:v:0',
+           '-c', 'copy', '-f', 'segment',
+           '-segment_time', '%.3f' % (duration / float(count)),
+           '-segment_list', list_path, '-segment_list_type', 'csv',
+           '-reset_timestamps', '1',
+           os.path.join(chunk_dir, 'input_%04d.mkv')]
+    log_command(cmd)
+    check_exit_code(subprocess.call(cmd), cmd)
+
+    starts = {}
+    with open(list_path) as f:
+        for line in f:
+            fields = line.strip().split(',')
+            if len(fields) >= 2:
+                starts[fields[0]] = parse_number(fields[1]) or 0.0
+    chunks = sorted(glob.glob(os.path.join(chunk_dir, 'input_*.mkv')))
+    # The first chunk starts with the source's first frame, whatever the
+    # source's start time.
+    origin = min(starts.values()) if starts else 0.0
+    return chunks, [starts.get(os.path.basename(chunk), origin) - origin
+                    for chunk in chunks]
+
+
+def chunk_output(chunk, name):
+    base = os.path.splitext(os.path.basename(chunk))[0]
+    return os.path.join(os.path.dirname(chunk), '%s_%s' % (base, name))
+
+
+def encode_chunk(index, chunk, renditions, profile, threads, progress,
+                 checkpoint=None, storyboard=None):
+    """Encode every rendition of one chunk, and its storyboard thumbnails,
+     reporting its progress.  With a checkpoint, a chunk finished by an
+     earlier job is downloaded instead, and a newly encoded one is uploaded.
+    Enter: storyboard: (chain, count) from chunk_storyboard, or None."""
+    chain, count = storyboard or (None, 0)
+    outputs = list(renditions)
+    if count:
+        outputs.append((STORYBOARD_CHUNK_NAME, None))
+    if checkpoint is not None:
+        done = checkpoint.restore(index, chunk, outputs)
+        if done is not None:
+            progress.update(index, {
+                'frame': done.get('frames'),
+                'out_time_us': int((done.get('outTime') or 0) * 1e6)})
+            return
+
+    graph, labels, storyboard_label = split_graph(
+        renditions, storyboard_chain=chain)
+    cmd = [FFMPEG, '-v', 'error', '-i', chunk, '-filter_complex', graph]
+    for label, (name, height) in zip(labels, renditions):
+        cmd.extend(['-map', label])
+        cmd.extend(video_codec_args(profile, height, threads))
+        cmd.append(chunk_output(chunk, name))
+    if storyboard_label:
+        cmd.extend(['-map', storyboard_label, '-c:v', 'mjpeg', '-q:v', '5',
+                    '-frames:v', str(count),
+                    chunk_output(chunk, STORYBOARD_CHUNK_NAME)])
+    check_exit_code(run_with_progress(cmd, progress, index), cmd)
+
+    if checkpoint is not None:
+        with progress.lock:
+            frames = progress.frames.get(index)
+            out_time = progress.times.get(index)
+        checkpoint.record(index, chunk, outputs, frames, out_time)
+
+
+def encode_audio(input_file, profile):
+    """Encode the audio track of a chunked transcode, which is muxed into
+     every rendition.  Only the audio is decoded.
+    Exit:  audio: path of the encoded audio."""
+    audio = os.path.join(GIRDER_WORKER_DIR, CHUNK_DIR, 'audio.%s' % (
+        'webm' if profile['container'] == 'webm' else 'm4a'))
+    cmd = [FFMPEG, '-v', 'error'] + input_args(input_file) + [
+        '-map', '0:a:0', '-vn'] + audio_codec_args(profile) + [audio]
+    log_command(cmd)
+    check_exit_code(subprocess.call(cmd), cmd)
+    return audio
+
+
+def tile_storyboard(chunks, layout):
+    """Tile the thumbnails taken by the chunks into the storyboard sheets.
+     Only the small thumbnails are decoded.
+    Enter: chunks: the paths of the chunks that took thumbnails, in order."""
+    list_path = os.path.join(GIRDER_WORKER_DIR, CHUNK_DIR, 'storyboard.txt')
+    with open(list_path, 'w') as f:
+        for chunk in chunks:
+            f.write("file '%s'\n" % chunk_output(chunk, STORYBOARD_CHUNK_NAME))
+
+    cmd = [FFMPEG, '-v', 'error', '-f', 'concat', '-safe', '0',
+           '-i', list_path, '-filter_complex', '[0:v]tile=%dx%d[sbo]' % (
+               layout['columns'], layout['rows'])]
+    cmd.extend(storyboard_output('[sbo]', layout))
+    log_command(cmd)
+    check_exit_code(subprocess.call(cmd), cmd)
+
+
+def concat_rendition(chunks, name, audio):
+    """Join the encoded chunks of a rendition without re-encoding them, and
+     mux in the audio track."""
+    list_path = os.path.join(GIRDER_WORKER_DIR, CHUNK_DIR, name + '.txt')
+    with open(list_path, 'w') as f:
+        for chunk in chunks:
+            f.write("file '%s'\n" % chunk_output(chunk, name))
+
+    cmd = [FFMPEG, '-v', 'error', '-f', 'concat', '-safe', '0',
+           '-i', list_path]
+    if audio:
+        cmd.extend(['-i', audio, '-map', '0:v', '-map', '1:a'])
+    cmd.extend(['-c', 'copy'] + muxer_args(name) +
+               [os.path.join(GIRDER_WORKER_DIR, name)])
+    log_command(cmd)
+    check_exit_code(subprocess.call(cmd), cmd)
+
+
+def chunked_transcode(input_file, meta, renditions, profile, storyboard, count,
+                      progress, checkpoint=None):
+    """Transcode by splitting the input at keyframes and encoding the chunks
+     concurrently, one ffmpeg process per chunk, with as many processes as
+     the available CPUs allow.  libvpx-vp9 does not scale well across
+     threads, so several narrow encoders keep far more cores busy than one
+     wide one.  The storyboard thumbnails are taken from the same decodes,
+     so the video of the source is only decoded once.
+    Enter: checkpoint: a Checkpoint to resume from and record finished
+                       chunks in, or None.
+    Exit:  frame: the number of video frames encoded."""
+    chunks, starts = split_input(input_file, count, meta['duration'])
+    if checkpoint is not None:
+        checkpoint.plan(chunks)
+    threads = min(CHUNK_THREADS, available_cpus())
+    workers = max(1, available_cpus() // threads)
+
+    thumbnails = [None] * len(chunks)
+    if storyboard:
+        thumbnails = [
+            chunk_storyboard(storyboard, start, end)
+            for start, end in zip(starts, starts[1:] + [meta['duration']])]
+
+    with concurrent.futures.ThreadPoolExecutor(workers + 1) as pool:
+        audio = None
+        if meta['audio']:
+            audio = pool.submit(encode_audio, input_file, profile)
+        encodes = [
+            pool.submit(encode_chunk, index, chunk, renditions, profile,
+                        threads, progress, checkpoint, thumbnails[index])
+            for index, chunk in enumerate(chunks)]
+        for future in encodes:
+            future.result()
+        audio = audio.result() if audio is not None else None
+
+    for name, _ in renditions:
+        concat_rendition(chunks, name, audio)
+    if storyboard:
+        tile_storyboard([chunk for chunk, thumbs in zip(chunks, thumbnails)
+                         if thumbs[1]], storyboard)
+
+    meta['chunks'] = len(chunks)
+    if checkpoint is not None:
+        meta['checkpoint'] = {'restoredChunks': checkpoint.restored}
+    return progress.frame
+
+
+def read_frames(stream, frame_size, batch):
+    """Read raw 8-bit grayscale frames from a stream in batches.
+    Enter: stream: binary stream of concatenated frames.
+           frame_size: (width, height) of a frame.
+           batch: the number of frames per batch.
+    Exit:  yields uint8 arrays of shape (frames, height, width)."""
+    width, height = frame_size
+    size = width * height
+    while True:
+        data = stream.read(size * batch)
+        if len(data) < size:
+            return
+        count = len(data) // size
+        yield numpy.frombuffer(data[:count * size], numpy.uint8).reshape(
+            count, height, width)
+
+
+def scene_cuts(motion, rate):
+    """Find the frames that start a new scene.
+    Enter: motion: float32 array of the motion energy of each frame.
+           rate: frames per second of the array.
+    Exit:  cuts: list of frame numbers."""
+    # Mean of the preceding window, excluding the frame itself, from a
+    # cumulative sum.
+    total = numpy.concatenate(
+        ([0.0], numpy.cumsum(motion, dtype=numpy.float64)))
+    index = numpy.arange(len(motion))
+    start = numpy.maximum(index - ACTIVITY_CUT_WINDOW, 0)
+    count = numpy.maximum(index - start, 1)
+    baseline = (total[index] - total[start]) / count
+
+    candidates = numpy.flatnonzero(
+        (motion > ACTIVITY_CUT_THRESHOLD) &
+        (motion > ACTIVITY_CUT_RATIO * baseline))
+    cuts = []
+    min_gap = ACTIVITY_CUT_MIN_GAP * rate
+    for frame in candidates.tolist():
+        if frame and (not cuts or frame - cuts[-1] >= min_gap):
+            cuts.append(frame)
+    return cuts
 
-    meta_dump = json.dumps(meta, indent=2)
-    with open(os.path.join(GIRDER_WORKER_DIR, '.girder_progress'), 'w') as prog:
-        proc = subprocess.Popen(
-                cmd,
-                stderr=subprocess.PIPE,
-                universal_newlines=True)
-
-        total = int(calcframe + len(meta_dump))
-        for line in proc.stderr:
-            if calcdur:
-                m = RE_PROGRESS_INFO.match(line)
-                if m:
-                    progress_update = {
-                        'message': 'transcoding video...',
-                        'total': total,
-                        'current': int(m.group(1).strip())
-                    }
-
-                    json.dump(progress_update, prog)
-                    prog.flush()
-
-            sys.stderr.write(line)
-            sys.stderr.flush()
 
-        proc.stderr.close()
-        check_exit_code([proc.wait(), 0][1], cmd)
+def activity_index(input_file, meta, path):
+    """Decode a small grayscale version of the video and compute, for each
+     sampled frame, its mean luminance and its motion energy (the mean
+     absolute difference from the previous frame), both in [0, 1], with
+     batched array operations.  The index is saved as a float32 array of
+     (time, luminance, motion) rows.
+    Enter: input_file: path or URL of the input.
+           meta: the summarized probe of the input.
+           path: where to save the index.
+    Exit:  activity: a summary for the metadata, with the scene cuts in
+                     seconds."""
+    rate = min(ACTIVITY_RATE, meta['video'].get('frameRate') or ACTIVITY_RATE)
+    cmd = [FFMPEG, '-v', 'error', '-nostdin'] + input_args(input_file) + [
+           '-map', '0:v:0', '-an', '-sn',
+           '-vf', 'fps=%g,scale=%d:%d,format=gray' % (
+               rate, ACTIVITY_WIDTH, ACTIVITY_HEIGHT),
+           '-f', 'rawvideo', 'pipe:1']
+    log_command(cmd)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
 
-        progress_update = {
-            'message': 'writing metadata...',
-            'total': total,
-            'current': total
-        }
+    luminance = []
+    motion = []
+    previous = None
+    for frames in read_frames(proc.stdout, (ACTIVITY_WIDTH, ACTIVITY_HEIGHT),
+                              ACTIVITY_BATCH):
+        frames = frames.astype(numpy.int16)
+        luminance.append(frames.mean(axis=(1, 2)))
+        stacked = frames if previous is None else numpy.concatenate(
+            (previous, frames))
+        diff = numpy.abs(numpy.diff(stacked, axis=0)).mean(axis=(1, 2))
+        motion.append(diff if previous is not None else
+                      numpy.concatenate(([0.0], diff)))
+        previous = frames[-1:]
+    proc.stdout.close()
+    check_exit_code(proc.wait(), cmd)
 
-        json.dump(progress_update, prog)
-        prog.flush()
+    luminance = (numpy.concatenate(luminance) / 255.0 if luminance else
+                 numpy.zeros(0)).astype(numpy.float32)
+    motion = (numpy.concatenate(motion) / 255.0 if motion else
+              numpy.zeros(0)).astype(numpy.float32)
+    times = (numpy.arange(len(motion)) / rate).astype(numpy.float32)
+    with open(path, 'wb') as f:
+        numpy.save(f, numpy.stack((times, luminance, motion), axis=1))
+
+    return {
+        'name': os.path.basename(path),
+        'rate': rate,
+        'frames': len(motion),
+        'columns': ['time', 'luminance', 'motion'],
+        'cuts': [round(float(times[frame]), 3)
+                 for frame in scene_cuts(motion, rate)],
+    }
+
+
+def peak_pyramid(peaks):
+    """Build the coarser levels of a waveform by merging buckets.
+    Enter: peaks: int8 array of shape (buckets, 2) of (min, max) pairs.
+    Exit:  levels: list of (merge factor from the finest level, peaks),
+                   finest first."""
+    levels = [(1, peaks)]
+    factor = 1
+    while len(peaks) > WAVEFORM_MIN_BUCKETS:
+        # Pad the last bucket with its own values so the reshape is exact.
+        pad = -len(peaks) % WAVEFORM_FACTOR
+        padded = numpy.concatenate((peaks, numpy.repeat(peaks[-1:], pad, 0)))
+        grouped = padded.reshape(-1, WAVEFORM_FACTOR, 2)
+        peaks = numpy.stack(
+            (grouped[:, :, 0].min(axis=1), grouped[:, :, 1].max(axis=1)),
+            axis=1)
+        factor *= WAVEFORM_FACTOR
+        levels.append((factor, peaks))
+    return levels
+
+
+def waveform(input_file, path):
+    """Decode the first audio stream once to mono PCM and reduce it to
+     min/max peaks at several zoom levels, so that a timeline can draw the
+     waveform without fetching the audio.
+    Enter: input_file: path or URL of the input.
+           path: where to write the waveform file.
+    Exit:  waveform: a summary for the metadata."""
+    cmd = [FFMPEG, '-v', 'error', '-nostdin'] + input_args(input_file) + [
+           '-map', '0:a:0', '-vn', '-sn', '-ac', '1',
+           '-ar', str(WAVEFORM_RATE), '-f', 's16le', 'pipe:1']
+    log_command(cmd)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    batches = []
+    read_size = WAVEFORM_BUCKET * WAVEFORM_READ_BUCKETS * 2
+    while True:
+        data = proc.stdout.read(read_size)
+        if len(data) < 2:
+            break
+        samples = numpy.frombuffer(data[:len(data) // 2 * 2], '<i2')
+        pad = -len(samples) % WAVEFORM_BUCKET
+        if pad:
+            samples = numpy.concatenate(
+                (samples, numpy.repeat(samples[-1:], pad)))
+        buckets = samples.reshape(-1, WAVEFORM_BUCKET)
+        # Scale 16-bit samples to int8, rounding outwards so that quiet
+        # but nonzero audio stays visible.
+        batches.append(numpy.stack((
+            numpy.floor(buckets.min(axis=1) / 256.0),
+            numpy.ceil(buckets.max(axis=1) / 256.0)),
+            axis=1).clip(-128, 127).astype(numpy.int8))
+    proc.stdout.close()
+    check_exit_code(proc.wait(), cmd)
+
+    peaks = (numpy.concatenate(batches) if batches else
+             numpy.zeros((0, 2), numpy.int8))
+    levels = peak_pyramid(peaks)
+    with open(path, 'wb') as f:
+        f.write(WAVEFORM_HEADER.pack(
+            WAVEFORM_MAGIC, WAVEFORM_VERSION, WAVEFORM_RATE, len(levels)))
+        for factor, level in levels:
+            f.write(WAVEFORM_LEVEL_HEADER.pack(
+                WAVEFORM_BUCKET * factor, len(level)))
+            f.write(level.tobytes())
+
+    return {
+        'name': os.path.basename(path),
+        'sampleRate': WAVEFORM_RATE,
+        'levels': [{'samplesPerBucket': WAVEFORM_BUCKET * factor,
+                    'buckets': len(level)} for factor, level in levels],
+    }
+
+
+def cpu_seconds():
+    """Exit:  seconds: CPU time used by this process and by the children
+                    it has waited for."""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def peak_rss():
+    """Exit:  kib: the largest resident set size, in KiB, of this process
+                or of any child it has waited for."""
+    return max(resource.getrusage(who).ru_maxrss for who in (
+        resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+class StageMetrics(object):
+    """Record the start and end times, CPU time and peak memory of each
+     stage of the conversion.  CPU time includes the processes a stage ran;
+     stages that overlap, such as the analyses and the transcode, share
+     theirs.  The kernel only keeps a high-water mark of the memory of
+     waited-for children, so peakRssToDate is the largest resident set of
+     the conversion up to the end of the stage, not the stage's own peak: a
+     stage only shows its own usage when it is larger than that of every
+     earlier stage.  A stage may add fields, such as bytesIn, bytesOut and
+     frames, to the record it is given; fps is derived from frames, and
+     speed (as a multiple of real time) from the duration of the media."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {}
+        start = time.time()
+        cpu = cpu_seconds()
+        try:
+            yield record
+        finally:
+            end = time.time()
+            record.update({
+                'start': round(start, 3),
+                'end': round(end, 3),
+                'wall': round(end - start, 3),
+                'cpu': round(cpu_seconds() - cpu, 3),
+                'peakRssToDate': peak_rss(),
+            })
+            if end > start:
+                if record.get('frames'):
+                    record['fps'] = round(record['frames'] / (end - start), 2)
+                if record.get('duration'):
+                    record['speed'] = round(
+                        record['duration'] / (end - start), 3)
+            self.stages[name] = record
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'started': round(self.started, 3),
+                'finished': round(time.time(), 3),
+                'cpus': available_cpus(),
+                'stages': self.stages,
+            }, f, indent=2)
+
+
+def run_transcode(cmd, progress, publisher=None):
+    """Run a single transcode, reporting its progress.
+    Exit:  frame: the number of video frames encoded."""
+    if publisher is not None:
+        publisher.start()
+
+    code = run_with_progress(cmd, progress)
+
+    # A failed transcode stops publishing, but does not publish its final
+    # manifest.
+    if publisher is not None:
+        if code:
+            publisher.stop()
+        else:
+            publisher.finish()
+    check_exit_code(code, cmd)
+    return progress.frame
+
+
+def main(args, progress_stream=None):
+    """Convert the input.
+    Enter: args: the arguments from parse_args.
+           progress_stream: where to write progress reports, or None for the
+                            progress pipe of girder_worker's docker mode."""
+    global GIRDER_WORKER_DIR
+    if args.data_dir:
+        GIRDER_WORKER_DIR = args.data_dir
+
+    metrics = StageMetrics()
+    input_file = args.input_url or args.input or next(
+        glob.iglob(os.path.join(GIRDER_WORKER_DIR, 'input.*')))
+
+    # A job resuming a checkpoint reuses the metadata probed by the job that
+    # made it, which was run on the same file.
+    uploader = resumed = None
+    if args.checkpoint:
+        uploader = GirderUploader(args.girder_api_url, args.girder_token,
+                                  args.item_id)
+        if args.resume_checkpoint:
+            resumed = Checkpoint.read(uploader, args.resume_checkpoint)
+
+    # The frame count from the probe is only an estimate for containers that
+    # do not record it; the exact count is taken from the transcode below so
+    # that the input is only read once.
+    with metrics.stage('probe') as record:
+        meta = Checkpoint.recorded_probe(
+            resumed, None if args.input_url else file_size(input_file))
+        if meta is None:
+            meta = summarize_probe(probe(input_file))
+        else:
+            record['resumed'] = True
+        probed = json.loads(json.dumps(meta))
+    calcframe = meta['video'].get('frameCount')
+    input_size = file_size(None if args.input_url else input_file) or \
+        parse_number(meta['probe'].get('format', {}).get('size'), int)
+
+    profile = args.profile
+    renditions = select_renditions(
+        args.renditions, meta['video'].get('height'), profile['container'])
+    meta['profile'] = profile
+    meta['renditions'] = [
+        {'name': name, 'height': height, 'bitRate': rendition_bitrate(
+            height, profile.get('bitRateScale', 1.0))}
+        for name, height in renditions]
+
+    # A source that is already playable takes the place of the smallest
+    # rendition of the ladder that is at least as tall as it, and only the
+    # smaller renditions are encoded.  Segmented output is always encoded.
+    remux = None
+    outputs = renditions
+    if not args.segmented and meta['video']:
+        config = passthrough_config(profile)
+        reason = passthrough_reason(meta, profile, config, args.renditions)
+        meta['passthrough'] = {'remuxed': reason is None}
+        if reason is None:
+            height = meta['video']['height']
+            remux = RENDITION_NAME % (
+                min(h for h in args.renditions if h >= height),
+                profile['container'])
+            renditions = [(name, h) for name, h in renditions
+                          if h < height and config['encodeLadder']]
+            outputs = renditions + [(remux, height)]
+            bitrate = source_video_bitrate(meta)
+            meta['renditions'] = [
+                rendition for rendition in meta['renditions']
+                if rendition['name'] in dict(renditions)] + [{
+                    'name': remux, 'height': height, 'remuxed': True,
+                    'bitRate': '%dk' % bitrate}]
+        else:
+            meta['passthrough']['reason'] = reason
+
+    storyboard = None
+    if args.storyboard_sheets:
+        storyboard = storyboard_layout(
+            meta, args.storyboard_sheets, args.storyboard_size)
+        meta['storyboard'] = storyboard
+
+    # Segmented output is published while it is being encoded, so it is
+    # always produced by a single process.
+    chunks = 1
+    if not args.segmented and meta.get('duration') and meta['video'] and \
+            renditions:
+        chunks = plan_chunks(meta, args.chunks, args.chunk_min_duration)
+
+    # Transcodes long enough to be worth resuming are checkpointed, unless
+    # chunking was disabled.  They are split as their checkpoint was,
+    # whatever the CPUs of this worker, so that the chunks finished by an
+    # earlier job still match; a new checkpoint uses the requested number
+    # of chunks if one was given.
+    checkpoint = None
+    if args.checkpoint and args.chunks != 1 and not args.segmented and \
+            meta['video'] and \
+            renditions and \
+            (meta.get('duration') or 0) >= 2 * CHECKPOINT_SEGMENT_DURATION:
+        checkpoint = Checkpoint.open(
+            uploader, checkpoint_fingerprint(meta, renditions, profile),
+            probed, args.resume_checkpoint, resumed)
+        chunks = checkpoint.state['count'] or (
+            chunks if args.chunks else max(chunks, int(math.ceil(
+                meta['duration'] / CHECKPOINT_SEGMENT_DURATION))))
+        checkpoint.state['count'] = chunks
+
+    cmd = publisher = None
+    if args.segmented:
+        os.makedirs(os.path.join(GIRDER_WORKER_DIR, DASH_DIR), exist_ok=True)
+        cmd = dash_command(
+            input_file, renditions, profile, has_audio=bool(meta['audio']),
+            storyboard=storyboard)
+        meta['manifest'] = DASH_MANIFEST_NAME
+        publisher = SegmentPublisher(
+            GirderUploader(args.girder_api_url, args.girder_token,
+                           args.item_id),
+            os.path.join(GIRDER_WORKER_DIR, DASH_DIR))
+    elif chunks == 1 and (renditions or storyboard):
+        cmd = transcode_command(
+            input_file, renditions, profile, has_audio=bool(meta['audio']),
+            storyboard=storyboard)
+
+    # Each analysis runs on its own small decode, concurrently with the
+    # transcode.  They are optional outputs, so without NumPy they are left
+    # empty rather than failing the conversion.
+    analysis = concurrent.futures.ThreadPoolExecutor(2)
+    activity = peaks = None
+    if (args.activity_index or args.waveform) and numpy is None:
+        sys.stderr.write('NumPy is not installed; skipping the activity '
+                         'index and waveform\n')
+        sys.stderr.flush()
+    elif args.activity_index and meta['video']:
+        activity = analysis.submit(
+            activity_index, input_file, meta,
+            os.path.join(GIRDER_WORKER_DIR, ACTIVITY_INDEX_NAME))
+    if args.waveform and meta['audio'] and numpy is not None:
+        peaks = analysis.submit(
+            waveform, input_file,
+            os.path.join(GIRDER_WORKER_DIR, WAVEFORM_NAME))
+
+    if progress_stream is None:
+        progress_stream = open(
+            os.path.join(GIRDER_WORKER_DIR, '.girder_progress'), 'w')
+    with contextlib.closing(progress_stream) as prog:
+        progress = ProgressReporter(
+            prog, meta.get('duration'), calcframe, args.progress_interval,
+            args.progress_step)
+        if remux is not None:
+            with metrics.stage('remux') as record:
+                remux_cmd = remux_command(
+                    input_file, remux, has_audio=bool(meta['audio']))
+                log_command(remux_cmd)
+                check_exit_code(subprocess.call(remux_cmd), remux_cmd)
+                record['bytesIn'] = input_size
+                record['bytesOut'] = file_size(
+                    os.path.join(GIRDER_WORKER_DIR, remux))
+                if meta.get('duration'):
+                    record['duration'] = meta['duration']
+
+        with metrics.stage('encode') as record:
+            frame = None
+            if chunks > 1:
+                frame = chunked_transcode(
+                    input_file, meta, renditions, profile, storyboard, chunks,
+                    progress, checkpoint)
+            elif cmd is not None:
+                frame = run_transcode(cmd, progress, publisher)
+            record['frames'] = frame
+            record['bytesIn'] = input_size
+            record['bytesOut'] = sum(file_size(os.path.join(
+                GIRDER_WORKER_DIR, name)) or 0 for name, _ in renditions)
+            if meta.get('duration') and (cmd is not None or chunks > 1):
+                record['duration'] = meta['duration']
+
+        if frame:
+            meta['video']['frameCount'] = frame
+            if meta.get('duration'):
+                meta['video']['frameRate'] = float(frame)/meta['duration']
+
+        # Index the renditions that were just written; this only reads
+        # their packet headers, not the input.
+        if not args.segmented:
+            with metrics.stage('index'):
+                for name, _ in outputs:
+                    keyframes = keyframe_index(
+                        os.path.join(GIRDER_WORKER_DIR, name))
+                    write_keyframe_index(keyframes, os.path.join(
+                        GIRDER_WORKER_DIR,
+                        os.path.splitext(name)[0] + '.keyframes'))
+
+        if storyboard:
+            storyboard['sheets'] = write_storyboard_index(
+                storyboard, meta.get('duration'),
+                os.path.join(GIRDER_WORKER_DIR, STORYBOARD_INDEX_NAME))
+
+        # Only the time spent waiting for the analyses after the transcode
+        # is recorded; the rest of their work overlaps the encode.
+        with metrics.stage('analysis'):
+            if activity is not None:
+                meta['activity'] = activity.result()
+            if peaks is not None:
+                meta['waveform'] = peaks.result()
+            analysis.shutdown()
+
+        progress.finish('writing metadata...')
 
         with open(os.path.join(GIRDER_WORKER_DIR, 'meta.json'), 'w') as f:
-            f.write(meta_dump)
+            json.dump(meta, f, indent=2)
 
-if __name__ == '__main__':
+    metrics.write(os.path.join(GIRDER_WORKER_DIR, METRICS_NAME))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description='Probe and transcode a video for the Girder video plugin.')
+    parser.add_argument(
+        '--renditions', type=parse_renditions,
+        default=DEFAULT_RENDITIONS,
+        help='comma-separated rendition heights, e.g. 240,480,720,1080')
+    parser.add_argument(
+        '--profile', type=parse_profile,
+        default=DEFAULT_PROFILE,
+        help='encoding profile as a JSON object, e.g. '
+        '\'{"container": "mp4", "preset": "veryfast"}\'')
+    parser.add_argument(
+        '--segmented', action='store_true',
+        help='write a segmented DASH presentation and upload its segments to '
+        'the item while encoding')
+    parser.add_argument(
+        '--storyboard-sheets', type=int, default=0,
+        help='maximum number of storyboard sprite sheets; 0 to disable')
+    parser.add_argument(
+        '--storyboard-size', type=int, default=4096,
+        help='maximum width and height of a storyboard sprite sheet')
+    parser.add_argument(
+        '--chunks', type=int, default=0,
+        help='number of chunks to encode in parallel; 0 to choose from the '
+        'available CPUs and 1 to encode in a single process')
+    parser.add_argument(
+        '--chunk-min-duration', type=float, default=300,
+        help='shortest video, in seconds, that is chunked automatically')
+    parser.add_argument(
+        '--activity-index', action='store_true',
+        help='compute a scene-change and activity index (requires NumPy; '
+        'skipped without it)')
+    parser.add_argument(
+        '--waveform', action='store_true',
+        help='compute audio waveform peaks (requires NumPy; skipped '
+        'without it)')
+    parser.add_argument(
+        '--progress-interval', type=float, default=PROGRESS_INTERVAL,
+        help='minimum number of seconds between progress reports')
+    parser.add_argument(
+        '--progress-step', type=float, default=PROGRESS_STEP,
+        help='minimum advance, in percent, between progress reports')
+    parser.add_argument(
+        '--data-dir',
+        help='directory of the outputs, and of the input unless --input or '
+        '--input-url is given; defaults to the docker data volume')
+    parser.add_argument(
+        '--input', help='path of the input')
+    parser.add_argument(
+        '--input-url',
+        help='read the input from this URL, which should support range '
+        'requests, instead of from the worker data directory')
+    parser.add_argument(
+        '--checkpoint', action='store_true',
+        help='upload finished chunks of long transcodes to the item, with a '
+        'checkpoint from which a later job can resume; ignored with '
+        '--chunks 1')
+    parser.add_argument(
+        '--resume-checkpoint', metavar='FILE_ID',
+        help='resume from the checkpoint of an earlier job')
+    parser.add_argument('--girder-api-url', help='Girder API root URL')
+    parser.add_argument('--girder-token', help='Girder token for uploads')
+    parser.add_argument('--item-id', help='item to upload segments to')
+    return parser
+
+
+def parse_args(argv=None):
+    """Parse and check the command line.
+    Enter: argv: the arguments, or None for those of the process.
+    Exit:  args: the parsed arguments."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.segmented and not (
+            args.girder_api_url and args.girder_token and args.item_id):
+        parser.error('--segmented requires --girder-api-url, '
+                     '--girder-token and --item-id')
+    if args.checkpoint and not (
+            args.girder_api_url and args.girder_token and args.item_id):
+        parser.error('--checkpoint requires --girder-api-url, '
+                     '--girder-token and --item-id')
+    return args
+
+
+class JobManagerProgress(object):
+    """A file-like object that forwards the reports of a ProgressReporter
+     to girder_worker's job manager, for conversions run in the worker's own
+     process, where there is no progress pipe."""
+
+    def __init__(self, job_manager):
+        self.job_manager = job_manager
+        self.buffer = ''
+
+    def write(self, data):
+        self.buffer += data
+
+    def flush(self):
+        if not self.buffer:
+            return
+        report = json.loads(self.buffer)
+        self.buffer = ''
+        self.job_manager.updateProgress(
+            total=report['total'], current=report['current'],
+            message=report['message'])
+
+    def close(self):
+        self.flush()
+
+
+def run(args, progress_stream=None):
+    """Convert the input, then leave the outputs that were not produced
+     (including renditions that were skipped because the source is too small)
+     empty, so that the worker can still upload every declared output."""
     try:
-        main()
+        main(args, progress_stream)
     finally:
-        for fpath in (os.path.join(GIRDER_WORKER_DIR, 'meta.json'),
-                      os.path.join(GIRDER_WORKER_DIR, 'source.webm'),):
+        for fname in expected_outputs(args):
+            fpath = os.path.join(args.data_dir or GIRDER_WORKER_DIR, fname)
 
             if os.path.exists(fpath):
                 continue
 
-            with open(fpath, 'w') as f:
-                pass # touch
+            open(fpath, 'w').close()  # touch
 
+
+def run_local(argv, data_dir, input_path=None, job_manager=None):
+    """Run the conversion in the calling process, as the local executor of
+     the Girder plugin does from girder_worker's python mode, which saves
+     starting a container per job.  The data directory is module state, so
+     conversions in one process must not overlap; girder_worker runs one job
+     per worker process.
+    Enter: argv: the arguments that would be given to the container.
+           data_dir: the directory to write the outputs to.
+           input_path: the path of the input, unless it is streamed with
+                       --input-url.
+           job_manager: girder_worker's job manager to report progress to,
+                        or None."""
+    argv = list(argv) + ['--data-dir', data_dir]
+    if input_path:
+        argv.extend(['--input', input_path])
+    try:
+        args = parse_args(argv)
+    except SystemExit:
+        raise ValueError('Invalid conversion arguments: %r' % (argv, ))
+    run(args, JobManagerProgress(job_manager) if job_manager else None)
+
+
+if __name__ == '__main__':
+    run(parse_args())
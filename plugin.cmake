@@ -36,6 +36,15 @@ add_eslint_test(
 )
 
 add_python_test(cache PLUGIN video BIND_SERVER)
+add_python_test(dedup PLUGIN video)
+add_python_test(jobs PLUGIN video)
+add_python_test(scheduler PLUGIN video)
+add_python_test(metrics PLUGIN video)
+add_python_test(keyframes PLUGIN video)
+add_python_test(frames PLUGIN video)
+add_python_test(convert PLUGIN video)
+add_python_test(renditions PLUGIN video)
+add_python_test(video PLUGIN video)
 
 # add_web_client_test(
 #   video
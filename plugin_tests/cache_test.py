@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import os
+import shutil
+import tempfile
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class FrameCacheTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.directory = tempfile.mkdtemp(prefix='video_cache_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        base.TestCase.tearDown(self)
+
+    def _cache(self, maxDiskBytes=100, maxMemoryBytes=30):
+        from girder.plugins.video.cache import FrameCache
+
+        return FrameCache(self.directory, maxDiskBytes=maxDiskBytes,
+                          maxMemoryBytes=maxMemoryBytes)
+
+    def testKey(self):
+        from girder.plugins.video.cache import FrameCache
+
+        key = FrameCache.key('item', 'file', 12, None, 240, 'jpeg')
+        self.assertEqual(key, FrameCache.key(
+            'item', 'file', 12, None, 240, 'jpeg'))
+        self.assertNotEqual(key, FrameCache.key(
+            'item', 'file', 13, None, 240, 'jpeg'))
+        self.assertNotIn(os.sep, key)
+
+    def testGetPut(self):
+        cache = self._cache()
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', b'0123456789')
+        self.assertEqual(cache.get('a'), b'0123456789')
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'a')))
+
+        cache.put('a', b'abc')
+        self.assertEqual(cache.get('a'), b'abc')
+        self.assertEqual(cache._diskBytes, 3)
+
+    def testMemoryEviction(self):
+        cache = self._cache(maxMemoryBytes=30)
+        for key in 'abcd':
+            cache.put(key, key.encode('utf8') * 10)
+        # The least recently used frame leaves memory, but not the disk.
+        self.assertEqual(list(cache._memory), ['b', 'c', 'd'])
+        self.assertEqual(cache._memoryBytes, 30)
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        self.assertEqual(list(cache._memory), ['c', 'd', 'a'])
+
+        # Frames larger than the memory level are only kept on disk.
+        cache.put('e', b'e' * 40)
+        self.assertNotIn('e', cache._memory)
+        self.assertEqual(cache.get('e'), b'e' * 40)
+
+    def testDiskEviction(self):
+        cache = self._cache(maxDiskBytes=30, maxMemoryBytes=0)
+        for key in 'abc':
+            cache.put(key, key.encode('utf8') * 10)
+        # Reading a frame makes it the most recently used.
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        cache.put('d', b'd' * 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'b')))
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        self.assertEqual(cache._diskBytes, 30)
+
+        # Frames larger than the disk level are not written.
+        cache.put('e', b'e' * 40)
+        self.assertNotIn('e', cache._disk)
+
+    def testReload(self):
+        cache = self._cache()
+        cache.put('a', b'a' * 10)
+        open(os.path.join(self.directory, 'partial.tmp'), 'wb').close()
+
+        # A new cache on the same directory keeps the frames on disk and
+        # removes unfinished writes.
+        cache = self._cache()
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'partial.tmp')))
+
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,677 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import ast
+import io
+import json
+import mock
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+CONVERT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'docker', 'ffmpeg_local')
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+PROCESSING_PY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'server',
+    'processing.py')
+
+
+def _convert():
+    # The converter runs in its own Docker image rather than in Girder, so it
+    # is imported from its directory.
+    if CONVERT_DIR not in sys.path:
+        sys.path.insert(0, CONVERT_DIR)
+    import convert
+    return convert
+
+
+def _localTaskScript():
+    # The script is read from the plugin's source, as the plugin cannot be
+    # imported without Girder.
+    with open(PROCESSING_PY) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                getattr(target, 'id', None) == 'LOCAL_TASK_SCRIPT'
+                for target in node.targets):
+            return ast.literal_eval(node.value)
+
+
+def _loadProbe(name):
+    with open(os.path.join(DATA_DIR, name)) as f:
+        return json.load(f)
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'The converter needs Python 3')
+class ConvertProbeTestCase(unittest.TestCase):
+    def testSummarizeProbe(self):
+        convert = _convert()
+        info = _loadProbe('probe_h264_aac.json')
+        meta = convert.summarize_probe(info)
+
+        self.assertIs(meta['probe'], info)
+        self.assertAlmostEqual(meta['duration'], 10.01)
+        # The cover art is a video stream too, but not the video.
+        self.assertEqual(meta['video']['codec'], 'h264')
+        self.assertEqual(meta['video']['width'], 1280)
+        self.assertEqual(meta['video']['height'], 720)
+        self.assertEqual(meta['video']['pixelFormat'], 'yuv420p')
+        self.assertAlmostEqual(meta['video']['frameRate'], 30000 / 1001.0)
+        self.assertAlmostEqual(meta['video']['bitRate'], 2497.153)
+        self.assertEqual(meta['video']['frameCount'], 300)
+        self.assertEqual(meta['audio'], {
+            'codec': 'aac', 'bitRate': 128.001, 'sampleRate': 48000})
+
+    def testSummarizeProbeMissingFields(self):
+        convert = _convert()
+        info = _loadProbe('probe_h264_aac.json')
+        video = info['streams'][0]
+        for key in ('nb_frames', 'bit_rate'):
+            del video[key]
+        video['avg_frame_rate'] = '0/0'
+        info['streams'] = [video]
+        meta = convert.summarize_probe(info)
+
+        # The frame rate falls back to the stream's base rate, and the frame
+        # count is estimated from it and the duration.
+        self.assertAlmostEqual(meta['video']['frameRate'], 30000 / 1001.0)
+        self.assertEqual(meta['video']['frameCount'], 300)
+        self.assertNotIn('bitRate', meta['video'])
+        self.assertEqual(meta['audio'], {})
+
+        meta = convert.summarize_probe({'format': {'duration': 'N/A'}})
+        self.assertNotIn('duration', meta)
+        self.assertEqual(meta['video'], {})
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'The converter needs Python 3')
+class ConvertCommandTestCase(unittest.TestCase):
+    def testSelectRenditions(self):
+        convert = _convert()
+        ladder = (240, 480, 720, 1080)
+
+        self.assertEqual(convert.select_renditions(ladder, 720), [
+            ('source_240p.webm', 240), ('source_480p.webm', 480),
+            ('source_720p.webm', 720)])
+        self.assertEqual(convert.select_renditions(ladder, 600, 'mp4'), [
+            ('source_240p.mp4', 240), ('source_480p.mp4', 480)])
+        # An unknown source height encodes the whole ladder.
+        self.assertEqual(len(convert.select_renditions(ladder, None)), 4)
+        # A source shorter than the ladder keeps its own height.
+        self.assertEqual(convert.select_renditions(ladder, 144), [
+            ('source_240p.webm', 144)])
+        self.assertEqual(convert.select_renditions((), 720), [])
+
+    def testSplitGraph(self):
+        convert = _convert()
+        renditions = [('source_240p.webm', 240), ('source_480p.webm', 480)]
+
+        graph, labels, storyboardLabel = convert.split_graph(renditions)
+        self.assertEqual(graph, '[0:v:0]split=2[v0][v1];'
+                                '[v0]scale=-2:240[v0o];'
+                                '[v1]scale=-2:480[v1o]')
+        self.assertEqual(labels, ['[v0o]', '[v1o]'])
+        self.assertIsNone(storyboardLabel)
+
+        layout = {'interval': 5, 'tileWidth': 160, 'tileHeight': 90,
+                  'columns': 10, 'rows': 10, 'maxSheets': 3}
+        graph, labels, storyboardLabel = convert.split_graph(
+            renditions, layout)
+        self.assertTrue(graph.startswith('[0:v:0]split=3[v0][v1][sb];'))
+        self.assertTrue(graph.endswith(
+            ';[sb]fps=1/5,scale=160:90,tile=10x10[sbo]'))
+        self.assertEqual(labels, ['[v0o]', '[v1o]'])
+        self.assertEqual(storyboardLabel, '[sbo]')
+
+    def testChunkStoryboard(self):
+        convert = _convert()
+        layout = {'interval': 5, 'tileWidth': 160, 'tileHeight': 90,
+                  'columns': 10, 'rows': 10, 'maxSheets': 3}
+
+        # Every thumbnail of the source is taken by exactly one chunk.
+        bounds = [0, 9.97, 20, 31.2, 42.5]
+        plans = [convert.chunk_storyboard(layout, start, end)
+                 for start, end in zip(bounds, bounds[1:])]
+        self.assertEqual([count for _, count in plans], [2, 2, 3, 2])
+        self.assertIn('fps=1/5:start_time=10.000000', plans[1][0])
+        self.assertIn('setpts=PTS-STARTPTS+9.970000/TB', plans[1][0])
+        self.assertTrue(plans[1][0].endswith('scale=160:90'))
+        # A chunk shorter than the interval may take none.
+        self.assertEqual(convert.chunk_storyboard(layout, 10.5, 14), (None, 0))
+
+        graph, labels, storyboardLabel = convert.split_graph(
+            [('source_240p.webm', 240)], storyboard_chain=plans[1][0])
+        self.assertTrue(graph.startswith('[0:v:0]split=2[v0][sb];'))
+        self.assertTrue(graph.endswith(';[sb]%s[sbo]' % plans[1][0]))
+        self.assertEqual(storyboardLabel, '[sbo]')
+
+    def _option(self, cmd, option):
+        return [cmd[i + 1] for i, arg in enumerate(cmd) if arg == option]
+
+    def testTranscodeCommand(self):
+        convert = _convert()
+        renditions = [('source_240p.webm', 240), ('source_480p.webm', 480)]
+
+        with mock.patch.object(convert, 'available_cpus', return_value=8):
+            cmd = convert.transcode_command(
+                'in.mkv', renditions, convert.DEFAULT_PROFILE)
+        self.assertEqual(cmd[:3], [convert.FFMPEG, '-i', 'in.mkv'])
+        self.assertEqual(self._option(cmd, '-map'), [
+            '[v0o]', '0:a:0', '[v1o]', '0:a:0'])
+        self.assertEqual(self._option(cmd, '-c:v'), ['libvpx-vp9'] * 2)
+        self.assertEqual(self._option(cmd, '-b:v'), ['353k', '1000k'])
+        # The encoders run concurrently, so they share the CPUs.
+        self.assertEqual(self._option(cmd, '-threads:v'), ['4', '4'])
+        self.assertEqual(cmd[-1], os.path.join(
+            convert.GIRDER_WORKER_DIR, 'source_480p.webm'))
+        self.assertEqual(self._option(cmd, '-cues_to_front'), ['1', '1'])
+
+        # Without audio, only the video branches are mapped; inputs read
+        # over HTTP reconnect.
+        with mock.patch.object(convert, 'available_cpus', return_value=8):
+            cmd = convert.transcode_command(
+                'http://host/file?token=x', renditions,
+                convert.DEFAULT_PROFILE, has_audio=False)
+        self.assertEqual(self._option(cmd, '-map'), ['[v0o]', '[v1o]'])
+        self.assertEqual(self._option(cmd, '-reconnect'), ['1'])
+
+    def testDashCommand(self):
+        convert = _convert()
+        renditions = [('source_240p.mp4', 240), ('source_480p.mp4', 480),
+                      ('source_720p.mp4', 720)]
+        profile = convert.parse_profile('{"container": "mp4"}')
+
+        with mock.patch.object(convert, 'available_cpus', return_value=8):
+            cmd = convert.dash_command('in.mkv', renditions, profile)
+        self.assertEqual(self._option(cmd, '-map'), [
+            '[v0o]', '[v1o]', '[v2o]', '0:a:0'])
+        self.assertEqual(self._option(cmd, '-c:v:2'), ['libx264'])
+        # The threads are shared between the encoders.
+        self.assertEqual(self._option(cmd, '-threads:v:0'), ['2'])
+        self.assertEqual(self._option(cmd, '-dash_segment_type'), ['mp4'])
+        self.assertEqual(self._option(cmd, '-adaptation_sets'), [
+            'id=0,streams=v id=1,streams=a'])
+        self.assertEqual(cmd[-1], os.path.join(
+            convert.GIRDER_WORKER_DIR, convert.DASH_DIR,
+            convert.DASH_MANIFEST_NAME))
+
+    def testPlanChunks(self):
+        convert = _convert()
+
+        with mock.patch.object(convert, 'available_cpus', return_value=16):
+            # An explicit request is honored whatever the duration.
+            self.assertEqual(convert.plan_chunks({'duration': 10}, 3, 600), 3)
+            self.assertEqual(convert.plan_chunks({'duration': 10}, -2, 0), 1)
+            # Short or unknown durations are not chunked automatically.
+            self.assertEqual(
+                convert.plan_chunks({'duration': 599}, 0, 600), 1)
+            self.assertEqual(convert.plan_chunks({}, 0, 0), 1)
+            # Twice as many chunks as workers, none shorter than a minute.
+            self.assertEqual(
+                convert.plan_chunks({'duration': 3600}, 0, 600), 8)
+            self.assertEqual(convert.plan_chunks({'duration': 150}, 0, 0), 2)
+        with mock.patch.object(convert, 'available_cpus', return_value=2):
+            self.assertEqual(
+                convert.plan_chunks({'duration': 3600}, 0, 600), 2)
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'The converter needs Python 3')
+class ConvertCpuTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _limits(self, **files):
+        convert = _convert()
+        paths = {}
+        for key in ('CGROUP_CPU_MAX', 'CGROUP_CPU_QUOTA', 'CGROUP_CPU_PERIOD'):
+            paths[key] = os.path.join(self.tempdir, key)
+            if key in files:
+                with open(paths[key], 'w') as f:
+                    f.write(files[key])
+            elif os.path.exists(paths[key]):
+                os.unlink(paths[key])
+        return mock.patch.multiple(convert, **paths)
+
+    def testCgroupCpuQuota(self):
+        convert = _convert()
+
+        with self._limits(CGROUP_CPU_MAX='150000 100000\n'):
+            self.assertEqual(convert.cgroup_cpu_quota(), 1.5)
+        with self._limits(CGROUP_CPU_MAX='max 100000\n'):
+            self.assertIsNone(convert.cgroup_cpu_quota())
+        with self._limits(CGROUP_CPU_QUOTA='400000\n',
+                          CGROUP_CPU_PERIOD='100000\n'):
+            self.assertEqual(convert.cgroup_cpu_quota(), 4)
+        with self._limits(CGROUP_CPU_QUOTA='-1\n',
+                          CGROUP_CPU_PERIOD='100000\n'):
+            self.assertIsNone(convert.cgroup_cpu_quota())
+        with self._limits():
+            self.assertIsNone(convert.cgroup_cpu_quota())
+
+    def testAvailableCpus(self):
+        convert = _convert()
+
+        with mock.patch.object(os, 'sched_getaffinity', create=True,
+                               return_value=set(range(8))):
+            with self._limits(CGROUP_CPU_MAX='250000 100000'):
+                self.assertEqual(convert.available_cpus(), 3)
+            with self._limits(CGROUP_CPU_MAX='50000 100000'):
+                self.assertEqual(convert.available_cpus(), 1)
+            with self._limits(CGROUP_CPU_MAX='1600000 100000'):
+                self.assertEqual(convert.available_cpus(), 8)
+            with self._limits():
+                self.assertEqual(convert.available_cpus(), 8)
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'The converter needs Python 3')
+class ConvertMetricsTestCase(unittest.TestCase):
+    def testStageMetrics(self):
+        convert = _convert()
+        metrics = convert.StageMetrics()
+
+        with metrics.stage('first') as record:
+            record['frames'] = 10
+        with metrics.stage('second'):
+            pass
+        first, second = metrics.stages['first'], metrics.stages['second']
+        self.assertEqual(set(first) - {'fps'}, {
+            'frames', 'start', 'end', 'wall', 'cpu', 'peakRssToDate'})
+        # The memory peak is a high-water mark of the whole conversion.
+        self.assertGreater(first['peakRssToDate'], 0)
+        self.assertGreaterEqual(
+            second['peakRssToDate'], first['peakRssToDate'])
+        self.assertLessEqual(first['end'], second['start'])
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'The converter needs Python 3')
+class ConvertWaveformTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _decode(self, convert, samples):
+        # Stands in for ffmpeg decoding the audio to 16-bit PCM.
+        proc = mock.Mock()
+        proc.stdout = io.BytesIO(struct.pack('<%dh' % len(samples), *samples))
+        proc.wait.return_value = 0
+        return mock.patch.object(convert.subprocess, 'Popen',
+                                 return_value=proc)
+
+    def testWaveform(self):
+        convert = _convert()
+        path = os.path.join(self.tempdir, convert.WAVEFORM_NAME)
+        bucket = convert.WAVEFORM_BUCKET
+        buckets = convert.WAVEFORM_MIN_BUCKETS * 2 + 1
+        samples = []
+        for index in range(buckets):
+            samples.extend([-(index % 128) * 256, (index % 100) * 256 + 1] *
+                           (bucket // 2))
+
+        with self._decode(convert, samples):
+            summary = convert.waveform('in.mkv', path)
+        self.assertEqual(summary['name'], convert.WAVEFORM_NAME)
+        self.assertEqual(summary['sampleRate'], convert.WAVEFORM_RATE)
+        levels = [(bucket, buckets), (bucket * 4, (buckets + 3) // 4)]
+        self.assertEqual(summary['levels'], [
+            {'samplesPerBucket': size, 'buckets': count}
+            for size, count in levels])
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, rate, count = convert.WAVEFORM_HEADER.unpack_from(
+            data)
+        self.assertEqual((magic, version, rate, count), (
+            convert.WAVEFORM_MAGIC, convert.WAVEFORM_VERSION,
+            convert.WAVEFORM_RATE, 2))
+        offset = convert.WAVEFORM_HEADER.size
+        for size, count in levels:
+            self.assertEqual(convert.WAVEFORM_LEVEL_HEADER.unpack_from(
+                data, offset), (size, count))
+            offset += convert.WAVEFORM_LEVEL_HEADER.size
+            peaks = struct.unpack_from('<%db' % (count * 2), data, offset)
+            offset += count * 2
+            if size == bucket:
+                # Quiet but nonzero samples round outwards.
+                self.assertEqual(peaks[:6], (0, 1, -1, 2, -2, 3))
+            else:
+                self.assertEqual(peaks[:4], (-3, 4, -7, 8))
+                # The last bucket is padded with its own values.
+                self.assertEqual(peaks[-2:], (0, 49))
+        self.assertEqual(offset, len(data))
+
+    def testWaveformWithoutNumpy(self):
+        convert = _convert()
+
+        # The analyses are skipped rather than refused, since their outputs
+        # are optional.
+        with mock.patch.object(convert, 'numpy', None):
+            args = convert.parse_args(['--waveform', '--activity-index'])
+        self.assertTrue(args.waveform)
+        self.assertIn(convert.WAVEFORM_NAME, convert.expected_outputs(args))
+
+
+class FakeUploader(object):
+    """Stands in for Girder's file API, keeping files by id in memory."""
+
+    def __init__(self, files):
+        self.files = files
+
+    def __call__(self, api_url, token, item_id):
+        return self
+
+    def download(self, fileId, path):
+        with open(path, 'wb') as f:
+            f.write(self.files[fileId])
+
+    def upload(self, path, name, mimeType):
+        with open(path, 'rb') as f:
+            self.files[name] = f.read()
+        return {'_id': name}
+
+    def replace(self, fileId, path):
+        with open(path, 'rb') as f:
+            self.files[fileId] = f.read()
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'The converter needs Python 3')
+class ConvertCheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.input = os.path.join(self.tempdir, 'input.mkv')
+        with open(self.input, 'wb') as f:
+            f.write(b'\0' * 1000)
+        self.info = _loadProbe('probe_h264_aac.json')
+        self.info['format']['size'] = '1000'
+        self.info['format']['duration'] = '900.0'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _run(self, convert, files, argv):
+        args = convert.parse_args([
+            '--renditions', '240,480', '--checkpoint', '--chunks', '3',
+            '--girder-api-url', 'http://girder/api/v1',
+            '--girder-token', 'token', '--item-id', 'item',
+            '--data-dir', self.tempdir, '--input', self.input] + argv)
+        with mock.patch.object(convert, 'GIRDER_WORKER_DIR'), \
+                mock.patch.object(convert, 'GirderUploader',
+                                  FakeUploader(files)), \
+                mock.patch.object(convert, 'probe',
+                                  return_value=self.info) as probe, \
+                mock.patch.object(convert, 'chunked_transcode',
+                                  return_value=27000) as transcode, \
+                mock.patch.object(convert, 'keyframe_index',
+                                  return_value=[]):
+            convert.main(args, io.StringIO())
+        return probe, transcode
+
+    def testNewCheckpoint(self):
+        convert = _convert()
+        files = {}
+
+        probe, transcode = self._run(convert, files, [])
+        self.assertEqual(probe.call_count, 1)
+        # An explicit number of chunks is used for a new checkpoint.
+        self.assertEqual(transcode.call_args[0][5], 3)
+        checkpoint = transcode.call_args[0][7]
+        self.assertEqual(checkpoint.state['count'], 3)
+        self.assertEqual(checkpoint.state['probe'],
+                         convert.summarize_probe(self.info))
+
+    def testResumeCheckpoint(self):
+        convert = _convert()
+        meta = convert.summarize_probe(self.info)
+        renditions = convert.select_renditions((240, 480), 720, 'webm')
+        state = {
+            'version': convert.CHECKPOINT_VERSION,
+            'fingerprint': convert.checkpoint_fingerprint(
+                meta, renditions, convert.DEFAULT_PROFILE),
+            'probe': meta, 'count': 4, 'chunks': [], 'completed': {}}
+        files = {'checkpoint': json.dumps(state).encode('utf8')}
+
+        probe, transcode = self._run(
+            convert, files, ['--resume-checkpoint', 'checkpoint'])
+        # The recorded metadata is used instead of probing the input, and
+        # the input is split as the checkpoint was, whatever --chunks says.
+        self.assertEqual(probe.call_count, 0)
+        self.assertEqual(transcode.call_args[0][5], 4)
+        checkpoint = transcode.call_args[0][7]
+        self.assertEqual(checkpoint.file_id, 'checkpoint')
+        self.assertEqual(checkpoint.state['count'], 4)
+        with open(os.path.join(self.tempdir, convert.METRICS_NAME)) as f:
+            self.assertTrue(json.load(f)['stages']['probe']['resumed'])
+        with open(os.path.join(self.tempdir, 'meta.json')) as f:
+            self.assertEqual(json.load(f)['video']['height'], 720)
+
+        # A different input is probed, and its checkpoint started over.
+        with open(self.input, 'ab') as f:
+            f.write(b'\0')
+        self.info['format']['size'] = '1001'
+        probe, transcode = self._run(
+            convert, files, ['--resume-checkpoint', 'checkpoint'])
+        self.assertEqual(probe.call_count, 1)
+        self.assertEqual(transcode.call_args[0][5], 3)
+
+
+class StubGirder(object):
+    """
+    Serves the input of a conversion and records the files uploaded to it,
+    with just enough of Girder's file API for the conversion script.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.files = {}
+        self.uploads = {}
+        self.tokens = set()
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.get(self)
+
+            def do_POST(self):
+                stub.post(self)
+
+            def do_PUT(self):
+                stub.post(self)
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.apiUrl = 'http://127.0.0.1:%d/api/v1' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _reply(self, handler, code, body, headers=()):
+        handler.send_response(code)
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def get(self, handler):
+        # Only the input is downloaded, with range requests when ffmpeg
+        # seeks.
+        if urlparse(handler.path).path != '/api/v1/file/input/download':
+            return self._reply(handler, 404, b'')
+        size = len(self.data)
+        match = re.match(r'^bytes=(\d+)-(\d*)$',
+                         handler.headers.get('Range') or '')
+        if not match:
+            return self._reply(handler, 200, self.data, [
+                ('Accept-Ranges', 'bytes')])
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        if start >= size:
+            return self._reply(handler, 416, b'', [
+                ('Content-Range', 'bytes */%d' % size)])
+        self._reply(handler, 206, self.data[start:end + 1], [
+            ('Accept-Ranges', 'bytes'),
+            ('Content-Range', 'bytes %d-%d/%d' % (start, end, size))])
+
+    def post(self, handler):
+        url = urlparse(handler.path)
+        params = {key: value[0] for key, value in parse_qs(url.query).items()}
+        body = handler.rfile.read(int(handler.headers.get(
+            'Content-Length') or 0))
+        self.tokens.add(handler.headers.get('Girder-Token'))
+
+        if url.path == '/api/v1/file':
+            fileId = str(len(self.files))
+            self.files[fileId] = {
+                'name': params['name'], 'itemId': params['parentId'],
+                'reference': params.get('reference'), 'data': b''}
+        elif url.path.endswith('/contents'):
+            fileId = url.path.split('/')[-2]
+            self.files[fileId]['data'] = b''
+        elif url.path == '/api/v1/file/chunk':
+            fileId = self.uploads[params['uploadId']]
+            file = self.files[fileId]
+            if int(params['offset']) != len(file['data']):
+                return self._reply(handler, 400, b'')
+            file['data'] += body
+            return self._reply(handler, 200, json.dumps({
+                '_id': fileId, 'name': file['name']}).encode('utf8'))
+        else:
+            return self._reply(handler, 404, b'')
+
+        uploadId = 'upload%d' % len(self.uploads)
+        self.uploads[uploadId] = fileId
+        self._reply(handler, 200, json.dumps({
+            '_id': uploadId}).encode('utf8'))
+
+    def named(self, name):
+        return [file for file in self.files.values() if file['name'] == name]
+
+
+class FakeJobManager(object):
+    def __init__(self):
+        self.progress = []
+
+    def updateProgress(self, total, current, message=None):
+        self.progress.append((total, current))
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'The converter needs Python 3')
+class ConvertLocalTestCase(unittest.TestCase):
+    def setUp(self):
+        if not (shutil.which('ffmpeg') and shutil.which('ffprobe')):
+            self.skipTest('ffmpeg is not installed')
+        self.tempdir = tempfile.mkdtemp()
+        source = os.path.join(self.tempdir, 'source.mkv')
+        subprocess.check_call([
+            'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i',
+            'testsrc=size=320x240:rate=10:duration=3', '-f', 'lavfi', '-i',
+            'sine=duration=3', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+            '-g', '10', '-c:a', 'aac', source])
+        with open(source, 'rb') as f:
+            self.girder = StubGirder(f.read())
+
+    def tearDown(self):
+        self.girder.stop()
+        shutil.rmtree(self.tempdir)
+
+    def testLocalTask(self):
+        convert = _convert()
+        # The task as useLocalExecutor makes it for a segmented job with a
+        # streamed input: the script is run by girder_worker's python mode
+        # with the job's inputs bound to variables.
+        outputNames = {
+            'meta': 'meta.json',
+            'metrics': convert.METRICS_NAME,
+            'storyboard': convert.STORYBOARD_INDEX_NAME,
+            'storyboard_1': convert.STORYBOARD_NAME % 1
+        }
+        jobManager = FakeJobManager()
+        scope = {
+            '_tempdir': self.tempdir,
+            '_job_manager': jobManager,
+            'outputNames': outputNames,
+            'args': [
+                '--renditions', '120,240',
+                '--profile', json.dumps({
+                    'container': 'mp4', 'videoCodec': 'libx264',
+                    'audioCodec': 'aac', 'crf': 23, 'preset': 'veryfast'}),
+                '--storyboard-sheets', '1', '--storyboard-size', '4096',
+                '--input-url', self.girder.apiUrl + '/file/input/download',
+                '--segmented', '--girder-api-url', self.girder.apiUrl,
+                '--girder-token', 'token', '--item-id', 'item']
+        }
+        with mock.patch.object(convert, 'GIRDER_WORKER_DIR'):
+            exec(_localTaskScript(), scope)
+
+        # Each output variable names a file the script produced.
+        dataDir = os.path.join(self.tempdir, 'video')
+        for outputId, name in outputNames.items():
+            self.assertEqual(scope[outputId], os.path.join(dataDir, name))
+            self.assertTrue(os.path.getsize(scope[outputId]))
+        with open(scope['meta']) as f:
+            self.assertEqual(json.load(f)['video']['height'], 240)
+        self.assertTrue(jobManager.progress)
+
+        # The segments and the manifest were uploaded to the item while
+        # encoding, and girder_worker uploads the outputs after.
+        uploader = convert.GirderUploader(
+            self.girder.apiUrl, 'token', 'item')
+        for outputId, name in outputNames.items():
+            uploader.upload(scope[outputId], name, 'application/octet-stream')
+
+        files = list(self.girder.files.values())
+        self.assertEqual(self.girder.tokens, {'token'})
+        self.assertEqual({file['itemId'] for file in files}, {'item'})
+        self.assertEqual({file['reference'] for file in files},
+                         {'videoPlugin'})
+        names = {file['name'] for file in files}
+        # Two video representations and the audio one.
+        for representation in range(3):
+            self.assertIn('init-%d.mp4' % representation, names)
+        self.assertTrue(any(re.match(r'^chunk-\d+-\d+\.m4s$', name)
+                            for name in names))
+        manifest, = self.girder.named(convert.DASH_MANIFEST_NAME)
+        self.assertIn(b'<MPD', manifest['data'])
+        for name in outputNames.values():
+            file, = self.girder.named(name)
+            with open(os.path.join(dataDir, name), 'rb') as f:
+                self.assertEqual(file['data'], f.read())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import six
+import time
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class DedupTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.user = self.model('user').createUser(
+            'user', 'password', 'User', 'One', 'user@example.com')
+        self.folder = six.next(self.model('folder').childFolders(
+            parent=self.user, parentType='user', user=self.user))
+
+    def _upload(self, name, data, item=None, reference=None):
+        if item is None:
+            item = self.model('item').createItem(name, self.user, self.folder)
+        file = self.model('upload').uploadFromFile(
+            six.BytesIO(data), len(data), name, parentType='item',
+            parent=item, user=self.user, reference=reference)
+        return item, file
+
+    def _waitForHash(self, file):
+        # Uploads are hashed by the background executor.
+        for _ in range(100):
+            file = self.model('file').load(file['_id'], force=True)
+            if file.get('sha256'):
+                return file
+            time.sleep(0.1)
+        self.fail('File %s was not hashed after upload' % file['_id'])
+
+    def testIsVideoFile(self):
+        from girder.plugins.video.dedup import isVideoFile
+
+        self.assertTrue(isVideoFile({'mimeType': 'video/mp4'}))
+        self.assertTrue(isVideoFile({
+            'mimeType': 'application/octet-stream', 'exts': ['mkv']}))
+        self.assertFalse(isVideoFile({'mimeType': 'image/png',
+                                      'exts': ['png']}))
+        self.assertFalse(isVideoFile({}))
+
+    def testUploadIsHashed(self):
+        data = b'not really a video'
+        _, video = self._upload('video.mp4', data)
+        video = self._waitForHash(video)
+
+        # Other files, and the outputs of processing jobs, are not hashed.
+        item, text = self._upload('notes.txt', data)
+        _, output = self._upload('source_720p.webm', data, item, 'videoPlugin')
+        time.sleep(0.5)
+        for file in (text, output):
+            self.assertNotIn(
+                'sha256', self.model('file').load(file['_id'], force=True))
+
+    def testReuseAfterUpload(self):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.video.dedup import cacheKey
+        from girder.plugins.video.processing import cacheParams, \
+            processingSettings
+
+        data = b'the same bytes, twice'
+        source, sourceFile = self._upload('first.mp4', data)
+        sourceFile = self._waitForHash(sourceFile)
+
+        # Record the first item as processed.
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.createJob(
+            title='Video Processing', type='video', user=self.user,
+            handler='worker_handler', save=False)
+        job['status'] = JobStatus.SUCCESS
+        job = jobModel.save(job)
+        _, poster = self._upload('poster.jpg', b'jpeg', source)
+        self.model('item').update({'_id': source['_id']}, {'$set': {
+            'video.jobId': str(job['_id']),
+            'video.fileId': str(sourceFile['_id']),
+            'video.createdFiles': [str(poster['_id'])],
+            'video.cacheKey': cacheKey(
+                sourceFile, cacheParams(processingSettings()))
+        }})
+
+        # The same bytes uploaded again are hashed on upload, so the first
+        # request to process them reuses the results.
+        item, file = self._upload('second.mp4', data)
+        file = self._waitForHash(file)
+        self.assertEqual(file['sha256'], sourceFile['sha256'])
+
+        resp = self.request(
+            path='/item/%s/video' % item['_id'], method='PUT',
+            user=self.user)
+        self.assertStatusOk(resp)
+        self.assertFalse(resp.json['video']['jobCreated'])
+        self.assertEqual(
+            resp.json['video']['message'],
+            'Processed results reused from item %s.' % source['_id'])
+
+        item = self.model('item').load(item['_id'], force=True)
+        self.assertEqual(item['video']['cachedFrom'], {
+            'itemId': str(source['_id']), 'jobId': str(job['_id'])})
+        self.assertEqual(item['video']['fileId'], str(file['_id']))
+        self.assertEqual(len(item['video']['createdFiles']), 1)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import ast
+import struct
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class BatchFramesTestCase(base.TestCase):
+    def testBatchFrameNumbers(self):
+        from girder.plugins.video.frames import batchFrameNumbers
+
+        # Times snap to the frame that contains them, and duplicates and
+        # frames past the end are dropped.
+        self.assertEqual(batchFrameNumbers(
+            10, 100, times=[0.05, 0.5, 0.52], frames=[5, 3, 200]), [0, 3, 5])
+        self.assertEqual(batchFrameNumbers(
+            10, None, frames=[500]), [500])
+        self.assertEqual(batchFrameNumbers(
+            10, 100, stride=2, start=1), [10, 30, 50, 70, 90])
+        self.assertEqual(batchFrameNumbers(
+            None, None, stride=0.5, start=0, end=1), [0, 15, 30])
+
+        with self.assertRaises(ValueError):
+            batchFrameNumbers(10, 100)
+        with self.assertRaises(ValueError):
+            batchFrameNumbers(10, 100, frames=[-1, 100])
+        with self.assertRaises(ValueError):
+            batchFrameNumbers(10, 100, stride=-1)
+        with self.assertRaises(ValueError):
+            batchFrameNumbers(10, None, stride=1)
+        with self.assertRaises(ValueError):
+            batchFrameNumbers(10, None, frames=list(range(1001)))
+        with self.assertRaises(ValueError):
+            batchFrameNumbers(10, None, stride=0.01, end=100)
+
+    def testPlanRuns(self):
+        from girder.plugins.video.frames import planRuns
+        from girder.plugins.video.keyframes import KeyframeIndex
+
+        frames = [0, 10, 20, 100, 110, 300]
+        # Without an index, gaps longer than BATCH_SEEK_GAP start a run.
+        self.assertEqual(planRuns(frames, 10), [
+            [0, 10, 20], [100, 110], [300]])
+        self.assertEqual(planRuns([], 10), [])
+
+        # With an index, only a gap across a keyframe is worth a seek.
+        index = KeyframeIndex([(0.0, 0, 0), (25.0, 1000, 250)])
+        self.assertEqual(planRuns(frames, 10, index), [
+            [0, 10, 20, 100, 110], [300]])
+        self.assertEqual(planRuns(frames, 10, KeyframeIndex([])), [frames])
+
+    def testNpyHeader(self):
+        from girder.plugins.video.frames import npyHeader
+
+        header = npyHeader((3, 240, 320, 3))
+        self.assertEqual(header[:8], b'\x93NUMPY\x01\x00')
+        length, = struct.unpack('<H', header[8:10])
+        self.assertEqual(len(header), 10 + length)
+        self.assertEqual(len(header) % 64, 0)
+        self.assertTrue(header.endswith(b'\n'))
+        self.assertEqual(ast.literal_eval(header[10:].decode('latin1')), {
+            'descr': '|u1', 'fortran_order': False,
+            'shape': (3, 240, 320, 3)})
+        self.assertEqual(ast.literal_eval(npyHeader((1, ))[10:].decode(
+            'latin1'))['shape'], (1, ))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import mock
+import six
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+def _runNow(func, *args, **kwargs):
+    func(*args, **kwargs)
+
+
+class JobsTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.user = self.model('user').createUser(
+            'user', 'password', 'User', 'One', 'user@example.com')
+        folder = six.next(self.model('folder').childFolders(
+            parent=self.user, parentType='user', user=self.user))
+        self.item = self.model('item').createItem(
+            'video.mp4', self.user, folder)
+
+    def _createJob(self, type='video', meta=None):
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.createJob(
+            title='Job', type=type, user=self.user, save=False)
+        if meta is not None:
+            job['meta'] = meta
+        return jobModel.save(job)
+
+    def _run(self, job, status):
+        from girder.plugins.jobs.constants import JobStatus
+
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.updateJob(job, status=JobStatus.QUEUED)
+        job = jobModel.updateJob(job, status=JobStatus.RUNNING)
+        job = jobModel.updateJob(job, progressCurrent=1, progressTotal=2)
+        return jobModel.updateJob(job, status=status)
+
+    def testUnrelatedJobsSkipped(self):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.video.background import executor
+
+        with mock.patch.object(executor, 'submit') as submit:
+            # Jobs of other plugins, even of the video type, are ignored.
+            self._run(self._createJob(type='other'), JobStatus.SUCCESS)
+            self._run(self._createJob(), JobStatus.ERROR)
+            self.assertEqual(submit.call_count, 0)
+
+            # So are saves and updates of a video job until it ends.
+            job = self._createJob(meta={'video_plugin': {
+                'itemId': str(self.item['_id']), 'fileId': 'file'}})
+            jobModel = self.model('job', 'jobs')
+            job = jobModel.updateJob(job, status=JobStatus.QUEUED)
+            job = jobModel.updateJob(job, status=JobStatus.RUNNING)
+            job = jobModel.updateJob(job, progressCurrent=1, progressTotal=2)
+            jobModel.save(job)
+            self.assertEqual(submit.call_count, 0)
+
+    def testFinalizedOnce(self):
+        from girder.plugins.jobs.constants import JobStatus
+
+        jobModel = self.model('job', 'jobs')
+        itemModel = self.model('item')
+        job = self._createJob(meta={'video_plugin': {
+            'itemId': str(self.item['_id']), 'fileId': 'file'}})
+        itemModel.update({'_id': self.item['_id']}, {'$set': {
+            'video.jobId': str(job['_id']), 'video.cacheKey': 'key'}})
+
+        with mock.patch('girder.plugins.video.base.executor.submit',
+                        side_effect=_runNow), \
+                mock.patch('girder.plugins.video.base.dispatch') as dispatch, \
+                mock.patch('girder.plugins.video.base.removeCheckpoint') \
+                as removeCheckpoint:
+            # The job ends with an update and a save, and may be saved
+            # again later; the item records its end once.
+            job = self._run(job, JobStatus.SUCCESS)
+            jobModel.save(job)
+            self.assertEqual(removeCheckpoint.call_count, 1)
+            self.assertGreater(dispatch.call_count, 0)
+
+        item = itemModel.load(self.item['_id'], force=True)
+        self.assertEqual(item['video']['jobStatus'], JobStatus.SUCCESS)
+        self.assertEqual(item['video']['cacheKey'], 'key')
+
+    def testFailedJobNotReused(self):
+        from girder.plugins.jobs.constants import JobStatus
+
+        itemModel = self.model('item')
+        job = self._createJob(meta={'video_plugin': {
+            'itemId': str(self.item['_id']), 'fileId': 'file'}})
+        itemModel.update({'_id': self.item['_id']}, {'$set': {
+            'video.jobId': str(job['_id']), 'video.cacheKey': 'key'}})
+
+        with mock.patch('girder.plugins.video.base.executor.submit',
+                        side_effect=_runNow), \
+                mock.patch('girder.plugins.video.base.dispatch'):
+            self._run(job, JobStatus.ERROR)
+
+        item = itemModel.load(self.item['_id'], force=True)
+        self.assertEqual(item['video']['jobStatus'], JobStatus.ERROR)
+        self.assertNotIn('cacheKey', item['video'])
+
+        # A job that is not the item's current one leaves the item alone.
+        other = self._createJob(meta={'video_plugin': {
+            'itemId': str(self.item['_id']), 'fileId': 'file'}})
+        with mock.patch('girder.plugins.video.base.executor.submit',
+                        side_effect=_runNow), \
+                mock.patch('girder.plugins.video.base.dispatch'):
+            self._run(other, JobStatus.SUCCESS)
+        item = itemModel.load(self.item['_id'], force=True)
+        self.assertEqual(item['video']['jobId'], str(job['_id']))
+        self.assertEqual(item['video']['jobStatus'], JobStatus.ERROR)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+def _indexBytes(records, magic=None, version=None):
+    from girder.plugins.video import keyframes
+
+    data = keyframes.KEYFRAME_INDEX_HEADER.pack(
+        magic or keyframes.KEYFRAME_INDEX_MAGIC,
+        version or keyframes.KEYFRAME_INDEX_VERSION, len(records))
+    for record in records:
+        data += keyframes.KEYFRAME_INDEX_RECORD.pack(*record)
+    return data
+
+
+class KeyframeIndexTestCase(base.TestCase):
+    def testParse(self):
+        from girder.plugins.video.keyframes import KeyframeIndex
+
+        # Records are sorted by pts whatever their order in the file.
+        index = KeyframeIndex.fromBytes(_indexBytes([
+            (4.0, 9000, 100), (0.0, 48, 0), (2.0, 4000, 50)]))
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.records, [
+            (0.0, 48, 0), (2.0, 4000, 50), (4.0, 9000, 100)])
+        self.assertEqual(len(KeyframeIndex.fromBytes(_indexBytes([]))), 0)
+
+        with self.assertRaises(ValueError):
+            KeyframeIndex.fromBytes(_indexBytes([], magic=b'XXXX'))
+        with self.assertRaises(ValueError):
+            KeyframeIndex.fromBytes(_indexBytes([], version=99))
+
+    def testLookup(self):
+        from girder.plugins.video.keyframes import KeyframeIndex
+
+        index = KeyframeIndex.fromBytes(_indexBytes([
+            (0.5, 48, 12), (2.0, 4000, 50), (4.0, 9000, 100)]))
+        self.assertIsNone(index.find(0.25))
+        self.assertIsNone(index.keyframeBefore(0.25))
+        self.assertEqual(index.find(0.5), 0)
+        self.assertEqual(index.keyframeBefore(1.9), (0.5, 48, 12))
+        self.assertEqual(index.keyframeBefore(2.0), (2.0, 4000, 50))
+        self.assertEqual(index.keyframeBefore(60), (4.0, 9000, 100))
+
+        self.assertEqual(index.byteRange(0.25), (48, 4000))
+        self.assertEqual(index.byteRange(3.0), (4000, 9000))
+        self.assertEqual(index.byteRange(5.0), (9000, None))
+        self.assertEqual(KeyframeIndex([]).byteRange(1.0), (0, None))
+
+    def testLoadKeyframeIndex(self):
+        from girder.plugins.video.keyframes import loadKeyframeIndex
+
+        # Renditions without a recorded index have none.
+        item = {'video': {'renditions': {'240p': 'abc'}}}
+        self.assertIsNone(loadKeyframeIndex(item, 'abc'))
+        self.assertIsNone(loadKeyframeIndex({}, 'abc'))
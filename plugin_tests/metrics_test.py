@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class MetricsTestCase(base.TestCase):
+    def testQuantile(self):
+        from girder.plugins.video.metrics import quantile
+
+        self.assertIsNone(quantile([], 0.5))
+        self.assertEqual(quantile([7], 0.5), 7)
+        self.assertEqual(quantile([7], 0.99), 7)
+
+        # Nearest rank: the smallest value with at least q of the values
+        # at or below it.
+        self.assertEqual(quantile([1, 2], 0.5), 1)
+        self.assertEqual(quantile([1, 2, 3], 0.5), 2)
+        self.assertEqual(quantile([1, 2, 3, 4, 5, 6], 0.5), 3)
+        self.assertEqual(quantile(list(range(1, 101)), 0.9), 90)
+        self.assertEqual(quantile(list(range(1, 101)), 0.99), 99)
+        self.assertEqual(quantile(list(range(1, 101)), 1.0), 100)
+        self.assertEqual(quantile([1, 2, 3], 0), 1)
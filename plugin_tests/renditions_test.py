@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import datetime
+import mock
+import six
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+def _item(sourceHeight, renditions, metaRenditions=None):
+    return {'video': {
+        'meta': {
+            'video': {'height': sourceHeight},
+            'renditions': metaRenditions or []
+        },
+        'renditions': renditions
+    }}
+
+
+class RenditionsTestCase(base.TestCase):
+    def testRemuxedRenditionHeight(self):
+        from girder.plugins.video.renditions import wantedLabel
+        from girder.plugins.video.stream import renditionHeights, \
+            selectRendition
+
+        # An 800 line source remuxed in place of the 1080p rendition.
+        item = _item(800, {'240p': 'a', '480p': 'b', '1080p': 'c'}, [
+            {'name': 'source_240p.webm', 'height': 240},
+            {'name': 'source_480p.webm', 'height': 480},
+            {'name': 'source_1080p.webm', 'height': 800, 'remuxed': True}])
+        ladder = [240, 480, 720, 1080]
+
+        self.assertEqual(renditionHeights(item), {
+            '240p': 240, '480p': 480, '1080p': 800})
+        self.assertEqual(selectRendition(item, 1080), 'c')
+        self.assertEqual(selectRendition(item, 800), 'c')
+        self.assertEqual(selectRendition(item, 700), 'c')
+        self.assertEqual(selectRendition(item, 480), 'b')
+        self.assertEqual(selectRendition(item), 'c')
+
+        # The remuxed source serves requests above 720 lines; a 720p
+        # rendition is still worth making for smaller ones.
+        self.assertEqual(wantedLabel(item, 1080, ladder), '1080p')
+        self.assertEqual(wantedLabel(item, 800, ladder), '1080p')
+        self.assertEqual(wantedLabel(item, 720, ladder), '720p')
+        self.assertEqual(wantedLabel(item, 600, ladder), '720p')
+        self.assertEqual(wantedLabel(item, 300, ladder), '480p')
+
+    def testRenditionLabels(self):
+        from girder.plugins.video.renditions import wantedLabel
+        from girder.plugins.video.stream import selectRendition
+
+        ladder = [240, 480, 720, 1080]
+        # Without metadata, a rendition is as tall as its label.
+        item = {'video': {'renditions': {'240p': 'a', '720p': 'b'}}}
+        self.assertEqual(selectRendition(item, 480), 'b')
+        self.assertEqual(selectRendition(item, 240), 'a')
+        self.assertIsNone(wantedLabel(item, 480, ladder))
+        self.assertIsNone(selectRendition({'video': {}}))
+
+        item = _item(720, {'240p': 'a'})
+        self.assertEqual(wantedLabel(item, 480, ladder), '480p')
+        self.assertEqual(wantedLabel(item, 1080, ladder), '720p')
+        self.assertEqual(wantedLabel(item, 100, ladder), '240p')
+
+        # A source shorter than the ladder only has its smallest rendition,
+        # at the source height.
+        item = _item(144, {'240p': 'a'}, [
+            {'name': 'source_240p.webm', 'height': 144}])
+        self.assertEqual(wantedLabel(item, 480, ladder), '240p')
+        self.assertEqual(selectRendition(item, 480), 'a')
+
+
+class RenditionJobsTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.owner, self.processor = [self.model('user').createUser(
+            'user%d' % i, 'password', 'User', str(i),
+            'user%d@example.com' % i) for i in range(2)]
+        self.folder = six.next(self.model('folder').childFolders(
+            parent=self.owner, parentType='user', user=self.owner))
+
+        # The job that processed the item, with another user and profile.
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.createJob(
+            title='Video Processing', type='video', user=self.processor,
+            save=False)
+        job['meta'] = {'video_plugin': {'profile': 'h264-fast'}}
+        self.job = jobModel.save(job)
+
+    def _createItem(self, name):
+        item = self.model('item').createItem(name, self.owner, self.folder)
+        source = self._upload(item, name, b'source')
+        return item, source
+
+    def _upload(self, item, name, data):
+        return self.model('upload').uploadFromFile(
+            six.BytesIO(data), len(data), name, parentType='item',
+            parent=item, user=self.owner)
+
+    def _processedItem(self, **video):
+        item, source = self._createItem('video.mp4')
+        base240 = self._upload(item, 'source_240p.webm', b'240p')
+        fields = {
+            'video.meta': {'video': {'height': 720}},
+            'video.fileId': str(source['_id']),
+            'video.jobId': str(self.job['_id']),
+            'video.renditions': {'240p': str(base240['_id'])},
+            'video.createdFiles': [str(base240['_id'])]
+        }
+        fields.update({'video.' + key: value for key, value in video.items()})
+        self.model('item').update({'_id': item['_id']}, {'$set': fields})
+        return self.model('item').load(item['_id'], force=True), source
+
+    def _renditionJobs(self):
+        return list(self.model('job', 'jobs').find(
+            {'meta.video_plugin.lazyRendition': {'$exists': True}}))
+
+    def testRequestRendition(self):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.video.renditions import RENDITION_FAILED, \
+            finalizeRendition, requestRendition
+
+        item, source = self._processedItem()
+        with mock.patch('girder.plugins.video.renditions.dispatch') as \
+                dispatch:
+            jobId = requestRendition(item, '480p')
+            self.assertEqual(dispatch.call_count, 1)
+            # Concurrent requests share the job of the first one.
+            self.assertEqual(requestRendition(item, '480p'), jobId)
+            # An existing rendition is not made again.
+            self.assertIsNone(requestRendition(item, '240p'))
+
+        job, = self._renditionJobs()
+        self.assertEqual(str(job['_id']), jobId)
+        self.assertEqual(job['userId'], self.processor['_id'])
+        jobVideoData = job['meta']['video_plugin']
+        self.assertEqual(jobVideoData['lazyRendition'], '480p')
+        self.assertTrue(jobVideoData['renditionsOnly'])
+        self.assertEqual(jobVideoData['fileId'], str(source['_id']))
+        self.assertEqual(jobVideoData['profile'], 'h264-fast')
+        self.assertEqual(jobVideoData['settings']['renditions'], [480])
+        item = self.model('item').load(item['_id'], force=True)
+        self.assertEqual(item['video']['pendingRenditions'], {'480p': jobId})
+
+        # A failed rendition is not requested again until reprocessing.
+        finalizeRendition(jobId, item['_id'], '480p', JobStatus.ERROR)
+        item = self.model('item').load(item['_id'], force=True)
+        self.assertEqual(item['video']['pendingRenditions']['480p'],
+                         RENDITION_FAILED)
+        with mock.patch('girder.plugins.video.renditions.dispatch'):
+            self.assertIsNone(requestRendition(item, '480p'))
+            jobId = requestRendition(item, '720p')
+        self.assertEqual(len(self._renditionJobs()), 2)
+
+        # The claim of a rendition that was made is released.
+        finalizeRendition(jobId, item['_id'], '720p', JobStatus.SUCCESS)
+        item = self.model('item').load(item['_id'], force=True)
+        self.assertNotIn('720p', item['video']['pendingRenditions'])
+
+    def testClaimReleasedOnFailure(self):
+        from girder.plugins.video.renditions import requestRendition
+
+        item, _ = self._processedItem()
+        with mock.patch('girder.plugins.video.renditions._buildRenditionJob',
+                        side_effect=ValueError('no source')), \
+                mock.patch('girder.plugins.video.renditions.dispatch'):
+            with self.assertRaises(ValueError):
+                requestRendition(item, '480p')
+        item = self.model('item').load(item['_id'], force=True)
+        self.assertNotIn('480p', item['video'].get('pendingRenditions', {}))
+        self.assertEqual(self._renditionJobs(), [])
+
+        # The next request tries again.
+        with mock.patch('girder.plugins.video.renditions.dispatch'):
+            jobId = requestRendition(item, '480p')
+        self.assertIsNotNone(jobId)
+        item = self.model('item').load(item['_id'], force=True)
+        self.assertEqual(item['video']['pendingRenditions'], {'480p': jobId})
+
+    def testReusedResultsRendition(self):
+        from girder.plugins.video.renditions import requestRendition
+
+        # An item that reused the results of another has no job, and may
+        # not have recorded its source file.
+        other, _ = self._processedItem()
+        item, source = self._processedItem(cachedFrom={
+            'itemId': str(other['_id']), 'jobId': str(self.job['_id'])})
+        self.model('item').update({'_id': item['_id']}, {'$unset': {
+            'video.jobId': '', 'video.fileId': ''}})
+        item = self.model('item').load(item['_id'], force=True)
+
+        with mock.patch('girder.plugins.video.renditions.dispatch'):
+            jobId = requestRendition(item, '480p')
+        job = self.model('job', 'jobs').load(jobId, force=True)
+        # The item's creator owns the job, which uses the profile of the job
+        # whose results were reused, and the item's own source file.
+        self.assertEqual(job['userId'], self.owner['_id'])
+        self.assertEqual(job['meta']['video_plugin']['profile'], 'h264-fast')
+        self.assertEqual(job['meta']['video_plugin']['fileId'],
+                         str(source['_id']))
+
+    def testEvictable(self):
+        from girder.plugins.video.renditions import _evictable
+
+        itemVideoData = {
+            'fileId': 'source',
+            'renditions': {'240p': 'a', '480p': 'b', '720p': 'source',
+                           '1080p': 'c'},
+            'keyframeIndex': {'480p': 'kb'},
+            'createdFiles': ['a', 'b', 'kb']
+        }
+        # The base proxy, the processed source and uploaded files are kept.
+        self.assertEqual(_evictable(itemVideoData), [('480p', 'b', 'kb')])
+
+    def testEvictionOrder(self):
+        from girder.plugins.video.renditions import evictRenditions
+
+        def day(n):
+            return datetime.datetime(2020, 1, n)
+
+        itemA, _ = self._processedItem()
+        a480 = self._upload(itemA, 'source_480p.webm', b'0123456789')
+        a720 = self._upload(itemA, 'source_720p.webm', b'0123456789')
+        k720 = self._upload(itemA, 'source_720p.keyframes', b'01234')
+        itemB, _ = self._processedItem()
+        b480 = self._upload(itemB, 'source_480p.webm', b'0123456789')
+        for item, files in (
+                (itemA, [('480p', a480, day(2)), ('720p', a720, day(3))]),
+                (itemB, [('480p', b480, day(1))])):
+            fields = {}
+            for label, file, accessed in files:
+                fields['video.renditions.' + label] = str(file['_id'])
+                fields['video.lastAccess.%s' % file['_id']] = accessed
+            created = [str(file['_id']) for _, file, _ in files]
+            if item is itemA:
+                fields['video.keyframeIndex.720p'] = str(k720['_id'])
+                created.append(str(k720['_id']))
+            self.model('item').update({'_id': item['_id']}, {
+                '$set': fields,
+                '$push': {'video.createdFiles': {'$each': created}}})
+
+        # The created files take 4 + 10 + 10 + 5 bytes in item A and 4 + 10
+        # in item B; the least recently used renditions go first, until the
+        # usage fits the quota.
+        self.assertEqual(evictRenditions(30), 2)
+        fileModel = self.model('file')
+        self.assertIsNone(fileModel.load(b480['_id'], force=True))
+        self.assertIsNone(fileModel.load(a480['_id'], force=True))
+        self.assertIsNotNone(fileModel.load(a720['_id'], force=True))
+        itemA = self.model('item').load(itemA['_id'], force=True)
+        self.assertEqual(sorted(itemA['video']['renditions']),
+                         ['240p', '720p'])
+        self.assertNotIn(str(a480['_id']), itemA['video']['createdFiles'])
+        self.assertNotIn(str(a480['_id']), itemA['video']['lastAccess'])
+        itemB = self.model('item').load(itemB['_id'], force=True)
+        self.assertEqual(list(itemB['video']['renditions']), ['240p'])
+
+        # The base proxies are always kept, and a rendition goes with its
+        # keyframe index.
+        self.assertEqual(evictRenditions(0), 1)
+        self.assertIsNone(fileModel.load(k720['_id'], force=True))
+        itemA = self.model('item').load(itemA['_id'], force=True)
+        self.assertEqual(list(itemA['video']['renditions']), ['240p'])
+        self.assertNotIn('720p', itemA['video'].get('keyframeIndex', {}))
+        self.assertEqual(evictRenditions(0), 0)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import mock
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class SchedulerTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.users = [self.model('user').createUser(
+            'user%d' % i, 'password', 'User', str(i),
+            'user%d@example.com' % i) for i in range(2)]
+
+    def _createJob(self, user, priority=0, status=None):
+        from girder.plugins.video.scheduler import queueJob
+
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.createJob(
+            title='Video Processing', type='video', user=user,
+            handler='worker_handler', save=False)
+        job['meta'] = {'video_plugin': {}}
+        if status is None:
+            queueJob(job, priority)
+        else:
+            job['status'] = status
+        return jobModel.save(job)
+
+    def testSaturatedUsers(self):
+        from girder.plugins.video.scheduler import saturatedUsers
+
+        active = {'a': 2, 'b': 1, 'c': 3}
+        self.assertEqual(saturatedUsers(active, 0), [])
+        self.assertEqual(sorted(saturatedUsers(active, 2)), ['a', 'c'])
+        self.assertEqual(saturatedUsers(active, 4), [])
+        self.assertEqual(saturatedUsers({}, 1), [])
+
+    def testDispatchLimits(self):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.video.constants import PluginSettings
+        from girder.plugins.video.scheduler import BATCH_PRIORITY, dispatch
+
+        settingModel = self.model('setting')
+        settingModel.set(PluginSettings.VIDEO_MAX_JOBS, 3)
+        settingModel.set(PluginSettings.VIDEO_MAX_JOBS_PER_USER, 1)
+
+        # The first user is at their limit and has a long queue of batch
+        # jobs ahead of the second user's job.
+        self._createJob(self.users[0], status=JobStatus.RUNNING)
+        for _ in range(5):
+            self._createJob(self.users[0], BATCH_PRIORITY)
+        waiting = self._createJob(self.users[1], BATCH_PRIORITY)
+
+        jobModel = self.model('job', 'jobs')
+        with mock.patch.object(jobModel, 'scheduleJob') as scheduleJob, \
+                mock.patch('girder.plugins.video.scheduler.prepareVideoJob'):
+            self.assertEqual(dispatch(), 1)
+            self.assertEqual(scheduleJob.call_count, 1)
+            self.assertEqual(
+                scheduleJob.call_args[0][0]['_id'], waiting['_id'])
+
+            # Nothing can start until the running jobs end.
+            self.assertEqual(dispatch(), 0)
+
+        pending = jobModel.find({'meta.video_plugin.pending': True})
+        self.assertEqual(pending.count(), 5)
+        self.assertNotIn(
+            'pending', jobModel.load(waiting['_id'], force=True)['meta'][
+                'video_plugin'])
+
+    def testDispatchCreatesTokens(self):
+        import six
+
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.video.processing import buildVideoJob, \
+            processingSettings
+        from girder.plugins.video.scheduler import dispatch, queueJob
+
+        user = self.users[0]
+        folder = six.next(self.model('folder').childFolders(
+            parent=user, parentType='user', user=user))
+        item = self.model('item').createItem('video.mp4', user, folder)
+        data = b'not really a video'
+        file = self.model('upload').uploadFromFile(
+            six.BytesIO(data), len(data), 'video.mp4', parentType='item',
+            parent=item, user=user)
+
+        # A queued job has no tokens that could expire while it waits.
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.save(queueJob(buildVideoJob(
+            item, file, user, processingSettings(), save=False)))
+        self.assertNotIn('task', job['kwargs'])
+
+        with mock.patch.object(jobModel, 'scheduleJob') as scheduleJob:
+            self.assertEqual(dispatch(), 1)
+        kwargs = scheduleJob.call_args[0][0]['kwargs']
+        token = self.model('token').load(
+            kwargs['outputs']['meta']['token'], force=True, objectId=False)
+        self.assertEqual(token['userId'], user['_id'])
+        self.assertEqual(kwargs['inputs']['input']['id'], str(file['_id']))
+        self.assertEqual(jobModel.load(job['_id'], force=True)['kwargs'],
+                         kwargs)
+
+        # A job whose file was removed while it waited fails.
+        job = jobModel.save(queueJob(buildVideoJob(
+            item, file, user, processingSettings(), save=False)))
+        self.model('file').remove(file)
+        with mock.patch.object(jobModel, 'scheduleJob') as scheduleJob:
+            self.assertEqual(dispatch(), 0)
+        self.assertEqual(scheduleJob.call_count, 0)
+        self.assertEqual(jobModel.load(job['_id'], force=True)['status'],
+                         JobStatus.ERROR)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import six
+
+from bson.objectid import ObjectId
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('video')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+RENDITION_DATA = b'0123456789abcdefghij'
+
+
+class VideoTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.user = self.model('user').createUser(
+            'user', 'password', 'User', 'One', 'user@example.com')
+        folder = six.next(self.model('folder').childFolders(
+            parent=self.user, parentType='user', user=self.user))
+        self.item = self.model('item').createItem(
+            'video.mp4', self.user, folder)
+        self.rendition = self._upload('source_240p.webm', RENDITION_DATA)
+        self.jobId = str(ObjectId())
+        self.meta = {'duration': 10.0, 'video': {'height': 240}}
+        self.model('item').update({'_id': self.item['_id']}, {'$set': {
+            'video.jobId': self.jobId,
+            'video.meta': self.meta,
+            'video.renditions': {'240p': str(self.rendition['_id'])}
+        }})
+
+    def _upload(self, name, data):
+        return self.model('upload').uploadFromFile(
+            six.BytesIO(data), len(data), name, parentType='item',
+            parent=self.item, user=self.user)
+
+    def _get(self, path, headers=(), isJson=True):
+        return self.request(
+            path='/item/%s/video%s' % (self.item['_id'], path),
+            user=self.user, additionalHeaders=list(headers), isJson=isJson)
+
+    def testMetadataETag(self):
+        resp = self._get('')
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, self.meta)
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, '"%s"' % self.jobId)
+
+        for ifNoneMatch in (etag, '"other", %s' % etag, '*'):
+            resp = self._get('', [('If-None-Match', ifNoneMatch)], False)
+            self.assertStatus(resp, 304)
+            self.assertEqual(self.getBody(resp), '')
+
+        resp = self._get('', [('If-None-Match', '"other"')])
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, self.meta)
+
+        # Reprocessing gives the metadata a new tag, so the old one no
+        # longer matches.
+        newJobId = str(ObjectId())
+        newMeta = {'duration': 12.0, 'video': {'height': 240}}
+        self.model('item').update({'_id': self.item['_id']}, {'$set': {
+            'video.jobId': newJobId, 'video.meta': newMeta}})
+        resp = self._get('', [('If-None-Match', etag)])
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, newMeta)
+        self.assertEqual(resp.headers['ETag'], '"%s"' % newJobId)
+
+        # Reused results are tagged with the job that made them.
+        self.model('item').update({'_id': self.item['_id']}, {
+            '$set': {'video.cachedFrom': {'itemId': 'other', 'jobId': 'job'}},
+            '$unset': {'video.jobId': ''}})
+        resp = self._get('')
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['ETag'], '"job"')
+
+    def testStreamETag(self):
+        resp = self._get('/stream', isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp, text=False), RENDITION_DATA)
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, '"%s"' % self.rendition['_id'])
+
+        resp = self._get('/stream', [('If-None-Match', etag)], False)
+        self.assertStatus(resp, 304)
+        resp = self._get('/stream', [('If-None-Match', '"other"')], False)
+        self.assertStatusOk(resp)
+
+        # A new rendition of the item is a new file, with a new tag.
+        rendition = self._upload('source_240p.webm', b'reprocessed')
+        self.model('item').update({'_id': self.item['_id']}, {'$set': {
+            'video.renditions.240p': str(rendition['_id'])}})
+        resp = self._get('/stream', [('If-None-Match', etag)], False)
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp, text=False), b'reprocessed')
+        self.assertEqual(resp.headers['ETag'], '"%s"' % rendition['_id'])
+
+    def testStreamRange(self):
+        size = len(RENDITION_DATA)
+        for rangeHeader, start, end in (
+                ('bytes=2-5', 2, 5),
+                ('bytes=-4', size - 4, size - 1),
+                ('bytes=15-', 15, size - 1),
+                ('bytes=10-100', 10, size - 1)):
+            resp = self._get('/stream', [('Range', rangeHeader)], False)
+            self.assertStatus(resp, 206)
+            self.assertEqual(self.getBody(resp, text=False),
+                             RENDITION_DATA[start:end + 1])
+            self.assertEqual(resp.headers['Content-Range'],
+                             'bytes %d-%d/%d' % (start, end, size))
+
+        resp = self._get('/stream', [('Range', 'bytes=%d-' % size)], False)
+        self.assertStatus(resp, 416)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */%d' % size)
+
+        # A range of another version of the rendition gets the whole file.
+        resp = self._get('/stream', [
+            ('Range', 'bytes=2-5'), ('If-Range', '"other"')], False)
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp, text=False), RENDITION_DATA)
+        resp = self._get('/stream', [
+            ('Range', 'bytes=2-5'),
+            ('If-Range', '"%s"' % self.rendition['_id'])], False)
+        self.assertStatus(resp, 206)
+        self.assertEqual(self.getBody(resp, text=False), b'2345')
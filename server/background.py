@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import threading
+
+from six.moves import queue
+
+from girder import logger
+
+
+class BoundedExecutor(object):
+    """
+    A small pool of daemon threads that runs tasks off the request thread.
+    The queue of pending tasks is bounded; when it is full, a task is run by
+    the caller instead, which slows the producer down rather than letting
+    the backlog grow without limit.
+    """
+
+    def __init__(self, workers=2, maxPending=256):
+        self.workers = workers
+        self._queue = queue.Queue(maxPending)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            self._run(func, args, kwargs)
+            self._queue.task_done()
+
+    @staticmethod
+    def _run(func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception('Video plugin background task failed')
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in the background.  Exceptions are logged.
+        """
+        if len(self._threads) < self.workers:
+            self._start()
+        try:
+            self._queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            self._run(func, args, kwargs)
+
+
+executor = BoundedExecutor()
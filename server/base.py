@@ -17,7 +17,12 @@
 #  limitations under the License.
 #############################################################################
 
+import calendar
 import json
+import re
+import six
+
+from bson.objectid import ObjectId
 
 from girder import events, plugin, logger
 from girder.constants import AccessType, SettingDefault
@@ -25,42 +30,104 @@ from girder.models.model_base import ModelImporter, ValidationException
 from girder.utility import setting_utilities
 
 from . import constants
+from .background import executor
+from .renditions import finalizeRendition, startEvictor
+from .scheduler import dispatch
 
 JobStatus = constants.JobStatus
 
+# Outputs of a processing job whose contents are copied into the database
+# when the job succeeds.
+INGESTED_OUTPUTS = (constants.META_NAME, constants.METRICS_NAME)
+
 
 def _postUpload(event):
     """
     Called when a file is uploaded. If the file was created by the video
     plugin's initial processing job, we register this file as such.
+
+    Several outputs of a job usually arrive at once, so the item is updated
+    with a single atomic operation rather than loaded, modified and saved.
     """
     reference = event.info.get('reference')
     if reference != 'videoPlugin':
         return
 
     file = event.info['file']
-    itemModel = ModelImporter.model('item')
-
-    item = itemModel.load(file['itemId'], force=True, exc=True)
-    itemVideoData = item.get('video', {})
-    createdFiles = set(itemVideoData.get('createdFiles', []))
 
-    createdFiles.add(str(file['_id']))
-
-    itemVideoData['createdFiles'] = list(createdFiles)
-    item['video'] = itemVideoData
+    # Outputs that were not needed (renditions taller than the source, their
+    # keyframe indices, unused storyboard sheets) are uploaded as empty
+    # files; discard those.
+    if not file.get('size') and any(
+            re.match(pattern, file['name'])
+            for pattern in constants.OPTIONAL_OUTPUT_PATTERNS):
+        ModelImporter.model('file').remove(file)
+        return
 
-    itemModel.save(item)
+    update = {'$addToSet': {'video.createdFiles': str(file['_id'])}}
+    field = createdFileField(file['name'])
+    if field is not None:
+        update['$set'] = {'video.' + field: str(file['_id'])}
+    ModelImporter.model('item').update(
+        {'_id': file['itemId']}, update, multi=False)
+
+    # The job can be reported as successful before its last outputs are
+    # uploaded; if that happened, the metadata is ingested now.
+    if file['name'] in INGESTED_OUTPUTS:
+        item = ModelImporter.model('item').findOne(
+            {'_id': file['itemId']},
+            fields=['video.jobId', 'video.jobStatus'])
+        itemVideoData = (item or {}).get('video', {})
+        if itemVideoData.get('jobStatus') == JobStatus.SUCCESS:
+            executor.submit(ingestOutput, item['_id'],
+                            itemVideoData['jobId'], file)
+
+
+def createdFileField(name):
+    """
+    Return the dotted path within an item's video data under which a file
+    produced by a processing job is registered, based on its name: a
+    rendition, keyframe index, manifest, storyboard, activity index,
+    waveform, or checkpoint.  Other outputs are only listed in the created
+    files, and None is returned for them.
+    """
+    renditionMatch = re.match(constants.RENDITION_NAME_PATTERN, name)
+    if renditionMatch:
+        return 'renditions.%sp' % renditionMatch.group(1)
+    indexMatch = re.match(constants.KEYFRAME_INDEX_NAME_PATTERN, name)
+    if indexMatch:
+        return 'keyframeIndex.%sp' % indexMatch.group(1)
+    if name == constants.DASH_MANIFEST_NAME:
+        return 'manifest'
+    if name == constants.STORYBOARD_INDEX_NAME:
+        return 'storyboard'
+    if name == constants.ACTIVITY_INDEX_NAME:
+        return 'activity'
+    if name == constants.WAVEFORM_NAME:
+        return 'waveform'
+    if name == constants.CHECKPOINT_NAME:
+        return 'checkpoint'
+    return None
+
+
+_terminalStatuses = None
 
 
 def updateJob(event):
     """
     Called when a job is saved, updated, or removed.  If this is a video
     job and it is ended, clean up after it.
+
+    This runs on every save of every job, including progress updates, so
+    anything that is not the end of a video job returns after a few
+    dictionary lookups, and the clean up itself is done in the background.
     """
-    global JobStatus
+    global JobStatus, _terminalStatuses
     if not JobStatus:
         from girder.plugins.jobs.constants import JobStatus
+    if _terminalStatuses is None:
+        _terminalStatuses = frozenset((
+            JobStatus.ERROR, JobStatus.CANCELED, JobStatus.SUCCESS))
 
     job = (
         event.info['job']
@@ -72,58 +139,164 @@ def updateJob(event):
     if jobVideoData is None:
         return
 
-    videoItemId = jobVideoData.get('itemId')
-    videoFileId = jobVideoData.get('fileId')
-    if videoItemId is None or videoFileId is None:
+    status = job.get('status')
+    if event.name == 'model.job.remove' and status not in _terminalStatuses:
+        status = JobStatus.CANCELED
+    if status not in _terminalStatuses:
         return
 
-    status = job['status']
-    if event.name == 'model.job.remove' and status not in (
-            JobStatus.ERROR, JobStatus.CANCELED, JobStatus.SUCCESS):
-        status = JobStatus.CANCELED
-    if status not in (JobStatus.ERROR, JobStatus.CANCELED, JobStatus.SUCCESS):
+    # The job no longer counts against the concurrency limits, so another
+    # one may start.
+    if job.get('type') == 'video':
+        executor.submit(dispatch)
+
+    videoItemId = jobVideoData.get('itemId')
+    if videoItemId is None or jobVideoData.get('fileId') is None:
         return
 
-    item = ModelImporter.model('item').load(videoItemId, force=True)
-    if not item:
+    if jobVideoData.get('lazyRendition'):
+        executor.submit(finalizeRendition, job['_id'], videoItemId,
+                        jobVideoData['lazyRendition'], status)
         return
 
-    itemVideoData = item.get('video')
-    if itemVideoData is None:
+    executor.submit(finalizeJob, job['_id'], videoItemId, status)
+
+
+def finalizeJob(jobId, itemId, status):
+    """
+    Record the final status of a processing job on its item.  The job is
+    both updated and saved when it ends, so the item is claimed with an
+    atomic update to make sure this happens once per job and status, and
+    only if the item still belongs to this job.
+
+    :returns: the item as it was before the update, or None if there was
+        nothing to do.
+    """
+    item = ModelImporter.model('item').collection.find_one_and_update({
+        '_id': ObjectId(itemId),
+        'video.jobId': str(jobId),
+        'video.jobStatus': {'$ne': status}
+    }, {'$set': {'video.jobStatus': status}})
+    if item is None:
+        return None
+
+    logger.info('Video processing job %s for item %s ended with status %s' %
+                (jobId, itemId, status))
+
+    if status == JobStatus.SUCCESS:
+        for outputFile in ModelImporter.model('file').find({
+            'itemId': item['_id'],
+            'name': {'$in': list(INGESTED_OUTPUTS)},
+            '_id': {'$in': [ObjectId(f) for f in item['video'].get(
+                'createdFiles', [])]}
+        }):
+            ingestOutput(item['_id'], jobId, outputFile)
+        removeCheckpoint(item['_id'])
+    else:
+        # Failed results must not be offered for reuse.
+        ModelImporter.model('item').update(
+            {'_id': item['_id'], 'video.jobId': str(jobId)},
+            {'$unset': {'video.cacheKey': ''}}, multi=False)
+    return item
+
+
+def removeCheckpoint(itemId):
+    """
+    Remove the checkpoint of an item's processing job and the chunks it
+    lists, which are only needed to resume the job.
+    """
+    fileModel = ModelImporter.model('file')
+    removed = []
+    for file in fileModel.find({
+        'itemId': itemId,
+        'name': {'$regex': constants.CHECKPOINT_NAME_PATTERN}
+    }):
+        fileModel.remove(file)
+        removed.append(str(file['_id']))
+    if removed:
+        ModelImporter.model('item').update({'_id': itemId}, {
+            '$pull': {'video.createdFiles': {'$in': removed}},
+            '$unset': {'video.checkpoint': ''}
+        }, multi=False)
+
+
+def _readJSON(file):
+    data = b''.join(
+        ModelImporter.model('file').download(file, headers=False)())
+    return json.loads(data.decode('utf8'))
+
+
+def _epoch(value):
+    """Convert a naive UTC datetime, as stored by Girder, to seconds."""
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def ingestOutput(itemId, jobId, file):
+    """
+    Copy an output of a processing job whose contents are kept in the
+    database: the metadata into its item, so that it can be served with the
+    item rather than read from a file per request, and the metrics into the
+    job.
+
+    :param itemId: the id of the item.
+    :param jobId: the id of the job; nothing is done if the item has been
+        given to another job since.
+    :param file: the meta.json or metrics.json file document.
+    """
+    try:
+        data = _readJSON(file)
+    except ValueError:
+        logger.warning('Video processing job %s wrote an invalid %s' % (
+            jobId, file['name']))
         return
 
-    if itemVideoData['jobId'] != str(job['_id']):
+    if file['name'] == constants.META_NAME:
+        ModelImporter.model('item').update(
+            {'_id': itemId, 'video.jobId': str(jobId)},
+            {'$set': {'video.meta': data}}, multi=False)
+    elif file['name'] == constants.METRICS_NAME:
+        ingestMetrics(jobId, data)
+
+
+def ingestMetrics(jobId, metrics):
+    """
+    Store the per-stage metrics of a processing job in the job, completed
+    with the stages only the server sees: the wait in the queue, the time
+    from the start of the job to the start of the conversion (fetching the
+    input and starting the container), and the time from the end of the
+    conversion to the end of the job (uploading the outputs).  The job is
+    updated directly, so that this does not trigger another job event.
+    """
+    jobModel = ModelImporter.model('job', 'jobs')
+    job = jobModel.load(jobId, force=True)
+    if job is None:
         return
 
-    # TODO(opadron): remove this after this section is finished
-    print(
-        'Found video item %s from job %s' %
-        (videoItemId, str(job['_id'])))
-
-    # if item.get('largeImage', {}).get('expected'):
-    #     # We can get a SUCCESS message before we get the upload message, so
-    #     # don't clear the expected status on success.
-    #     if status != JobStatus.SUCCESS:
-    #         del item['largeImage']['expected']
-
-    # notify = item.get('largeImage', {}).get('notify')
-    # msg = None
-    # if notify:
-    #     del item['largeImage']['notify']
-    #     if status == JobStatus.SUCCESS:
-    #         msg = 'Large image created'
-    #     elif status == JobStatus.CANCELED:
-    #         msg = 'Large image creation canceled'
-    #     else:  # ERROR
-    #         msg = 'FAILED: Large image creation failed'
-    #     msg += ' for item %s' % item['name']
-    # if (status in (JobStatus.ERROR, JobStatus.CANCELED) and
-    #         'largeImage' in item):
-    #     del item['largeImage']
-
-    # ModelImporter.model('item').save(item)
-    # if msg and event.name != 'model.job.remove':
-    #     ModelImporter.model('job', 'jobs').updateJob(job, progressMessage=msg)
+    times = {}
+    for timestamp in job.get('timestamps', []):
+        times.setdefault(timestamp['status'], _epoch(timestamp['time']))
+    created = _epoch(job['created'])
+    running = times.get(JobStatus.RUNNING)
+    ended = times.get(JobStatus.SUCCESS, _epoch(job['updated']))
+
+    stages = metrics.setdefault('stages', {})
+    if running is not None:
+        metrics['queueWait'] = round(max(0.0, running - created), 3)
+        if metrics.get('started'):
+            stages['fetch'] = {
+                'start': running,
+                'end': metrics['started'],
+                'wall': round(max(0.0, metrics['started'] - running), 3)
+            }
+    if metrics.get('finished'):
+        stages['upload'] = {
+            'start': metrics['finished'],
+            'end': ended,
+            'wall': round(max(0.0, ended - metrics['finished']), 3)
+        }
+
+    jobModel.update({'_id': job['_id']}, {
+        '$set': {'meta.video_plugin.metrics': metrics}}, multi=False)
 
 
 def checkForLargeImageFiles(event):
@@ -166,6 +339,11 @@ def removeThumbnails(event):
     constants.PluginSettings.VIDEO_SHOW_THUMBNAILS,
     constants.PluginSettings.VIDEO_SHOW_VIEWER,
     constants.PluginSettings.VIDEO_AUTO_SET,
+    constants.PluginSettings.VIDEO_STREAM_INPUT,
+    constants.PluginSettings.VIDEO_ACTIVITY_INDEX,
+    constants.PluginSettings.VIDEO_AUDIO_WAVEFORM,
+    constants.PluginSettings.VIDEO_CHECKPOINT,
+    constants.PluginSettings.VIDEO_LAZY_RENDITIONS,
 })
 def validateBoolean(doc):
     val = doc['value']
@@ -194,9 +372,54 @@ def validateDictOrJSON(doc):
         raise ValidationException('%s must be a JSON object.' % doc['key'], 'value')
 
 
+@setting_utilities.validator({
+    constants.PluginSettings.VIDEO_ENCODING_PROFILES,
+})
+def validateEncodingProfiles(doc):
+    validateDictOrJSON(doc)
+    profiles = json.loads(doc['value'] or '{}')
+    for name, profile in six.viewitems(profiles):
+        if not isinstance(profile, dict):
+            raise ValidationException(
+                'Encoding profile %s must be a JSON object.' % name, 'value')
+        if profile.get('container') not in constants.ENCODING_CONTAINERS:
+            raise ValidationException(
+                'Encoding profile %s must have a container of %s.' % (
+                    name, ', '.join(constants.ENCODING_CONTAINERS)), 'value')
+        for key in ('crf', 'speed', 'bitRateScale'):
+            if key in profile and not isinstance(
+                    profile[key], six.integer_types + (float, )):
+                raise ValidationException(
+                    'Encoding profile %s must have a numeric %s.' % (
+                        name, key), 'value')
+        if not _validPassthrough(profile.get('passthrough', True)):
+            raise ValidationException(
+                'Encoding profile %s must have a passthrough of true, false, '
+                'or an object of codec lists and numeric bounds.' % name,
+                'value')
+
+
+def _validPassthrough(value):
+    if isinstance(value, bool):
+        return True
+    if not isinstance(value, dict):
+        return False
+    numeric = six.integer_types + (float, )
+    return (
+        all(isinstance(value.get(key, []), list)
+            for key in ('videoCodecs', 'audioCodecs')) and
+        all(isinstance(value.get(key, 0), numeric)
+            for key in ('maxHeight', 'maxBitRateScale')) and
+        isinstance(value.get('encodeLadder', True), bool))
+
+
 @setting_utilities.validator({
     constants.PluginSettings.VIDEO_MAX_THUMBNAIL_FILES,
     constants.PluginSettings.VIDEO_MAX_SMALL_IMAGE_SIZE,
+    constants.PluginSettings.VIDEO_FRAME_CACHE_SIZE,
+    constants.PluginSettings.VIDEO_MAX_JOBS,
+    constants.PluginSettings.VIDEO_MAX_JOBS_PER_USER,
+    constants.PluginSettings.VIDEO_RENDITION_QUOTA,
 })
 def validateNonnegativeInteger(doc):
     val = doc['value']
@@ -211,12 +434,42 @@ def validateNonnegativeInteger(doc):
 
 
 @setting_utilities.validator({
-    constants.PluginSettings.VIDEO_DEFAULT_VIEWER
+    constants.PluginSettings.VIDEO_RENDITIONS
+})
+def validateRenditions(doc):
+    val = doc['value']
+    try:
+        if isinstance(val, six.string_types):
+            val = val.strip()
+            val = json.loads(val) if val.startswith('[') else val.split(',')
+        heights = sorted({int(str(h).strip().rstrip('p')) for h in val})
+        if not heights or heights[0] <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValidationException('%s must be a non-empty list of positive '
+                                  'rendition heights.' % doc['key'], 'value')
+    doc['value'] = heights
+
+
+@setting_utilities.validator({
+    constants.PluginSettings.VIDEO_DEFAULT_VIEWER,
+    constants.PluginSettings.VIDEO_DEFAULT_PROFILE,
 })
 def validateDefaultViewer(doc):
     doc['value'] = str(doc['value']).strip()
 
 
+@setting_utilities.validator({
+    constants.PluginSettings.VIDEO_EXECUTOR
+})
+def validateExecutor(doc):
+    val = str(doc['value']).strip()
+    if val not in constants.EXECUTORS:
+        raise ValidationException('%s must be one of %s.' % (
+            doc['key'], ', '.join(constants.EXECUTORS)), 'value')
+    doc['value'] = val
+
+
 # Defaults
 
 # Defaults that have fixed values can just be added to the system defaults
@@ -227,6 +480,20 @@ SettingDefault.defaults.update({
     constants.PluginSettings.VIDEO_AUTO_SET: True,
     constants.PluginSettings.VIDEO_MAX_THUMBNAIL_FILES: 10,
     constants.PluginSettings.VIDEO_MAX_SMALL_IMAGE_SIZE: 4096,
+    constants.PluginSettings.VIDEO_RENDITIONS: [240, 480, 720, 1080],
+    constants.PluginSettings.VIDEO_FRAME_CACHE_SIZE: 512 * 1024 ** 2,
+    constants.PluginSettings.VIDEO_ENCODING_PROFILES: json.dumps(
+        constants.DEFAULT_ENCODING_PROFILES),
+    constants.PluginSettings.VIDEO_DEFAULT_PROFILE: 'default',
+    constants.PluginSettings.VIDEO_STREAM_INPUT: False,
+    constants.PluginSettings.VIDEO_ACTIVITY_INDEX: False,
+    constants.PluginSettings.VIDEO_AUDIO_WAVEFORM: False,
+    constants.PluginSettings.VIDEO_CHECKPOINT: False,
+    constants.PluginSettings.VIDEO_EXECUTOR: 'docker',
+    constants.PluginSettings.VIDEO_LAZY_RENDITIONS: False,
+    constants.PluginSettings.VIDEO_RENDITION_QUOTA: 0,
+    constants.PluginSettings.VIDEO_MAX_JOBS: 8,
+    constants.PluginSettings.VIDEO_MAX_JOBS_PER_USER: 2,
 })
 
 
@@ -239,14 +506,22 @@ SettingDefault.defaults.update({
     dependencies={'worker'},
 )
 def load(info):
-    from .rest import addItemRoutes
+    from .dedup import hashUploadedVideo
+    from .rest import addFolderRoutes, addItemRoutes, Video
 
     addItemRoutes(info['apiRoot'].item)
+    addFolderRoutes(info['apiRoot'].folder)
+    info['apiRoot'].video = Video()
 
     ModelImporter.model('item').exposeFields(
         level=AccessType.READ, fields='video')
+    ModelImporter.model('item').ensureIndex(
+        ('video.cacheKey', {'sparse': True}))
+    ModelImporter.model('job', 'jobs').ensureIndex(
+        ('meta.video_plugin.pending', {'sparse': True}))
 
     events.bind('data.process', 'video', _postUpload)
+    events.bind('data.process', 'video', hashUploadedVideo)
     events.bind('jobs.job.update.after', 'video', updateJob)
     events.bind('model.job.save', 'video', updateJob)
     events.bind('model.job.remove', 'video', updateJob)
@@ -258,3 +533,5 @@ def load(info):
     events.bind('model.file.save.after', 'video',
                 checkForLargeImageFiles)
     events.bind('model.item.remove', 'video', removeThumbnails)
+
+    startEvictor()
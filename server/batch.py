@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import time
+import traceback
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from girder.constants import AccessType
+from girder.utility.model_importer import ModelImporter
+
+from .constants import JobStatus, VIDEO_EXTENSIONS
+from .dedup import cacheKey, copyProcessedResults, findProcessedItem
+from .processing import OUTPUT_FIELDS, buildVideoJob, cacheParams, \
+                        processingSettings, removeCreatedFiles
+from .scheduler import BATCH_PRIORITY, dispatch, queueJob
+
+# Number of items whose files are looked up with a single query.
+ITEM_BATCH_SIZE = 1000
+
+# Number of jobs created and scheduled together, and the pause between such
+# groups so that a large folder does not flood the worker queue at once.
+SCHEDULE_BATCH_SIZE = 50
+SCHEDULE_INTERVAL = 1.0
+
+
+def iterFolderItems(folder, user, recursive):
+    """
+    Yield lists of the items in a folder, and in its subfolders if
+    recursive, a list per query.  Subfolders are visited breadth first and
+    only if the user can read them.
+    """
+    folderModel = ModelImporter.model('folder')
+    itemModel = ModelImporter.model('item')
+
+    queue = [folder]
+    while queue:
+        current = queue.pop(0)
+        batch = []
+        for item in itemModel.find(
+                {'folderId': current['_id']},
+                fields=['_id', 'name', 'folderId', 'video']):
+            batch.append(item)
+            if len(batch) >= ITEM_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+        if recursive:
+            queue.extend(folderModel.childFolders(
+                parentType='folder', parent=current, user=user))
+
+
+def findVideoFiles(items):
+    """
+    Find the first video file of each of a list of items with a single
+    query.
+
+    :returns: a dictionary of file documents keyed by item id.
+    """
+    videoFiles = {}
+    cursor = ModelImporter.model('file').find({
+        'itemId': {'$in': [item['_id'] for item in items]},
+        '$or': [
+            {'mimeType': {'$regex': '^video/'}},
+            {'exts': {'$in': list(VIDEO_EXTENSIONS)}}
+        ]
+    }, sort=[('_id', 1)])
+    for file in cursor:
+        videoFiles.setdefault(file['itemId'], file)
+    return videoFiles
+
+
+def scheduleBatch(batchJob, candidates, user, settings, force):
+    """
+    Create, insert and schedule the processing jobs for a group of items,
+    and record the jobs on the items, with one write per collection.  Items
+    whose processing was started by someone else in the meantime are left
+    to that job.  With force, the outputs of the previous job of each
+    claimed item are removed.
+
+    :param candidates: a list of (item, file, cache key) tuples.
+    :returns: the number of jobs scheduled.
+    """
+    jobModel = ModelImporter.model('job', 'jobs')
+    itemModel = ModelImporter.model('item')
+
+    jobs = []
+    updates = []
+    for item, file, key in candidates:
+        unset = {'video.cachedFrom': '', 'video.jobStatus': '',
+                 'video.meta': ''}
+        if force:
+            unset.update({'video.' + field: '' for field in OUTPUT_FIELDS})
+
+        job = queueJob(buildVideoJob(
+            item, file, user, settings, save=False, parentJob=batchJob),
+            BATCH_PRIORITY)
+        jobs.append(job)
+
+        fields = {
+            'video.jobId': str(job['_id']),
+            'video.fileId': str(file['_id'])
+        }
+        if key is not None:
+            fields['video.cacheKey'] = key
+        # Like processVideo, an item is only claimed if its job has not
+        # changed since it was read.
+        updates.append(UpdateOne(
+            {'_id': item['_id'],
+             'video.jobId': item.get('video', {}).get('jobId')},
+            {'$set': fields, '$unset': unset}))
+
+    # Items are updated before their jobs are scheduled, so that the
+    # outputs of a job cannot be registered before it is.  The jobs start
+    # as the scheduler's concurrency limits allow.
+    itemModel.collection.bulk_write(updates, ordered=False)
+    claimed = list(itemModel.find({
+        '_id': {'$in': [item['_id'] for item, _, _ in candidates]},
+        'video.jobId': {'$in': [str(job['_id']) for job in jobs]}
+    }, fields=['video.jobId', 'video.createdFiles']))
+    claimedJobIds = {item['video']['jobId'] for item in claimed}
+    jobs = [job for job in jobs if str(job['_id']) in claimedJobIds]
+
+    # The outputs of the previous job of an item are only removed once the
+    # item is claimed, so that an item left to another request keeps them.
+    if force:
+        inputFiles = {item['_id']: file for item, file, _ in candidates}
+        for item in claimed:
+            itemVideoData = item['video']
+            createdFiles = set(itemVideoData.get('createdFiles', []))
+            if not createdFiles:
+                continue
+            removeCreatedFiles(itemVideoData, user,
+                               keepFileId=inputFiles[item['_id']]['_id'])
+            itemModel.update({
+                '_id': item['_id'],
+                'video.jobId': itemVideoData['jobId']
+            }, {'$pull': {'video.createdFiles': {'$in': list(
+                createdFiles - set(itemVideoData['createdFiles']))}}},
+                multi=False)
+
+    if jobs:
+        jobModel.collection.insert_many(jobs)
+        dispatch()
+    return len(jobs)
+
+
+def processFolder(batchJob):
+    jobModel = ModelImporter.model('job', 'jobs')
+    itemModel = ModelImporter.model('item')
+    folderModel = ModelImporter.model('folder')
+    userModel = ModelImporter.model('user')
+
+    kwargs = batchJob['kwargs']
+    force = kwargs.get('force', False)
+    user = userModel.load(batchJob['userId'], force=True)
+    folder = folderModel.load(
+        kwargs['folderId'], user=user, level=AccessType.READ, exc=True)
+    settings = processingSettings(
+        kwargs.get('profile'), kwargs.get('segmented', False))
+    params = cacheParams(settings)
+
+    counts = {'items': 0, 'scheduled': 0, 'reused': 0, 'skipped': 0}
+    pending = []
+    lastScheduled = None
+
+    def flush():
+        if lastScheduled is not None:
+            delay = SCHEDULE_INTERVAL - (time.time() - lastScheduled)
+            if delay > 0:
+                time.sleep(delay)
+        scheduled = scheduleBatch(
+            batchJob, pending, user, settings, force)
+        # Items claimed by someone else meanwhile are skipped.
+        counts['scheduled'] += scheduled
+        counts['skipped'] += len(pending) - scheduled
+        del pending[:]
+        return time.time()
+
+    for items in iterFolderItems(folder, user, kwargs.get('recursive')):
+        counts['items'] += len(items)
+        if not force:
+            unprocessed = [item for item in items if not (
+                item.get('video', {}).get('jobId') or
+                item.get('video', {}).get('cachedFrom'))]
+            counts['skipped'] += len(items) - len(unprocessed)
+            items = unprocessed
+        videoFiles = findVideoFiles(items) if items else {}
+        counts['skipped'] += len(items) - len(videoFiles)
+
+        for item in items:
+            file = videoFiles.get(item['_id'])
+            if file is None:
+                continue
+
+            # Only hashes that are already stored are used here; hashing
+            # every file of a large folder would be slower than the
+            # transcodes it might save.
+            key = cacheKey(file, params, compute=False)
+            if key is not None and not force:
+                source = findProcessedItem(key, exclude=item['_id'])
+                if source is not None:
+                    # As in processVideo, the item is claimed before the
+                    # results are copied; an item claimed by a request
+                    # meanwhile is left to it.
+                    claimId = str(ObjectId())
+                    claimed = itemModel.collection.find_one_and_update(
+                        {'_id': item['_id'],
+                         'video.jobId': item.get('video', {}).get('jobId')},
+                        {'$set': {'video.jobId': claimId}})
+                    if claimed is not None and copyProcessedResults(
+                            source, item, user, key, file, claimId):
+                        counts['reused'] += 1
+                    else:
+                        counts['skipped'] += 1
+                    continue
+
+            pending.append((item, file, key))
+            if len(pending) >= SCHEDULE_BATCH_SIZE:
+                lastScheduled = flush()
+
+        batchJob = jobModel.updateJob(
+            batchJob, progressCurrent=counts['items'],
+            progressMessage='%d items examined, %d jobs scheduled' % (
+                counts['items'], counts['scheduled']))
+
+    if pending:
+        flush()
+
+    return ('%(items)d items examined: %(scheduled)d processing jobs '
+            'scheduled, %(reused)d reused existing results, %(skipped)d '
+            'skipped.\n' % counts)
+
+
+def run(job):
+    """
+    Local job that processes every video in a folder.  The job's kwargs are
+    the folderId and the recursive, force, profile and segmented options.
+    The processing jobs are owned by the job's user, and each is given its
+    tokens when the scheduler starts it.
+    """
+    jobModel = ModelImporter.model('job', 'jobs')
+    job = jobModel.updateJob(
+        job, status=JobStatus.RUNNING,
+        log='Started processing the videos of folder %s.\n' %
+            job['kwargs']['folderId'])
+
+    try:
+        summary = processFolder(job)
+    except Exception:
+        jobModel.updateJob(
+            job, status=JobStatus.ERROR, log=traceback.format_exc())
+        raise
+
+    jobModel.updateJob(job, status=JobStatus.SUCCESS, log=summary)
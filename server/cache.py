@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+from girder import logger
+from girder.utility.model_importer import ModelImporter
+
+from . import constants
+
+
+class FrameCache(object):
+    """
+    A two-level LRU cache for encoded video frames.  Recently used frames
+    are kept in memory, and every frame is also written to a directory on
+    disk.  Both levels are bounded by the total number of bytes they hold,
+    and the least recently used entries are evicted first.
+    """
+
+    def __init__(self, directory=None, maxDiskBytes=512 * 1024 ** 2,
+                 maxMemoryBytes=64 * 1024 ** 2):
+        self.directory = directory or os.path.join(
+            tempfile.gettempdir(), 'girder_video_frames')
+        self.maxDiskBytes = maxDiskBytes
+        self.maxMemoryBytes = maxMemoryBytes
+
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+        self._memoryBytes = 0
+        self._disk = collections.OrderedDict()
+        self._diskBytes = 0
+
+        self._loadDirectory()
+
+    @staticmethod
+    def key(*parts):
+        """
+        Build a cache key from its parts.  The key is safe to use as a file
+        name.
+        """
+        return hashlib.sha1(
+            '/'.join(str(part) for part in parts).encode('utf8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _loadDirectory(self):
+        """
+        Index the frames that are already on disk, oldest first, so that a
+        restarted server keeps its cache.
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.endswith('.tmp'):
+                os.unlink(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._diskBytes += size
+        self._evictDisk()
+
+    def _evictMemory(self):
+        while self._memoryBytes > self.maxMemoryBytes and self._memory:
+            _, data = self._memory.popitem(last=False)
+            self._memoryBytes -= len(data)
+
+    def _evictDisk(self):
+        while self._diskBytes > self.maxDiskBytes and self._disk:
+            name, size = self._disk.popitem(last=False)
+            self._diskBytes -= size
+            try:
+                os.unlink(self._path(name))
+            except OSError:
+                pass
+
+    def _remember(self, key, data):
+        if len(data) > self.maxMemoryBytes:
+            return
+        if key in self._memory:
+            self._memoryBytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memoryBytes += len(data)
+        self._evictMemory()
+
+    def get(self, key):
+        """
+        Return the cached data for a key, or None if it is not cached.
+        """
+        with self._lock:
+            data = self._memory.pop(key, None)
+            if data is not None:
+                self._memory[key] = data
+                return data
+            if key not in self._disk:
+                return None
+            self._disk[key] = self._disk.pop(key)
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self._path(key), None)
+        except (IOError, OSError):
+            with self._lock:
+                self._diskBytes -= self._disk.pop(key, 0)
+            return None
+
+        with self._lock:
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """
+        Store data under a key in both levels of the cache.
+        """
+        if len(data) <= self.maxDiskBytes:
+            fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.rename(tmpPath, self._path(key))
+            except (IOError, OSError):
+                logger.exception('Could not write cached frame %s' % key)
+                if os.path.exists(tmpPath):
+                    os.unlink(tmpPath)
+            else:
+                with self._lock:
+                    self._diskBytes -= self._disk.pop(key, 0)
+                    self._disk[key] = len(data)
+                    self._diskBytes += len(data)
+                    self._evictDisk()
+
+        with self._lock:
+            self._remember(key, data)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memoryBytes = 0
+            for name in self._disk:
+                try:
+                    os.unlink(self._path(name))
+                except OSError:
+                    pass
+            self._disk.clear()
+            self._diskBytes = 0
+
+
+_frameCache = None
+_frameCacheLock = threading.Lock()
+
+
+def getFrameCache():
+    """
+    Return the process-wide frame cache, creating it on first use with the
+    size configured in the plugin settings.
+    """
+    global _frameCache
+    with _frameCacheLock:
+        if _frameCache is None:
+            _frameCache = FrameCache(
+                maxDiskBytes=ModelImporter.model('setting').get(
+                    constants.PluginSettings.VIDEO_FRAME_CACHE_SIZE))
+    return _frameCache
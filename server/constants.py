@@ -28,6 +28,117 @@ class PluginSettings:
     VIDEO_AUTO_SET = 'video.auto_set'
     VIDEO_MAX_THUMBNAIL_FILES = 'video.max_thumbnail_files'
     VIDEO_MAX_SMALL_IMAGE_SIZE = 'video.max_small_image_size'
+    VIDEO_RENDITIONS = 'video.renditions'
+    VIDEO_FRAME_CACHE_SIZE = 'video.frame_cache_size'
+    VIDEO_ENCODING_PROFILES = 'video.encoding_profiles'
+    VIDEO_DEFAULT_PROFILE = 'video.default_profile'
+    VIDEO_STREAM_INPUT = 'video.stream_input'
+    VIDEO_ACTIVITY_INDEX = 'video.activity_index'
+    VIDEO_AUDIO_WAVEFORM = 'video.audio_waveform'
+    VIDEO_CHECKPOINT = 'video.checkpoint'
+    VIDEO_EXECUTOR = 'video.executor'
+    VIDEO_LAZY_RENDITIONS = 'video.lazy_renditions'
+    VIDEO_RENDITION_QUOTA = 'video.rendition_quota'
+    VIDEO_MAX_JOBS = 'video.max_jobs'
+    VIDEO_MAX_JOBS_PER_USER = 'video.max_jobs_per_user'
+
+
+# Encoding profiles available by default.  Each profile names a container
+# and may override the encoder settings the conversion script uses for that
+# container (videoCodec, audioCodec, crf, quality, speed, preset,
+# bitRateScale, audioBitRate).  Sources that are already playable in the
+# container are remuxed rather than encoded, within bounds that the
+# passthrough key may override (videoCodecs, audioCodecs, maxHeight,
+# maxBitRateScale, encodeLadder) or set to false to always encode.
+DEFAULT_ENCODING_PROFILES = {
+    'default': {
+        'container': 'webm',
+        'videoCodec': 'libvpx-vp9',
+        'audioCodec': 'libopus',
+        'crf': 5,
+        'quality': 'good',
+    },
+    'vp9-archival': {
+        'container': 'webm',
+        'videoCodec': 'libvpx-vp9',
+        'audioCodec': 'libopus',
+        'crf': 5,
+        'quality': 'good',
+        'speed': 0,
+        'bitRateScale': 2.0,
+    },
+    'h264-fast': {
+        'container': 'mp4',
+        'videoCodec': 'libx264',
+        'audioCodec': 'aac',
+        'crf': 23,
+        'preset': 'veryfast',
+    },
+}
+ENCODING_CONTAINERS = ('webm', 'mp4')
+
+# How the worker runs the conversion script: in a container of the
+# ffmpeg_local image per job, or in the worker's own process, with the
+# script importable as the convert module and ffmpeg on the worker's host.
+EXECUTORS = ('docker', 'local')
+
+
+# File extensions treated as video when a file has no video mime type.
+VIDEO_EXTENSIONS = ('avi', 'flv', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg',
+                    'mts', 'ogv', 'ts', 'webm', 'wmv')
+
+# Name of the file produced for each rendition height; this must match the
+# naming used by the conversion script in docker/ffmpeg_local.
+RENDITION_NAME = 'source_%dp.%s'
+RENDITION_NAME_PATTERN = r'^source_(\d+)p\.(webm|mp4)$'
+
+# Name of the keyframe index written next to each rendition.
+KEYFRAME_INDEX_NAME = 'source_%dp.keyframes'
+KEYFRAME_INDEX_NAME_PATTERN = r'^source_(\d+)p\.keyframes$'
+
+# Names of the storyboard sprite sheets and of their WebVTT index.
+STORYBOARD_NAME = 'storyboard_%03d.jpg'
+STORYBOARD_NAME_PATTERN = r'^storyboard_(\d+)\.jpg$'
+STORYBOARD_INDEX_NAME = 'storyboard.vtt'
+
+# Name of the optional scene-change and activity index, a NumPy array of
+# (time, luminance, motion) rows.  The scene cuts are in the metadata.
+ACTIVITY_INDEX_NAME = 'activity.npy'
+ACTIVITY_INDEX_NAME_PATTERN = r'^activity\.npy$'
+
+# Name of the audio waveform peaks; the layout is described by the
+# conversion script in docker/ffmpeg_local.
+WAVEFORM_NAME = 'waveform.bin'
+WAVEFORM_NAME_PATTERN = r'^waveform\.bin$'
+
+# Name of the per-stage timings written by the conversion script.  They are
+# copied into the job's meta.video_plugin.metrics when the job succeeds.
+METRICS_NAME = 'metrics.json'
+METRICS_NAME_PATTERN = r'^metrics\.json$'
+
+# Name of the checkpoint of a resumable transcode, which lists the chunks
+# uploaded next to it.  They are removed when the job succeeds.
+CHECKPOINT_NAME = 'checkpoint.json'
+CHECKPOINT_NAME_PATTERN = r'^checkpoint(\.json|_\d+_.+)$'
+
+# Outputs that a processing job may legitimately leave empty (for instance
+# renditions taller than the source); empty uploads of these are discarded.
+OPTIONAL_OUTPUT_PATTERNS = (
+    RENDITION_NAME_PATTERN,
+    KEYFRAME_INDEX_NAME_PATTERN,
+    STORYBOARD_NAME_PATTERN,
+    ACTIVITY_INDEX_NAME_PATTERN,
+    WAVEFORM_NAME_PATTERN,
+    METRICS_NAME_PATTERN,
+)
+
+# Name of the DASH manifest uploaded by segmented processing jobs.  Its
+# segments are uploaded next to it and resolved relative to its URL.
+DASH_MANIFEST_NAME = 'manifest.mpd'
+
+# Name of the metadata written by the conversion script.  Its contents are
+# copied into the item when the job succeeds.
+META_NAME = 'meta.json'
 
 
 class JobStatus:
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import hashlib
+import json
+
+from girder.utility.model_importer import ModelImporter
+
+from .background import executor
+from .base import createdFileField
+from .constants import JobStatus, METRICS_NAME, VIDEO_EXTENSIONS
+
+# Hash fields that Girder or its plugins may already have stored on a file,
+# strongest first.  sha512 is maintained by the hashsum_download plugin.
+KNOWN_HASH_FIELDS = ('sha512', 'sha256')
+
+# Processing outputs that are specific to one run and are not reused.
+UNSHARED_OUTPUTS = ('processing_stdout.txt', 'processing_stderr.txt',
+                    METRICS_NAME)
+
+
+def contentHash(file, compute=True):
+    """
+    Return a content hash of a file as 'algorithm:hexdigest'.  A hash
+    already stored on the file is used if there is one; otherwise a SHA-256
+    is computed by reading the file once and stored for next time.
+
+    :param compute: if False, return None rather than reading the file when
+        no hash is stored.
+    """
+    for field in KNOWN_HASH_FIELDS:
+        if file.get(field):
+            return '%s:%s' % (field, file[field])
+    if not compute:
+        return None
+
+    fileModel = ModelImporter.model('file')
+    digest = hashlib.sha256()
+    for chunk in fileModel.download(file, headers=False)():
+        digest.update(chunk)
+    file['sha256'] = digest.hexdigest()
+    fileModel.update({'_id': file['_id']}, {'$set': {
+        'sha256': file['sha256']}})
+    return 'sha256:%s' % file['sha256']
+
+
+def isVideoFile(file):
+    """
+    Whether a file is a video, by its mime type or its extension.
+    """
+    return ((file.get('mimeType') or '').startswith('video/') or
+            any(ext in VIDEO_EXTENSIONS for ext in file.get('exts', [])))
+
+
+def hashFile(fileId):
+    """
+    Compute and store the content hash of a file, if it still exists.
+    """
+    file = ModelImporter.model('file').load(fileId, force=True)
+    if file is not None:
+        contentHash(file)
+
+
+def hashUploadedVideo(event):
+    """
+    Called when a file is uploaded.  Videos are hashed in the background as
+    they arrive, so that the first request to process one can already reuse
+    the results of identical content.  The outputs of processing jobs are
+    not hashed.
+    """
+    file = event.info['file']
+    if (event.info.get('reference') == 'videoPlugin' or
+            not isVideoFile(file) or
+            contentHash(file, compute=False) is not None):
+        return
+    executor.submit(hashFile, file['_id'])
+
+
+def cacheKey(file, params, compute=True):
+    """
+    Return the key under which the results of processing a file with the
+    given encoding parameters are cached.
+
+    :param file: the input file document.
+    :param params: a JSON-serializable dictionary of everything that affects
+        the outputs of the job (profile, renditions, storyboard, ...).
+    :param compute: if False, return None rather than hashing a file that
+        has no stored hash.
+    """
+    digest = contentHash(file, compute)
+    if digest is None:
+        return None
+    return hashlib.sha256(('%s\n%s' % (
+        digest, json.dumps(params, sort_keys=True))
+    ).encode('utf8')).hexdigest()
+
+
+def storeCacheKey(itemId, jobId, fileId, params):
+    """
+    Hash a file that had no stored hash and record the cache key of its
+    processing on the item, so that later requests can reuse the results.
+    This reads the whole file, so it is run in the background.  Nothing is
+    recorded if the item has been given to another job, or its job failed.
+
+    :param itemId: the id of the item.
+    :param jobId: the id of the item's processing job.
+    :param fileId: the id of the input file.
+    :param params: the encoding parameters, from cacheParams.
+    """
+    file = ModelImporter.model('file').load(fileId, force=True)
+    if file is None:
+        return
+    ModelImporter.model('item').update({
+        '_id': itemId,
+        'video.jobId': str(jobId),
+        'video.jobStatus': {'$nin': [JobStatus.ERROR, JobStatus.CANCELED]}
+    }, {'$set': {'video.cacheKey': cacheKey(file, params)}}, multi=False)
+
+
+def findProcessedItem(key, exclude=None):
+    """
+    Find an item whose processing with the given cache key has succeeded.
+
+    :param key: the cache key from cacheKey.
+    :param exclude: the id of an item to ignore.
+    :returns: the item document or None.
+    """
+    itemModel = ModelImporter.model('item')
+    jobModel = ModelImporter.model('job', 'jobs')
+
+    query = {'video.cacheKey': key}
+    if exclude is not None:
+        query['_id'] = {'$ne': exclude}
+
+    for item in itemModel.find(query, limit=10):
+        itemVideoData = item['video']
+        jobId = itemVideoData.get('cachedFrom', {}).get(
+            'jobId', itemVideoData.get('jobId'))
+        if not jobId or not itemVideoData.get('createdFiles'):
+            continue
+        job = jobModel.load(jobId, force=True)
+        if job is not None and job['status'] == JobStatus.SUCCESS:
+            return item
+    return None
+
+
+def copyProcessedResults(source, item, user, key, inputFile, claimId):
+    """
+    Give an item the processed results of another item that was processed
+    from identical content with identical parameters.  The files are copied
+    with Girder's copyFile, which shares the underlying assetstore data
+    rather than duplicating it.
+
+    The caller must have claimed the item by setting its video.jobId to
+    claimId, so that concurrent requests do not copy the results twice.
+    Only the fields of the results are written, and only while the claim
+    holds; the claim is then released, as the item has no job.
+
+    :param inputFile: the item's own file with that content, which is
+        recorded as the file the results were made from.
+    :param claimId: the value of video.jobId while the item is claimed.
+    :returns: whether the results were recorded.  If the claim was lost,
+        the copied files are removed again.
+    """
+    fileModel = ModelImporter.model('file')
+    sourceVideoData = source['video']
+
+    copied = []
+    fields = {}
+    for fileId in sourceVideoData.get('createdFiles', []):
+        sourceFile = fileModel.load(fileId, force=True)
+        if sourceFile is None or sourceFile['name'] in UNSHARED_OUTPUTS:
+            continue
+        newFile = fileModel.copyFile(sourceFile, creator=user, item=item)
+        copied.append(newFile)
+        field = createdFileField(newFile['name'])
+        if field is not None:
+            fields['video.' + field] = str(newFile['_id'])
+
+    if 'meta' in sourceVideoData:
+        fields['video.meta'] = sourceVideoData['meta']
+    fields.update({
+        'video.fileId': str(inputFile['_id']),
+        'video.cacheKey': key,
+        'video.cachedFrom': {
+            'itemId': str(source['_id']),
+            'jobId': sourceVideoData.get('cachedFrom', {}).get(
+                'jobId', sourceVideoData.get('jobId'))
+        }
+    })
+    result = ModelImporter.model('item').collection.update_one({
+        '_id': item['_id'],
+        'video.jobId': claimId
+    }, {
+        '$set': fields,
+        '$addToSet': {'video.createdFiles': {
+            '$each': [str(newFile['_id']) for newFile in copied]}},
+        '$unset': {'video.jobId': '', 'video.jobStatus': ''}
+    })
+    if not result.matched_count:
+        for newFile in copied:
+            fileModel.remove(newFile)
+        return False
+    return True
@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+from girder.utility.model_importer import ModelImporter
+
+from .background import executor
+from .cache import getFrameCache
+from .keyframes import loadKeyframeIndex
+from .stream import loadRenditionFile, recordAccess, selectRendition
+
+FFMPEG = 'ffmpeg'
+
+# Frame rate assumed when quantizing timestamps for items whose metadata does
+# not record one.
+DEFAULT_FRAME_RATE = 30.0
+
+FRAME_FORMATS = {
+    'jpeg': ('mjpeg', 'image/jpeg'),
+    'png': ('png', 'image/png'),
+}
+
+# Batch extraction returns an archive of images, or a single NumPy array of
+# RGB frames.  Requests are limited to MAX_BATCH_FRAMES distinct frames.
+BATCH_FORMATS = {
+    'tar': 'application/x-tar',
+    'zip': 'application/zip',
+    'npy': 'application/octet-stream',
+}
+MAX_BATCH_FRAMES = 1000
+
+# A batch is decoded forward in one pass, except that a gap of more than
+# this many seconds between requested frames, across a keyframe, is
+# skipped by seeking, which is cheaper than decoding through it.
+BATCH_SEEK_GAP = 2.0
+
+BATCH_CHUNK_SIZE = 1024 ** 2
+
+
+def quantizeTime(time, frameRate):
+    """
+    Snap a time to the start of the frame that contains it, so that nearby
+    requests share a cache entry.
+
+    :param time: time in seconds.
+    :param frameRate: frames per second, or None to use the default.
+    :returns: a tuple of the frame number and the quantized time.
+    """
+    frameRate = frameRate or DEFAULT_FRAME_RATE
+    frame = max(0, int(time * frameRate + 1e-6))
+    return frame, frame / float(frameRate)
+
+
+def scaleFilter(width=None, height=None):
+    """
+    Return an ffmpeg scale filter for the requested size, preserving the
+    aspect ratio if only one dimension is given, or None for no scaling.
+    """
+    if not width and not height:
+        return None
+    return 'scale=%s:%s' % (width or -2, height or -2)
+
+
+def selectVideoFile(item, height=None):
+    """
+    Pick the file to decode frames from: the smallest rendition that is at
+    least as tall as requested, or the tallest rendition otherwise.  Items
+    without renditions fall back to the file that was processed.
+
+    :param item: the video item.
+    :param height: the requested frame height, if any.
+    :returns: a file document or None.
+    """
+    fileModel = ModelImporter.model('file')
+    itemVideoData = item.get('video', {})
+
+    fileId = selectRendition(item, height)
+    if fileId is not None:
+        file = loadRenditionFile(fileId)
+        if file:
+            executor.submit(recordAccess, item['_id'], file['_id'])
+            return file
+
+    fileId = itemVideoData.get('fileId')
+    if fileId:
+        file = fileModel.load(fileId, force=True)
+        if file:
+            return file
+    return fileModel.findOne({'itemId': item['_id']})
+
+
+def _runFFmpeg(cmd, file=None):
+    """
+    Run an ffmpeg command, copying a file's contents to its standard input
+    if one is given.
+
+    :returns: a tuple of its standard output, its standard error and its
+        exit code.
+    """
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if file is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+    feeder = None
+    if file is not None:
+        feeder = threading.Thread(target=_feed, args=(proc, file))
+        feeder.daemon = True
+        feeder.start()
+
+    # With '-v error' ffmpeg writes very little to stderr, so reading the
+    # two pipes one after the other cannot dead-lock.
+    data = proc.stdout.read()
+    err = proc.stderr.read()
+    proc.wait()
+    if feeder is not None:
+        feeder.join()
+    return data, err, proc.returncode
+
+
+def _localPath(file):
+    try:
+        return ModelImporter.model('file').getLocalFilePath(file)
+    except Exception:
+        return None
+
+
+def _feed(proc, file):
+    """Copy a file's contents to the standard input of a process."""
+    try:
+        for chunk in ModelImporter.model('file').download(
+                file, headers=False)():
+            proc.stdin.write(chunk)
+    except (IOError, OSError):
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+def extractFrame(file, time, width=None, height=None, format='jpeg'):
+    """
+    Decode a single frame with ffmpeg.  The seek is placed before the input,
+    so ffmpeg jumps to the nearest preceding keyframe and only decodes from
+    there.  Files that are not on a local assetstore are piped to ffmpeg,
+    which then has to decode from the start.
+
+    :param file: the file document of the video.
+    :param time: the time of the frame in seconds.
+    :param width: the width of the frame, or None.
+    :param height: the height of the frame, or None.
+    :param format: one of the keys of FRAME_FORMATS.
+    :returns: the encoded frame.
+    """
+    codec, _ = FRAME_FORMATS[format]
+    path = _localPath(file)
+
+    cmd = [FFMPEG, '-v', 'error']
+    if path is not None:
+        cmd.append('-nostdin')
+    cmd.extend(['-ss', '%.6f' % time, '-i', path or 'pipe:0',
+                '-frames:v', '1'])
+    vf = scaleFilter(width, height)
+    if vf:
+        cmd.extend(['-vf', vf])
+    cmd.extend(['-f', 'image2pipe', '-c:v', codec, 'pipe:1'])
+
+    data, err, returncode = _runFFmpeg(cmd, file if path is None else None)
+    if returncode or not data:
+        raise RuntimeError('Could not extract a frame at %s: %s' % (
+            time, err.decode('utf8', 'replace').strip()))
+    return data
+
+
+def getFrame(item, time, width=None, height=None, format='jpeg'):
+    """
+    Return a frame of a video item, using the frame cache.
+
+    :returns: a tuple of the encoded frame and its mime type.
+    """
+    file = selectVideoFile(item, height)
+    if file is None:
+        raise RuntimeError('Item %s has no video file' % item['_id'])
+
+    frameRate = item.get('video', {}).get('meta', {}).get(
+        'video', {}).get('frameRate')
+    frame, time = quantizeTime(time, frameRate)
+
+    cache = getFrameCache()
+    key = cache.key(item['_id'], file['_id'], frame, width, height, format)
+    data = cache.get(key)
+    if data is None:
+        data = extractFrame(file, time, width, height, format)
+        cache.put(key, data)
+    return data, FRAME_FORMATS[format][1]
+
+
+def batchFrameNumbers(frameRate, frameCount=None, times=None, frames=None,
+                      start=0, end=None, stride=None):
+    """
+    Resolve the frames requested from a batch into frame numbers.  Times
+    are snapped to frames as for single frames, and a stride adds a frame
+    every stride seconds from start to end (the end of the video by
+    default).
+
+    :param frameRate: frames per second, or None to use the default.
+    :param frameCount: the number of frames of the video, if known; later
+        frames are dropped.
+    :returns: a sorted list of distinct frame numbers.
+    :raises ValueError: if no frame, or too many, are requested.
+    """
+    frameRate = frameRate or DEFAULT_FRAME_RATE
+    numbers = set(int(frame) for frame in frames or [])
+    numbers.update(quantizeTime(float(t), frameRate)[0] for t in times or [])
+    if stride:
+        if stride <= 0:
+            raise ValueError('stride must be positive.')
+        if end is None:
+            if not frameCount:
+                raise ValueError('end is required when the length of the '
+                                 'video is not known.')
+            end = frameCount / float(frameRate)
+        count = int((end - start) / stride + 1e-6) + 1
+        if count > MAX_BATCH_FRAMES:
+            raise ValueError('At most %d frames can be requested at once.' %
+                             MAX_BATCH_FRAMES)
+        numbers.update(quantizeTime(start + i * stride, frameRate)[0]
+                       for i in range(count))
+
+    numbers = sorted(n for n in numbers
+                     if n >= 0 and (not frameCount or n < frameCount))
+    if not numbers:
+        raise ValueError('No frames were requested.')
+    if len(numbers) > MAX_BATCH_FRAMES:
+        raise ValueError('At most %d frames can be requested at once.' %
+                         MAX_BATCH_FRAMES)
+    return numbers
+
+
+def planRuns(frames, frameRate, index=None):
+    """
+    Group sorted frame numbers into runs that are each decoded forward by
+    one ffmpeg process, seeking to the start of each run.  A new run starts
+    where the gap between two requested frames is longer than
+    BATCH_SEEK_GAP and, if the keyframe index is known, a keyframe lies in
+    between, so that the seek actually skips decoding.
+
+    :param index: the KeyframeIndex of the file, or None.
+    :returns: a list of lists of frame numbers.
+    """
+    runs = []
+    for frame in frames:
+        if runs:
+            previous = runs[-1][-1] / float(frameRate)
+            current = frame / float(frameRate)
+            keyframe = index.keyframeBefore(current) if index else None
+            if current - previous <= BATCH_SEEK_GAP or (
+                    index is not None and (
+                        keyframe is None or keyframe[0] <= previous)):
+                runs[-1].append(frame)
+                continue
+        runs.append([frame])
+    return runs
+
+
+def outputSize(item, file, width=None, height=None):
+    """
+    Return the exact size of the frames extracted from a file, for outputs
+    that need it up front: the requested size, with a missing dimension
+    following the aspect ratio of the source, or the size of the file.
+
+    :returns: a tuple of the width and height, both even.
+    """
+    videoMeta = item.get('video', {}).get('meta', {})
+    sourceWidth = videoMeta.get('video', {}).get('width')
+    sourceHeight = videoMeta.get('video', {}).get('height')
+    if width and height:
+        return width, height
+    if not sourceWidth or not sourceHeight:
+        raise RuntimeError('Item %s has no recorded frame size; give both '
+                           'width and height.' % item['_id'])
+
+    def even(value):
+        return max(2, int(round(value / 2.0)) * 2)
+
+    if height:
+        return even(sourceWidth * height / float(sourceHeight)), height
+    if width:
+        return width, even(sourceHeight * width / float(sourceWidth))
+    height = next((
+        rendition['height'] for rendition in videoMeta.get('renditions', [])
+        if rendition.get('name') == file['name']), sourceHeight)
+    return even(sourceWidth * height / float(sourceHeight)), even(height)
+
+
+def decodeRun(file, path, run, frameRate, output, vf=None, codec=None,
+              startNumber=1):
+    """
+    Decode the frames of a run in a single forward pass.
+
+    :param file: the file document, piped to ffmpeg if path is None.
+    :param path: the local path of the file, or None.
+    :param run: sorted frame numbers.
+    :param output: the path ffmpeg writes to: an image2 pattern when a codec
+        is given, and a raw RGB file otherwise.
+    :param vf: an optional filter applied to the selected frames.
+    :param codec: the image codec, or None for raw RGB.
+    :param startNumber: the number of the first image of the run.
+    """
+    # A piped file cannot seek, so its run is decoded from the start.
+    base = run[0] if path is not None else 0
+    cmd = [FFMPEG, '-v', 'error']
+    if path is not None:
+        cmd.extend(['-nostdin', '-ss', '%.6f' % (base / float(frameRate))])
+    cmd.extend(['-i', path or 'pipe:0'])
+
+    filters = ['select=%s' % '+'.join(
+        'eq(n\\,%d)' % (frame - base) for frame in run)]
+    if vf:
+        filters.append(vf)
+    cmd.extend(['-vf', ','.join(filters), '-vsync', '0',
+                '-frames:v', str(len(run))])
+    if codec:
+        cmd.extend(['-f', 'image2', '-start_number', str(startNumber),
+                    '-c:v', codec, output])
+    else:
+        cmd.extend(['-f', 'rawvideo', '-pix_fmt', 'rgb24', output])
+
+    _, err, returncode = _runFFmpeg(cmd, file if path is None else None)
+    if returncode:
+        raise RuntimeError('Could not extract frames %d to %d: %s' % (
+            run[0], run[-1], err.decode('utf8', 'replace').strip()))
+
+
+def npyHeader(shape):
+    """Return the header of a version 1.0 .npy file of unsigned bytes."""
+    header = "{'descr': '|u1', 'fortran_order': False, 'shape': (%s), }" % (
+        ''.join('%d, ' % dim for dim in shape).rstrip(' '))
+    header += ' ' * ((-(10 + len(header) + 1)) % 64) + '\n'
+    return (b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) +
+            header.encode('latin1'))
+
+
+def _readChunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BATCH_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def _tarEntry(name, path):
+    info = tarfile.TarInfo(name)
+    info.size = os.path.getsize(path)
+    info.mtime = int(os.path.getmtime(path))
+    info.mode = 0o644
+    yield info.tobuf(tarfile.USTAR_FORMAT)
+    for data in _readChunks(path):
+        yield data
+    if info.size % tarfile.BLOCKSIZE:
+        yield b'\0' * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+
+
+def extractFrames(item, frames, width=None, height=None, format='tar',
+                  imageFormat='jpeg'):
+    """
+    Extract many frames of a video item, decoding each run of nearby frames
+    in one forward pass.  The frames are decoded to a temporary directory
+    before anything is returned, so that errors can still be reported.
+
+    :param frames: sorted distinct frame numbers from batchFrameNumbers.
+    :param format: one of the keys of BATCH_FORMATS.  Archives hold one
+        image per frame, named after its frame number, and a frames.json
+        index of the frame numbers, times and names; npy is a single array
+        of shape (frames, height, width, 3).
+    :param imageFormat: the image format of archives; one of the keys of
+        FRAME_FORMATS.
+    :returns: a function that generates the response body.
+    """
+    file = selectVideoFile(item, height)
+    if file is None:
+        raise RuntimeError('Item %s has no video file' % item['_id'])
+    frameRate = item.get('video', {}).get('meta', {}).get(
+        'video', {}).get('frameRate') or DEFAULT_FRAME_RATE
+
+    path = _localPath(file)
+    if path is None:
+        runs = [frames]
+    else:
+        runs = planRuns(
+            frames, frameRate, loadKeyframeIndex(item, file['_id']))
+
+    tempDir = tempfile.mkdtemp(prefix='video_frames_')
+    try:
+        if format == 'npy':
+            size = outputSize(item, file, width, height)
+            outputs = []
+            for number, run in enumerate(runs):
+                output = os.path.join(tempDir, 'run_%04d.rgb' % number)
+                decodeRun(file, path, run, frameRate, output,
+                          vf='scale=%d:%d' % size)
+                if os.path.getsize(output) != len(run) * size[0] * size[1] * 3:
+                    raise RuntimeError(
+                        'Could not extract every frame from %d to %d.' % (
+                            run[0], run[-1]))
+                outputs.append(output)
+        else:
+            codec = FRAME_FORMATS[imageFormat][0]
+            ext = 'jpg' if imageFormat == 'jpeg' else imageFormat
+            names = []
+            for run in runs:
+                decodeRun(file, path, run, frameRate,
+                          os.path.join(tempDir, '%%08d.%s' % ext),
+                          vf=scaleFilter(width, height), codec=codec,
+                          startNumber=len(names) + 1)
+                names.extend('%08d.%s' % (len(names) + i + 1, ext)
+                             for i in range(len(run)))
+            if len([name for name in names if os.path.exists(
+                    os.path.join(tempDir, name))]) != len(frames):
+                raise RuntimeError('Could not extract every frame.')
+            index = [{
+                'frame': frame,
+                'time': frame / float(frameRate),
+                'name': 'frame_%08d.%s' % (frame, ext)
+            } for frame in frames]
+            with open(os.path.join(tempDir, 'frames.json'), 'w') as f:
+                json.dump(index, f, indent=2)
+    except Exception:
+        shutil.rmtree(tempDir, ignore_errors=True)
+        raise
+
+    def stream():
+        try:
+            if format == 'npy':
+                yield npyHeader((len(frames), size[1], size[0], 3))
+                for output in outputs:
+                    for data in _readChunks(output):
+                        yield data
+            elif format == 'tar':
+                for data in _tarEntry(
+                        'frames.json', os.path.join(tempDir, 'frames.json')):
+                    yield data
+                for name, entry in zip(names, index):
+                    for data in _tarEntry(
+                            entry['name'], os.path.join(tempDir, name)):
+                        yield data
+                yield b'\0' * (2 * tarfile.BLOCKSIZE)
+            else:
+                # Images are already compressed, so they are stored as is.
+                archive = os.path.join(tempDir, 'frames.zip')
+                with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+                    zf.write(os.path.join(tempDir, 'frames.json'),
+                             'frames.json')
+                    for name, entry in zip(names, index):
+                        zf.write(os.path.join(tempDir, name), entry['name'])
+                for data in _readChunks(archive):
+                    yield data
+        finally:
+            shutil.rmtree(tempDir, ignore_errors=True)
+
+    return stream
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import bisect
+import collections
+import struct
+import threading
+
+from girder.utility.model_importer import ModelImporter
+
+# This layout must match the one written by the conversion script in
+# docker/ffmpeg_local.
+KEYFRAME_INDEX_MAGIC = b'GVKI'
+KEYFRAME_INDEX_VERSION = 1
+KEYFRAME_INDEX_HEADER = struct.Struct('<4sHI')
+KEYFRAME_INDEX_RECORD = struct.Struct('<dqq')
+
+# Number of parsed indices kept in memory.
+_indexCacheSize = 256
+_indexCache = collections.OrderedDict()
+_indexCacheLock = threading.Lock()
+
+
+class KeyframeIndex(object):
+    """
+    The keyframes of a rendition, as (pts, byte offset, frame number)
+    records sorted by pts.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.times = [record[0] for record in records]
+
+    @classmethod
+    def fromBytes(cls, data):
+        magic, version, count = KEYFRAME_INDEX_HEADER.unpack_from(data)
+        if magic != KEYFRAME_INDEX_MAGIC or version != KEYFRAME_INDEX_VERSION:
+            raise ValueError('Not a version %d keyframe index' %
+                             KEYFRAME_INDEX_VERSION)
+        offset = KEYFRAME_INDEX_HEADER.size
+        records = [
+            KEYFRAME_INDEX_RECORD.unpack_from(
+                data, offset + i * KEYFRAME_INDEX_RECORD.size)
+            for i in range(count)]
+        return cls(sorted(records))
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, time):
+        """
+        Return the position in the index of the last keyframe at or before a
+        time, or None if there is none.
+        """
+        pos = bisect.bisect_right(self.times, time) - 1
+        return pos if pos >= 0 else None
+
+    def keyframeBefore(self, time):
+        """
+        Return the (pts, byte offset, frame number) of the last keyframe at
+        or before a time, or None.
+        """
+        pos = self.find(time)
+        return self.records[pos] if pos is not None else None
+
+    def byteRange(self, time):
+        """
+        Return the byte range of the group of pictures that contains a time,
+        as (start, end) where end is None for the last group.
+        """
+        pos = self.find(time)
+        if pos is None:
+            pos = 0
+        if not self.records:
+            return 0, None
+        start = self.records[pos][1]
+        end = (self.records[pos + 1][1]
+               if pos + 1 < len(self.records) else None)
+        return start, end
+
+
+def loadKeyframeIndex(item, fileId):
+    """
+    Load the keyframe index of one of an item's renditions.
+
+    :param item: the video item.
+    :param fileId: the id of the rendition file.
+    :returns: a KeyframeIndex, or None if the rendition has no index.
+    """
+    itemVideoData = item.get('video', {})
+    label = next((
+        label for label, renditionId in itemVideoData.get(
+            'renditions', {}).items()
+        if renditionId == str(fileId)), None)
+    indexId = itemVideoData.get('keyframeIndex', {}).get(label)
+    if indexId is None:
+        return None
+
+    with _indexCacheLock:
+        index = _indexCache.pop(indexId, None)
+        if index is not None:
+            _indexCache[indexId] = index
+            return index
+
+    fileModel = ModelImporter.model('file')
+    indexFile = fileModel.load(indexId, force=True)
+    if indexFile is None:
+        return None
+    data = b''.join(fileModel.download(indexFile, headers=False)())
+    try:
+        index = KeyframeIndex.fromBytes(data)
+    except (ValueError, struct.error):
+        return None
+
+    with _indexCacheLock:
+        _indexCache[indexId] = index
+        while len(_indexCache) > _indexCacheSize:
+            _indexCache.popitem(last=False)
+    return index
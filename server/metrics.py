@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import math
+import threading
+import time
+
+from girder.utility.model_importer import ModelImporter
+
+from .constants import JobStatus
+
+# The summaries are computed over the metrics of this many of the most
+# recently updated processing jobs, and recomputed at most this often.
+METRICS_JOB_LIMIT = 1000
+METRICS_CACHE_SECONDS = 30
+
+QUANTILES = (0.5, 0.95)
+
+_cache = {'time': 0, 'text': None}
+_cacheLock = threading.Lock()
+
+
+def quantile(values, q):
+    """Return the q-quantile of a sorted list by the nearest-rank method."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(math.ceil(q * len(values))) - 1))
+    return values[rank]
+
+
+def _statusNames():
+    return {
+        JobStatus.INACTIVE: 'inactive',
+        JobStatus.QUEUED: 'queued',
+        JobStatus.RUNNING: 'running',
+        JobStatus.SUCCESS: 'success',
+        JobStatus.ERROR: 'error',
+        JobStatus.CANCELED: 'canceled',
+    }
+
+
+def collectMetrics(limit=METRICS_JOB_LIMIT):
+    """
+    Gather the job counts and the samples the summaries are computed from.
+
+    :returns: a tuple of a dictionary of job counts by status name, and a
+        dictionary of sorted sample lists by summary name and stage.
+    """
+    jobModel = ModelImporter.model('job', 'jobs')
+
+    names = _statusNames()
+    counts = {}
+    for group in jobModel.collection.aggregate([
+            {'$match': {'type': 'video'}},
+            {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+        name = names.get(group['_id'], str(group['_id']))
+        counts[name] = counts.get(name, 0) + group['count']
+
+    samples = {'speed': [], 'fps': [], 'queueWait': [], 'stages': {}}
+    for job in jobModel.find(
+            {'type': 'video', 'meta.video_plugin.metrics': {'$exists': True}},
+            sort=[('updated', -1)], limit=limit,
+            fields=['meta.video_plugin.metrics']):
+        metrics = job['meta']['video_plugin']['metrics']
+        stages = metrics.get('stages', {})
+        encode = stages.get('encode', {})
+        if encode.get('speed'):
+            samples['speed'].append(encode['speed'])
+        if encode.get('fps'):
+            samples['fps'].append(encode['fps'])
+        if metrics.get('queueWait') is not None:
+            samples['queueWait'].append(metrics['queueWait'])
+        for name, stage in stages.items():
+            if stage.get('wall') is not None:
+                samples['stages'].setdefault(name, []).append(stage['wall'])
+
+    for values in [samples['speed'], samples['fps'], samples['queueWait']] + \
+            list(samples['stages'].values()):
+        values.sort()
+    return counts, samples
+
+
+def _summary(lines, name, help, values, labels=None, header=True):
+    labels = labels or {}
+    if header:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s summary' % name)
+
+    def labelString(extra=None):
+        merged = dict(labels, **(extra or {}))
+        if not merged:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (key, merged[key]) for key in sorted(merged))
+
+    for q in QUANTILES:
+        value = quantile(values, q)
+        if value is not None:
+            lines.append('%s%s %g' % (
+                name, labelString({'quantile': str(q)}), value))
+    lines.append('%s_sum%s %g' % (name, labelString(), sum(values)))
+    lines.append('%s_count%s %d' % (name, labelString(), len(values)))
+
+
+def formatPrometheus(counts, samples):
+    """
+    Format collected metrics in the Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP video_jobs Video processing jobs by status.',
+        '# TYPE video_jobs gauge',
+    ]
+    for status in sorted(counts):
+        lines.append('video_jobs{status="%s"} %d' % (status, counts[status]))
+
+    _summary(lines, 'video_encode_speed',
+             'Encode speed of recent jobs, as a multiple of real time.',
+             samples['speed'])
+    _summary(lines, 'video_encode_fps',
+             'Frames encoded per second by recent jobs.', samples['fps'])
+    _summary(lines, 'video_queue_wait_seconds',
+             'Time recent jobs waited before they started running.',
+             samples['queueWait'])
+    for index, stage in enumerate(sorted(samples['stages'])):
+        _summary(lines, 'video_stage_seconds',
+                 'Wall time of each stage of recent jobs.',
+                 samples['stages'][stage], {'stage': stage},
+                 header=not index)
+    return '\n'.join(lines) + '\n'
+
+
+def prometheusMetrics():
+    """
+    Return the plugin's metrics in the Prometheus text format, computing
+    them at most once per METRICS_CACHE_SECONDS.
+    """
+    with _cacheLock:
+        if _cache['text'] is not None and \
+                time.time() - _cache['time'] < METRICS_CACHE_SECONDS:
+            return _cache['text']
+
+    text = formatPrometheus(*collectMetrics())
+    with _cacheLock:
+        _cache['time'] = time.time()
+        _cache['text'] = text
+    return text
@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import json
+import os.path
+import re
+
+from bson.objectid import ObjectId
+
+from girder.constants import AccessType, TokenScope
+from girder.models.model_base import ValidationException
+from girder.plugins.worker import utils as workerUtils
+from girder.utility.model_importer import ModelImporter
+
+from .constants import PluginSettings, RENDITION_NAME, KEYFRAME_INDEX_NAME, \
+                       META_NAME, STORYBOARD_NAME, STORYBOARD_INDEX_NAME, \
+                       ACTIVITY_INDEX_NAME, METRICS_NAME, WAVEFORM_NAME, \
+                       CHECKPOINT_NAME_PATTERN
+
+
+def processingSettings(profileName=None, segmented=False):
+    """
+    Resolve the plugin settings that determine the outputs of a processing
+    job.
+
+    :param profileName: the encoding profile to use, or None for the
+        default profile.
+    :param segmented: whether to produce a segmented DASH presentation.
+    :returns: a dictionary of the resolved settings.
+    """
+    settingModel = ModelImporter.model('setting')
+
+    profileName = profileName or settingModel.get(
+        PluginSettings.VIDEO_DEFAULT_PROFILE)
+    profiles = json.loads(
+        settingModel.get(PluginSettings.VIDEO_ENCODING_PROFILES) or '{}')
+    profile = profiles.get(profileName)
+    if profile is None:
+        raise ValidationException(
+            'No such encoding profile: %s' % profileName, 'profile')
+
+    # With lazy renditions, processing only produces the smallest rendition
+    # of the ladder, and the others are made when they are first requested.
+    ladder = settingModel.get(PluginSettings.VIDEO_RENDITIONS)
+    lazyRenditions = settingModel.get(PluginSettings.VIDEO_LAZY_RENDITIONS)
+
+    storyboardSheets = 0
+    if settingModel.get(PluginSettings.VIDEO_SHOW_THUMBNAILS):
+        storyboardSheets = settingModel.get(
+            PluginSettings.VIDEO_MAX_THUMBNAIL_FILES)
+
+    return {
+        'profileName': profileName,
+        'profile': profile,
+        'renditions': ladder[:1] if lazyRenditions else ladder,
+        'ladder': ladder,
+        'lazyRenditions': lazyRenditions,
+        'segmented': segmented,
+        'storyboardSheets': storyboardSheets,
+        'storyboardSize': settingModel.get(
+            PluginSettings.VIDEO_MAX_SMALL_IMAGE_SIZE),
+        'streamInput': settingModel.get(PluginSettings.VIDEO_STREAM_INPUT),
+        'activityIndex': settingModel.get(
+            PluginSettings.VIDEO_ACTIVITY_INDEX),
+        'waveform': settingModel.get(PluginSettings.VIDEO_AUDIO_WAVEFORM),
+        'checkpoint': settingModel.get(PluginSettings.VIDEO_CHECKPOINT),
+        'executor': settingModel.get(PluginSettings.VIDEO_EXECUTOR),
+    }
+
+
+def cacheParams(settings):
+    """
+    Return the subset of the settings that affects the outputs, for use in
+    the deduplication cache key.
+    """
+    return {
+        'profile': settings['profile'],
+        'renditions': settings['renditions'],
+        'segmented': settings['segmented'],
+        'storyboardSheets': settings['storyboardSheets'],
+        'storyboardSize': settings['storyboardSize'],
+        'activityIndex': settings['activityIndex'],
+        'waveform': settings['waveform']
+    }
+
+
+# Fields of an item's video data that refer to outputs of its processing,
+# besides the list of created files.
+OUTPUT_FIELDS = ('renditions', 'keyframeIndex', 'manifest', 'storyboard',
+                 'activity', 'waveform', 'pendingRenditions', 'lastAccess',
+                 'checkpoint')
+
+
+def removeCreatedFiles(itemVideoData, user, keepFileId=None,
+                       keepCheckpoint=False):
+    """
+    Remove the files created by an item's last processing job and forget
+    them, except for the given file (rerunning a job against one of its own
+    outputs is almost certainly user error, but the file is kept anyway).
+
+    :param keepCheckpoint: whether to keep the job's checkpoint and the
+        chunks it lists, for a job that resumes from it.
+    """
+    fileModel = ModelImporter.model('file')
+    kept = []
+    for f in itemVideoData.get('createdFiles', []):
+        if f == str(keepFileId):
+            continue
+
+        theFile = fileModel.load(f, level=AccessType.WRITE, user=user)
+
+        if theFile:
+            if keepCheckpoint and re.match(
+                    CHECKPOINT_NAME_PATTERN, theFile['name']):
+                kept.append(f)
+                continue
+            fileModel.remove(theFile)
+    itemVideoData['createdFiles'] = kept
+    for key in OUTPUT_FIELDS:
+        if key != 'checkpoint' or not keepCheckpoint:
+            itemVideoData.pop(key, None)
+
+
+# The task of the local executor, run by girder_worker's python mode with
+# the job's inputs bound to variables.  The conversion writes to a
+# directory of the job's temporary directory, and each output variable is
+# set to the path of the file the output spec uploads.
+LOCAL_TASK_SCRIPT = '''
+import os
+
+from convert import run_local
+
+_dataDir = os.path.join(_tempdir, 'video')
+os.makedirs(_dataDir)
+run_local(args, _dataDir, globals().get('input'), _job_manager)
+for _id, _name in outputNames.items():
+    globals()[_id] = os.path.join(_dataDir, _name)
+'''
+
+
+def useLocalExecutor(jobKwargs):
+    """
+    Turn the docker task of a processing job into one that girder_worker
+    runs in its own process, which saves creating a container per job.  The
+    captured standard output and error are docker-mode outputs; the local
+    task's prints go to the job log instead.
+
+    :param jobKwargs: the kwargs of the job, modified in place.
+    """
+    task = jobKwargs['task']
+    outputNames = {}
+    outputs = []
+    for output in task['outputs']:
+        if output['id'] in ('_stdout', '_stderr'):
+            jobKwargs['outputs'].pop(output['id'], None)
+            continue
+        outputNames[output['id']] = os.path.basename(output.pop('path'))
+        outputs.append(output)
+
+    containerArgs = task['container_args']
+    for key in ('docker_image', 'progress_pipe', 'a', 'pull_image',
+                'container_args'):
+        task.pop(key, None)
+    task.update({
+        'mode': 'python',
+        'script': LOCAL_TASK_SCRIPT,
+        'outputs': outputs
+    })
+
+    for inputId, value in (('args', containerArgs),
+                           ('outputNames', outputNames)):
+        task['inputs'].append({
+            'id': inputId,
+            'type': 'python',
+            'format': 'object'
+        })
+        jobKwargs['inputs'][inputId] = {
+            'mode': 'inline',
+            'type': 'python',
+            'format': 'object',
+            'data': value
+        }
+
+
+def buildVideoJob(item, inputFile, user, settings, save=True,
+                  parentJob=None, jobId=None, resume=None,
+                  renditionsOnly=False):
+    """
+    Create the girder_worker job that processes a video file.  The job is
+    not scheduled, and the worker specs it runs with are only added by
+    prepareVideoJob when the scheduler dispatches it, so that the tokens
+    they carry cannot expire while the job waits in the queue; everything
+    they are made from is kept in the job's metadata.
+
+    :param item: the item to attach the outputs to.
+    :param inputFile: the file to process.
+    :param user: the user who owns the job.
+    :param settings: the settings from processingSettings.
+    :param save: whether to save the job.  Unsaved jobs can be inserted in
+        bulk by the caller.
+    :param parentJob: an optional parent job.
+    :param jobId: the id to give the job, or None for a new one.
+    :param resume: the id of the checkpoint of an earlier job to resume
+        from, or None.
+    :param renditionsOnly: whether to upload only the renditions and their
+        keyframe indices, for a job that adds renditions to an item that is
+        already processed.
+    :returns: the job document.
+    """
+    jobModel = ModelImporter.model('job', 'jobs')
+
+    jobTitle = 'Video Processing'
+    job = jobModel.createJob(
+        title=jobTitle,
+        type='video',
+        user=user,
+        handler='worker_handler',
+        save=False,
+        parentJob=parentJob
+    )
+    job['_id'] = jobId or ObjectId()
+
+    job['meta'] = job.get('meta', {})
+    job['meta']['video_plugin'] = {
+        'itemId': str(item['_id']),
+        'fileId': str(inputFile['_id']),
+        'segmented': settings['segmented'],
+        'profile': settings['profileName'],
+        'settings': settings
+    }
+    if resume:
+        job['meta']['video_plugin']['resumedFrom'] = str(resume)
+    if renditionsOnly:
+        job['meta']['video_plugin']['renditionsOnly'] = True
+
+    if save:
+        job = jobModel.save(job)
+    return job
+
+
+def prepareVideoJob(job):
+    """
+    Give a processing job the worker specs it runs with, just before it is
+    scheduled: a new token with which the worker reads the input and
+    uploads the outputs as the job's user, and a job token with which it
+    reports its progress.
+
+    :param job: a job from buildVideoJob, which is updated in place and
+        saved.
+    :returns: the job.
+    :raises ValueError: if the item or the file to process no longer
+        exists.
+    """
+    jobModel = ModelImporter.model('job', 'jobs')
+    jobVideoData = job['meta']['video_plugin']
+
+    item = ModelImporter.model('item').load(
+        jobVideoData['itemId'], force=True)
+    inputFile = ModelImporter.model('file').load(
+        jobVideoData['fileId'], force=True)
+    if item is None or inputFile is None:
+        raise ValueError('The item or file processed by job %s no longer '
+                         'exists.' % job['_id'])
+    user = None
+    if job.get('userId'):
+        user = ModelImporter.model('user').load(job['userId'], force=True)
+
+    # It seems like we should be able to use a token without USER_AUTH
+    # in its scope, but I'm not sure how.
+    userToken = ModelImporter.model('token').createToken(
+        user, days=1, scope=TokenScope.USER_AUTH)
+    jobToken = jobModel.createJobToken(job)
+
+    job['kwargs'] = _videoJobKwargs(
+        job, item, inputFile, userToken, jobToken, jobVideoData['settings'],
+        jobVideoData.get('resumedFrom'),
+        jobVideoData.get('renditionsOnly', False))
+    jobModel.update({'_id': job['_id']}, {
+        '$set': {'kwargs': job['kwargs']}}, multi=False)
+    return job
+
+
+def _videoJobKwargs(job, item, inputFile, userToken, jobToken, settings,
+                    resume, renditionsOnly):
+    """
+    Build the kwargs of a processing job: its girder_worker task and the
+    specs of its inputs and outputs.
+    """
+    profile = settings['profile']
+    container = profile['container']
+    renditions = settings['renditions']
+    storyboardSheets = settings['storyboardSheets']
+
+    kwargs = {}
+    kwargs['task'] = {
+        'mode': 'docker',
+
+        # TODO(opadron): replace this once we have a maintained
+        #                image on dockerhub
+        'docker_image': 'ffmpeg_local',
+        'progress_pipe': True,
+        'a': 'b',
+        'pull_image': False,
+        'container_args': [
+            '--renditions', ','.join(str(h) for h in renditions),
+            '--profile', json.dumps(profile),
+            '--storyboard-sheets', str(storyboardSheets),
+            '--storyboard-size', str(settings['storyboardSize'])
+        ],
+        'inputs': [],
+        'outputs': [
+            {
+                'id': '_stdout',
+                'type': 'string',
+                'format': 'text',
+                'target': 'memory'
+            },
+            {
+                'id': '_stderr',
+                'type': 'string',
+                'format': 'text',
+                'target': 'memory'
+            },
+            {
+                'id': 'meta',
+                'type:': 'string',
+                'format': 'text',
+                'target': 'filepath',
+                'path': '/mnt/girder_worker/data/' + META_NAME
+            },
+            {
+                'id': 'metrics',
+                'type:': 'string',
+                'format': 'text',
+                'target': 'filepath',
+                'path': '/mnt/girder_worker/data/' + METRICS_NAME
+            },
+        ]
+    }
+
+    # A streamed input is read by ffmpeg straight from Girder, with range
+    # requests when it seeks, so processing starts at once and the worker
+    # never holds a copy of the source.  Otherwise girder_worker downloads
+    # the whole file before the conversion starts.
+    if settings['streamInput']:
+        kwargs['task']['container_args'].extend([
+            '--input-url', '%s/file/%s/download?token=%s' % (
+                workerUtils.getWorkerApiUrl(), inputFile['_id'],
+                userToken['_id'])
+        ])
+        kwargs['inputs'] = {}
+    else:
+        _, itemExt = os.path.splitext(item['name'])
+
+        kwargs['task']['inputs'].append({
+            'id': 'input',
+            'type': 'string',
+            'format': 'text',
+            'target': 'filepath'
+        })
+        kwargs['inputs'] = {
+            'input': workerUtils.girderInputSpec(
+                inputFile,
+                resourceType='file',
+                token=userToken,
+                name='input' + itemExt,
+                dataType='string',
+                dataFormat='text'
+            )
+        }
+
+    kwargs['outputs'] = {
+        '_stdout': workerUtils.girderOutputSpec(
+            item,
+            parentType='item',
+            token=userToken,
+            name='processing_stdout.txt',
+            dataType='string',
+            dataFormat='text',
+            reference='videoPlugin'
+        ),
+        '_stderr': workerUtils.girderOutputSpec(
+            item,
+            parentType='item',
+            token=userToken,
+            name='processing_stderr.txt',
+            dataType='string',
+            dataFormat='text',
+            reference='videoPlugin'
+        ),
+        'meta': workerUtils.girderOutputSpec(
+            item,
+            parentType='item',
+            token=userToken,
+            name=META_NAME,
+            dataType='string',
+            dataFormat='text',
+            reference='videoPlugin'
+        ),
+        'metrics': workerUtils.girderOutputSpec(
+            item,
+            parentType='item',
+            token=userToken,
+            name=METRICS_NAME,
+            dataType='string',
+            dataFormat='text',
+            reference='videoPlugin'
+        ),
+    }
+
+    # Every rendition of the ladder and its keyframe index is declared as
+    # an output; the conversion script leaves renditions larger than the
+    # source empty, and those are discarded when they are uploaded.
+    # Segmented jobs upload their segments themselves as they are
+    # produced, and so do checkpointed jobs with their finished chunks.
+    girderArgs = [
+        '--girder-api-url', workerUtils.getWorkerApiUrl(),
+        '--girder-token', userToken['_id'],
+        '--item-id', str(item['_id'])
+    ]
+    if settings['segmented']:
+        kwargs['task']['container_args'].extend(
+            ['--segmented'] + girderArgs)
+        renditions = []
+    elif settings['checkpoint']:
+        kwargs['task']['container_args'].extend(
+            ['--checkpoint'] + girderArgs)
+        if resume:
+            kwargs['task']['container_args'].extend(
+                ['--resume-checkpoint', str(resume)])
+
+    fileOutputs = []
+    for height in renditions:
+        fileOutputs.append((
+            'rendition_%d' % height,
+            RENDITION_NAME % (height, container)))
+        fileOutputs.append(
+            ('keyframes_%d' % height, KEYFRAME_INDEX_NAME % height))
+
+    # Storyboard sheets are declared up to the configured maximum; the
+    # conversion script writes as many as the video's length needs.
+    if storyboardSheets:
+        fileOutputs.append(('storyboard', STORYBOARD_INDEX_NAME))
+        for sheet in range(1, storyboardSheets + 1):
+            fileOutputs.append((
+                'storyboard_%d' % sheet, STORYBOARD_NAME % sheet))
+
+    if settings['activityIndex']:
+        kwargs['task']['container_args'].append('--activity-index')
+        fileOutputs.append(('activity', ACTIVITY_INDEX_NAME))
+    if settings['waveform']:
+        kwargs['task']['container_args'].append('--waveform')
+        fileOutputs.append(('waveform', WAVEFORM_NAME))
+
+    for outputId, outputName in fileOutputs:
+        kwargs['task']['outputs'].append({
+            'id': outputId,
+            'type:': 'string',
+            'format': 'text',
+            'target': 'filepath',
+            'path': '/mnt/girder_worker/data/' + outputName
+        })
+
+        kwargs['outputs'][outputId] = workerUtils.girderOutputSpec(
+            item,
+            parentType='item',
+            token=userToken,
+            name=outputName,
+            dataType='string',
+            dataFormat='text',
+            reference='videoPlugin'
+        )
+
+    if renditionsOnly:
+        task = kwargs['task']
+        task['outputs'] = [
+            output for output in task['outputs']
+            if output['id'].startswith(('rendition_', 'keyframes_'))]
+        for outputId in list(kwargs['outputs']):
+            if not outputId.startswith(('rendition_', 'keyframes_')):
+                del kwargs['outputs'][outputId]
+
+    if settings['executor'] == 'local':
+        useLocalExecutor(kwargs)
+
+    kwargs['jobInfo'] = workerUtils.jobInfoSpec(
+        job=job,
+        token=jobToken,
+        logPrint=True)
+    return kwargs
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import re
+import threading
+import time
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+from girder import logger
+from girder.utility.model_importer import ModelImporter
+
+from .constants import JobStatus, PluginSettings
+from .processing import buildVideoJob, processingSettings
+from .scheduler import DEFAULT_PRIORITY, dispatch, queueJob
+from .stream import forgetRenditionFile, renditionHeights
+
+# Marks a lazy rendition whose job failed; it is not requested again until
+# the item is reprocessed.
+RENDITION_FAILED = 'failed'
+
+# Seconds between two passes of the evictor.
+EVICTION_INTERVAL = 10 * 60
+
+# Number of items and files read at once by the evictor.
+EVICTION_BATCH_SIZE = 500
+
+_evictorThread = None
+_evictorLock = threading.Lock()
+
+
+def _height(label):
+    return int(re.match(r'^(\d+)p$', label).group(1))
+
+
+def wantedLabel(item, height, ladder):
+    """
+    Return the rendition that best serves a requested height: the smallest
+    one that is at least as tall, or the tallest one otherwise.  Both the
+    renditions the item has, at their actual heights, and those of the
+    ladder that could be made are considered; renditions taller than the
+    source are never made.
+
+    :param item: the processed video item.
+    :param height: the requested height.
+    :param ladder: the heights of the rendition ladder.
+    :returns: a rendition label such as '720p', or None if the height of the
+        source is not known.
+    """
+    sourceHeight = item.get('video', {}).get('meta', {}).get(
+        'video', {}).get('height')
+    if not sourceHeight:
+        return None
+    heights = {'%dp' % h: h for h in ladder if h <= sourceHeight}
+    heights.update(renditionHeights(item))
+    if not heights:
+        return None
+    labels = sorted(heights, key=lambda label: (heights[label], label))
+    return next((label for label in labels if heights[label] >= height),
+                labels[-1])
+
+
+def requestRendition(item, label):
+    """
+    Make sure a rendition of a processed item exists or is being made.  The
+    item is claimed with an atomic update, so concurrent requests for the
+    same rendition share a single job.  The job is owned by the user who
+    processed the item, and uses the same encoding profile.
+
+    :param item: the processed video item.
+    :param label: the rendition, from wantedLabel.
+    :returns: the id of the job making the rendition, or None if the
+        rendition exists, failed, or cannot be made.
+    """
+    itemModel = ModelImporter.model('item')
+    jobModel = ModelImporter.model('job', 'jobs')
+    itemVideoData = item.get('video', {})
+    if label in itemVideoData.get('renditions', {}):
+        return None
+
+    jobId = ObjectId()
+    claimed = itemModel.collection.find_one_and_update({
+        '_id': item['_id'],
+        'video.meta': {'$exists': True},
+        'video.renditions.' + label: {'$exists': False},
+        'video.pendingRenditions.' + label: {'$exists': False}
+    }, {
+        '$set': {'video.pendingRenditions.' + label: str(jobId)}
+    }, return_document=ReturnDocument.AFTER)
+    if claimed is None:
+        current = itemModel.findOne(
+            {'_id': item['_id']}, fields=['video.pendingRenditions'])
+        pending = (current or {}).get('video', {}).get(
+            'pendingRenditions', {}).get(label)
+        return pending if pending != RENDITION_FAILED else None
+
+    # Only a job that ran and failed marks the rendition as failed; if the
+    # job cannot even be made, the next request tries again.
+    try:
+        job = _buildRenditionJob(claimed, label, jobId)
+    except Exception:
+        _releaseClaim(item['_id'], label, jobId)
+        raise
+
+    jobModel.save(job)
+    dispatch()
+    logger.info('Created job %s for rendition %s of item %s' % (
+        jobId, label, item['_id']))
+    return str(jobId)
+
+
+def _buildRenditionJob(item, label, jobId):
+    jobModel = ModelImporter.model('job', 'jobs')
+    fileModel = ModelImporter.model('file')
+    itemVideoData = item['video']
+
+    # Items that reused the results of another item have no job of their
+    # own; their renditions are made by the item's creator, with the
+    # profile of the job whose results were reused.
+    originalJob = None
+    if itemVideoData.get('jobId'):
+        originalJob = jobModel.load(itemVideoData['jobId'], force=True)
+    userId = (originalJob or {}).get('userId') or item.get('creatorId')
+    if originalJob is None and itemVideoData.get('cachedFrom', {}).get(
+            'jobId'):
+        originalJob = jobModel.load(
+            itemVideoData['cachedFrom']['jobId'], force=True)
+
+    user = ModelImporter.model('user').load(userId, force=True)
+    inputFile = None
+    if itemVideoData.get('fileId'):
+        inputFile = fileModel.load(itemVideoData['fileId'], force=True)
+    if inputFile is None:
+        # Results reused before the source file was recorded.
+        inputFile = fileModel.findOne({
+            'itemId': item['_id'],
+            '_id': {'$nin': [ObjectId(f) for f in itemVideoData.get(
+                'createdFiles', [])]}
+        })
+    if user is None or inputFile is None:
+        raise ValueError('Item %s has no user or source file to make '
+                         'rendition %s with.' % (item['_id'], label))
+
+    profileName = (originalJob or {}).get('meta', {}).get(
+        'video_plugin', {}).get('profile')
+    settings = processingSettings(profileName)
+    settings.update({
+        'renditions': [_height(label)],
+        'segmented': False,
+        'storyboardSheets': 0,
+        'activityIndex': False,
+        'waveform': False,
+        'checkpoint': False
+    })
+
+    job = buildVideoJob(item, inputFile, user, settings, save=False,
+                        jobId=jobId, renditionsOnly=True)
+    job['meta']['video_plugin']['lazyRendition'] = label
+    return queueJob(job, DEFAULT_PRIORITY)
+
+
+def _releaseClaim(itemId, label, jobId, value=None):
+    """
+    Clear the pending entry of a rendition, or replace it with a value, if
+    it still belongs to the given job.
+    """
+    field = 'video.pendingRenditions.' + label
+    update = {'$set': {field: value}} if value else {'$unset': {field: ''}}
+    ModelImporter.model('item').update(
+        {'_id': ObjectId(itemId), field: str(jobId)}, update, multi=False)
+
+
+def finalizeRendition(jobId, itemId, label, status):
+    """
+    Record the end of a job that made a lazy rendition.  Its outputs are
+    registered on the item as they are uploaded, so only the pending entry
+    is left to clear; a failed rendition stays marked so that requests for
+    it do not start a new job each time.
+    """
+    if status == JobStatus.SUCCESS:
+        _releaseClaim(itemId, label, jobId)
+    else:
+        logger.warning('Job %s for rendition %s of item %s ended with '
+                       'status %s' % (jobId, label, itemId, status))
+        _releaseClaim(itemId, label, jobId, RENDITION_FAILED)
+
+
+def _evictable(itemVideoData):
+    """
+    List the renditions of an item that may be evicted, as tuples of the
+    label, the rendition file id and the keyframe index file id.  The
+    smallest rendition is the item's base proxy and is always kept, and so
+    is the processed source file, should it also be a rendition.
+    """
+    renditions = itemVideoData.get('renditions', {})
+    created = set(itemVideoData.get('createdFiles', []))
+    labels = sorted(renditions, key=_height)
+    return [
+        (label, renditions[label],
+         itemVideoData.get('keyframeIndex', {}).get(label))
+        for label in labels[1:]
+        if renditions[label] in created and
+        renditions[label] != itemVideoData.get('fileId')
+    ]
+
+
+def evictRenditions(quota):
+    """
+    Remove the least recently used renditions until the files created by
+    processing take no more than the quota on each assetstore.  Only
+    renditions above an item's base proxy, and their keyframe indices, are
+    removed; they are made again when they are next requested.  Uploaded
+    files are never removed.
+
+    :param quota: the number of bytes allowed per assetstore.
+    :returns: the number of renditions removed.
+    """
+    itemModel = ModelImporter.model('item')
+    fileModel = ModelImporter.model('file')
+
+    usage = {}
+    candidates = []
+
+    def readFiles(fileIds, itemsByFile):
+        files = {}
+        for file in fileModel.find(
+                {'_id': {'$in': [ObjectId(f) for f in fileIds]}},
+                fields=['size', 'assetstoreId', 'created']):
+            files[str(file['_id'])] = file
+            assetstoreId = file.get('assetstoreId')
+            usage[assetstoreId] = usage.get(assetstoreId, 0) + file.get(
+                'size', 0)
+        for itemId, itemVideoData in itemsByFile:
+            lastAccess = itemVideoData.get('lastAccess', {})
+            for label, fileId, indexId in _evictable(itemVideoData):
+                file = files.get(fileId)
+                if file is None:
+                    continue
+                size = file.get('size', 0) + files.get(indexId, {}).get(
+                    'size', 0)
+                candidates.append((
+                    lastAccess.get(fileId) or file.get('created'),
+                    file.get('assetstoreId'), size, itemId, label, fileId,
+                    indexId))
+
+    fileIds = []
+    items = []
+    for item in itemModel.find(
+            {'video.createdFiles.0': {'$exists': True}},
+            fields=['video.createdFiles', 'video.renditions',
+                    'video.keyframeIndex', 'video.lastAccess',
+                    'video.fileId'],
+            batch_size=EVICTION_BATCH_SIZE):
+        fileIds.extend(item['video']['createdFiles'])
+        items.append((item['_id'], item['video']))
+        if len(fileIds) >= EVICTION_BATCH_SIZE:
+            readFiles(fileIds, items)
+            fileIds, items = [], []
+    if fileIds:
+        readFiles(fileIds, items)
+
+    evicted = 0
+    # Renditions that were never accessed, nor dated, go first.
+    candidates.sort(key=lambda candidate: (
+        candidate[0] is not None, candidate[0] or 0))
+    for _, assetstoreId, size, itemId, label, fileId, indexId in candidates:
+        if usage.get(assetstoreId, 0) <= quota:
+            continue
+        # The item is updated first, and only if it still lists the
+        # rendition, so that nothing is served from a removed file and a
+        # rendition made meanwhile is kept.
+        removed = [fileId] + ([indexId] if indexId else [])
+        result = itemModel.collection.update_one({
+            '_id': itemId,
+            'video.renditions.' + label: fileId
+        }, {
+            '$unset': {
+                'video.renditions.' + label: '',
+                'video.keyframeIndex.' + label: '',
+                'video.lastAccess.' + fileId: ''
+            },
+            '$pull': {'video.createdFiles': {'$in': removed}}
+        })
+        if not result.modified_count:
+            continue
+        for removedId in removed:
+            file = fileModel.load(removedId, force=True)
+            if file is not None:
+                fileModel.remove(file)
+            forgetRenditionFile(removedId)
+        usage[assetstoreId] -= size
+        evicted += 1
+        logger.info('Evicted rendition %s of item %s' % (label, itemId))
+    return evicted
+
+
+def _evictPeriodically():
+    settingModel = ModelImporter.model('setting')
+    while True:
+        time.sleep(EVICTION_INTERVAL)
+        try:
+            quota = settingModel.get(PluginSettings.VIDEO_RENDITION_QUOTA)
+            if quota:
+                evictRenditions(quota)
+        except Exception:
+            logger.exception('Video rendition eviction failed')
+
+
+def startEvictor():
+    """
+    Start the thread that evicts renditions over the quota.  The quota is
+    read on every pass, so it can be changed, or set to 0 to disable
+    eviction, without restarting the server.
+    """
+    global _evictorThread
+    with _evictorLock:
+        if _evictorThread is None:
+            _evictorThread = threading.Thread(target=_evictPeriodically)
+            _evictorThread.daemon = True
+            _evictorThread.start()
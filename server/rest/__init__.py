@@ -17,7 +17,9 @@
 #  limitations under the License.
 ##############################################################################
 
+from .folder import addFolderRoutes
+from .metrics import Video
 from .video import addItemRoutes
 
 
-__all__ = ('addItemRoutes',)
+__all__ = ('addFolderRoutes', 'addItemRoutes', 'Video')
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+##############################################################################
+
+from girder.api import access
+from girder.api.describe import autoDescribeRoute, Description
+from girder.api.rest import RestException, boundHandler, getCurrentUser
+
+from girder.constants import AccessType
+from girder.models.model_base import ValidationException
+
+from ..processing import processingSettings
+
+
+def addFolderRoutes(folder):
+    routes = createRoutes(folder)
+    folder.route('PUT', (':id', 'video'), routes['processFolderVideos'])
+
+
+def createRoutes(folder):
+    @autoDescribeRoute(
+        Description('Create a job that processes every video in a folder.')
+        .notes('The returned job creates one processing job per video and '
+               'schedules them in throttled batches; poll it to follow the '
+               'progress.  Items that already have a processing job are '
+               'skipped unless force is set.')
+        .param('id', 'Id of the folder.', paramType='path')
+        .param('recursive', 'Also process the videos of subfolders.',
+               required=False, dataType='boolean', default=False)
+        .param('force', 'Reprocess items that already have a job.',
+               required=False, dataType='boolean', default=False)
+        .param('segmented', 'Produce segmented DASH presentations.',
+               required=False, dataType='boolean', default=False)
+        .param('profile', 'Name of the encoding profile to use.  Defaults '
+               'to the video.default_profile setting.', required=False)
+        .errorResponse()
+        .errorResponse('Read access was denied on the folder.', 403)
+    )
+    @access.user
+    @boundHandler(folder)
+    def processFolderVideos(self, id, recursive, force, segmented, profile,
+                            params):
+        user = getCurrentUser()
+        folder = self.model('folder').load(
+            id, user=user, level=AccessType.READ)
+
+        # Validate the profile now rather than in the background job.
+        try:
+            processingSettings(profile, segmented)
+        except ValidationException as exc:
+            raise RestException(str(exc))
+
+        jobModel = self.model('job', 'jobs')
+        job = jobModel.createLocalJob(
+            module='girder.plugins.video.batch',
+            function='run',
+            title='Video processing of folder %s' % folder['name'],
+            type='video_batch',
+            user=user,
+            public=False,
+            handler='local',
+            asynchronous=True,
+            kwargs={
+                'folderId': str(folder['_id']),
+                'recursive': recursive,
+                'force': force,
+                'segmented': segmented,
+                'profile': profile
+            })
+        jobModel.scheduleJob(job)
+
+        result = {
+            'video': {
+                'jobCreated': True,
+                'message': 'Batch processing job created.'
+            }
+        }
+
+        result.update(job)
+        return result
+
+    return {
+        'processFolderVideos': processFolderVideos
+    }
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+##############################################################################
+
+from girder.api import access
+from girder.api.describe import autoDescribeRoute, Description
+from girder.api.rest import Resource, setRawResponse, setResponseHeader
+
+from ..metrics import METRICS_CACHE_SECONDS, METRICS_JOB_LIMIT, \
+                      prometheusMetrics
+
+
+class Video(Resource):
+    def __init__(self):
+        super(Video, self).__init__()
+        self.resourceName = 'video'
+        self.route('GET', ('metrics',), self.getMetrics)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Get processing metrics in the Prometheus text format.')
+        .notes('Job counts by status, and summaries of the encode speed, '
+               'the queue wait and the time of each stage over the %d most '
+               'recent processing jobs.  The values are recomputed at most '
+               'every %d seconds.' % (METRICS_JOB_LIMIT,
+                                      METRICS_CACHE_SECONDS))
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getMetrics(self, params):
+        setResponseHeader('Content-Type', 'text/plain; version=0.0.4')
+        setRawResponse()
+        return prometheusMetrics()
@@ -17,21 +17,32 @@
 #  limitations under the License.
 ##############################################################################
 
-import os.path
+import cherrypy
 
 from bson.objectid import ObjectId
 
 from girder import logger
 from girder.api import access
 from girder.api.describe import autoDescribeRoute, Description
-from girder.api.rest import filtermodel, RestException, \
-                            boundHandler, getCurrentUser
+from girder.api.rest import RestException, boundHandler, getCurrentUser, \
+                            setRawResponse, setResponseHeader
 
-from girder.constants import AccessType, TokenScope
-from girder.plugins.worker import utils as workerUtils
+from girder.constants import AccessType
+from girder.models.model_base import ValidationException
 # from girder.utility.model_importer import ModelImporter
 
-from ..constants import JobStatus
+from ..background import executor
+from ..constants import JobStatus, PluginSettings, STORYBOARD_INDEX_NAME
+from ..dedup import cacheKey, copyProcessedResults, findProcessedItem, \
+                    storeCacheKey
+from ..frames import BATCH_FORMATS, FRAME_FORMATS, MAX_BATCH_FRAMES, \
+                     batchFrameNumbers, extractFrames, getFrame
+from ..processing import OUTPUT_FIELDS, buildVideoJob, cacheParams, \
+                         processingSettings, removeCreatedFiles
+from ..renditions import requestRendition, wantedLabel
+from ..scheduler import DEFAULT_PRIORITY, dispatch, queueJob
+from ..stream import STREAM_MAX_AGE, loadRenditionFile, recordAccess, \
+                     selectRendition
 
 
 def addItemRoutes(item):
@@ -40,28 +51,91 @@ def addItemRoutes(item):
     item.route('PUT', (':id', 'video'), routes['processVideo'])
     item.route('DELETE', (':id', 'video'), routes['deleteProcessedVideo'])
     item.route('GET', (':id', 'video', 'frame'), routes['getVideoFrame'])
+    item.route('POST', (':id', 'video', 'frames'), routes['getVideoFrames'])
+    item.route('GET', (':id', 'video', 'stream'), routes['streamVideo'])
+    item.route('GET', (':id', 'video', 'dash', ':name'),
+               routes['getDashFile'])
+    item.route('GET', (':id', 'video', 'storyboard', ':name'),
+               routes['getStoryboardFile'])
 
 def createRoutes(item):
+    def downloadCreatedFile(self, id, name, kind):
+        """
+        Download a file that was created by the item's processing job, looked
+        up by name.  This lets manifests and indices refer to their parts
+        with relative URLs.
+        """
+        user = getCurrentUser()
+        item = self.model('item').load(id, user=user, level=AccessType.READ)
+
+        createdFiles = item.get('video', {}).get('createdFiles', [])
+        createdFile = self.model('file').findOne({
+            'itemId': item['_id'],
+            'name': name,
+            '_id': {'$in': [ObjectId(f) for f in createdFiles]}
+        })
+        if createdFile is None:
+            raise RestException(
+                'Item with id=%s has no %s file named %s' % (id, kind, name),
+                code=404)
+
+        return self.model('file').download(createdFile)
+
     @autoDescribeRoute(
         Description('Return video metadata if it exists.')
+        .notes('The metadata is probed by the processing job and stored in '
+               'the item, so it is also part of item listings.  Responses '
+               'carry an ETag derived from the job that produced them and '
+               'honor If-None-Match.')
         .param('id', 'Id of the item.', paramType='path')
         .errorResponse()
         .errorResponse('Read access was denied on the item.', 403)
+        .errorResponse('The item has no video metadata yet.', 404)
     )
     @access.public
     @boundHandler(item)
     def getVideoMetadata(self, id, params):
-        return {
-            'a': 1,
-            'b': 2
-        }
+        user = getCurrentUser()
+        item = self.model('item').load(id, user=user, level=AccessType.READ)
+
+        itemVideoData = item.get('video', {})
+        meta = itemVideoData.get('meta')
+        if meta is None:
+            raise RestException(
+                'Item with id=%s has no video metadata.' % id, code=404)
+
+        jobId = itemVideoData.get('cachedFrom', {}).get(
+            'jobId', itemVideoData.get('jobId'))
+        if jobId:
+            etag = '"%s"' % jobId
+            setResponseHeader('ETag', etag)
+            ifNoneMatch = cherrypy.request.headers.get('If-None-Match', '')
+            if etag in [tag.strip() for tag in ifNoneMatch.split(',')] or \
+                    ifNoneMatch.strip() == '*':
+                cherrypy.response.status = 304
+                setRawResponse()
+                return ''
+
+        return meta
 
     @autoDescribeRoute(
         Description('Create a girder-worker job to process the given video.')
+        .notes('If the last processing job of the item failed after it '
+               'checkpointed part of its transcode, the new job resumes from '
+               'the checkpoint unless force is set.')
         .param('id', 'Id of the item.', paramType='path')
         .param('fileId', 'Id of the file to use as the video.', required=False)
         .param('force', 'Force the creation of a new job.', required=False,
             dataType='boolean', default=False)
+        .param('segmented', 'Produce a segmented DASH presentation whose '
+               'segments are uploaded while the video is being encoded.',
+               required=False, dataType='boolean', default=False)
+        .param('profile', 'Name of the encoding profile to use.  Defaults '
+               'to the video.default_profile setting.', required=False)
+        .param('priority', 'Scheduling priority of the job; jobs with a '
+               'higher priority start first.  Only administrators may raise '
+               'it above the default.', required=False, dataType='integer',
+               default=DEFAULT_PRIORITY)
         .errorResponse()
         .errorResponse('Read access was denied on the item.', 403)
     )
@@ -69,11 +143,16 @@ def createRoutes(item):
     @boundHandler(item)
     def processVideo(self, id, params):
         force = params['force']
-        user, userToken = getCurrentUser(True)
+        segmented = params['segmented']
+        priority = params['priority']
+        user = getCurrentUser()
+
+        if priority > DEFAULT_PRIORITY and not (user or {}).get('admin'):
+            raise RestException('Only administrators may raise the priority '
+                                'of a processing job.', code=403)
 
         itemModel = self.model('item')
         fileModel = self.model('file')
-        tokenModel = self.model('token')
         jobModel = self.model('job', 'jobs')
 
         item = itemModel.load(id, user=user, level=AccessType.READ)
@@ -104,6 +183,16 @@ def createRoutes(item):
                 result.update(job)
                 return result
 
+            if job is None and itemVideoData.get('cachedFrom'):
+                return {
+                    'video': {
+                        'jobCreated': False,
+                        'message': 'Processed results already reused from '
+                                   'item %s.' %
+                                   itemVideoData['cachedFrom']['itemId']
+                    }
+                }
+
         # if user provided fileId, use that one
         fileId = params.get('fileId')
         if fileId is not None:
@@ -122,7 +211,8 @@ def createRoutes(item):
             # If we're *re*running a processing job (force=True), look
             # for the fileId used by the old job.
             if force and job:
-                fileId = job.get('meta', {}).get('video', {}).get('fileId')
+                fileId = job.get('meta', {}).get(
+                    'video_plugin', {}).get('fileId')
                 if fileId:
                     # ensure the provided fileId is valid, but in this case,
                     # don't raise an exception if it is not -- just discard the
@@ -140,162 +230,125 @@ def createRoutes(item):
 
             # if there *are* no files, bail
             if inputFile is None:
-                raise RestException('item %s has no files' % itemId)
+                raise RestException('item %s has no files' % id)
 
             fileId = inputFile['_id']
 
+        try:
+            settings = processingSettings(params.get('profile'), segmented)
+        except ValidationException as exc:
+            raise RestException(str(exc))
+
+        # Claim the item for the new job with a conditional update, so that
+        # concurrent requests for the same item coalesce onto the job of
+        # whichever claims it first instead of each starting a transcode or
+        # copying results.  From here on, the item is only written while
+        # the claim holds, and only the fields that change.
+        newJobId = ObjectId()
+        claimed = itemModel.collection.find_one_and_update(
+            {'_id': item['_id'], 'video.jobId': jobId},
+            {'$set': {'video.jobId': str(newJobId)}})
+        if claimed is None:
+            current = itemModel.findOne(
+                {'_id': item['_id']}, fields=['video.jobId'])
+            currentJobId = (current or {}).get('video', {}).get('jobId')
+            result = {
+                'video': {
+                    'jobCreated': False,
+                    'jobId': currentJobId,
+                    'message': 'Processing job already created.'
+                }
+            }
+            if currentJobId is not None:
+                job = jobModel.load(
+                    currentJobId, level=AccessType.READ, user=user)
+                if job is not None:
+                    result.update(job)
+            return result
+        itemVideoData = claimed.get('video', {})
+
+        # Identical content processed with identical parameters gives
+        # identical results, so reuse the results of any other item that
+        # has already been processed that way instead of transcoding again.
+        # Only a hash stored on the file is used here.  Videos are hashed in
+        # the background as they are uploaded; a file without a hash yet is
+        # hashed once its job is created.
+        key = cacheKey(inputFile, cacheParams(settings), compute=False)
+        if key is not None and not force:
+            source = findProcessedItem(key, exclude=item['_id'])
+            if source is not None and copyProcessedResults(
+                    source, item, user, key, inputFile, str(newJobId)):
+                return {
+                    'video': {
+                        'jobCreated': False,
+                        'message': 'Processed results reused from item %s.'
+                                   % source['_id']
+                    }
+                }
+
         # if we are *re*running a processing job (force=True), remove all files
         # from this item that were created by the last processing job...
         #
         # ...unless (for some reason) the user is running the job against that
         # particular file (this is almost certainly user error, but for now,
         # we'll just keep the file around).
+        createdFiles = set(itemVideoData.get('createdFiles', []))
         if force:
-            fileIdList = itemVideoData.get('createdFiles', [])
-            for f in fileIdList:
-                if f == fileId:
-                    continue
-
-                theFile = fileModel.load(
-                        f, level=AccessType.WRITE, user=user)
-
-                if theFile:
-                    fileModel.remove(theFile)
-            itemVideoData['createdFiles'] = []
-
-        # begin construction of the actual job
-        if not userToken:
-            # It seems like we should be able to use a token without USER_AUTH
-            # in its scope, but I'm not sure how.
-            userToken = tokenModel.createToken(
-                user, days=1, scope=TokenScope.USER_AUTH)
-
-        jobTitle = 'Video Processing'
-        job = jobModel.createJob(
-            title=jobTitle,
-            type='video',
-            user=user,
-            handler='worker_handler'
-        )
-        jobToken = jobModel.createJobToken(job)
-
-        job['kwargs'] = job.get('kwargs', {})
-        job['kwargs']['task'] = {
-            'mode': 'docker',
-
-            # TODO(opadron): replace this once we have a maintained
-            #                image on dockerhub
-            'docker_image': 'ffmpeg_local',
-            'progress_pipe': True,
-            'a': 'b',
-            'pull_image': False,
-            'inputs': [
-                {
-                    'id': 'input',
-                    'type': 'string',
-                    'format': 'text',
-                    'target': 'filepath'
-                }
-            ],
-            'outputs': [
-                {
-                    'id': '_stdout',
-                    'type': 'string',
-                    'format': 'text',
-                    'target': 'memory'
-                },
-                {
-                    'id': '_stderr',
-                    'type': 'string',
-                    'format': 'text',
-                    'target': 'memory'
-                },
-                {
-                    'id': 'source',
-                    'type:': 'string',
-                    'format': 'text',
-                    'target': 'filepath',
-                    'path': '/mnt/girder_worker/data/source.webm'
-                },
-                {
-                    'id': 'meta',
-                    'type:': 'string',
-                    'format': 'text',
-                    'target': 'filepath',
-                    'path': '/mnt/girder_worker/data/meta.json'
-                },
-            ]
-        }
-
-        _, itemExt = os.path.splitext(item['name'])
-
-        job['kwargs']['inputs'] = {
-            'input': workerUtils.girderInputSpec(
-                inputFile,
-                resourceType='file',
-                token=userToken,
-                name='input' + itemExt,
-                dataType='string',
-                dataFormat='text'
-            )
-        }
-
-        job['kwargs']['outputs'] = {
-            '_stdout': workerUtils.girderOutputSpec(
-                item,
-                parentType='item',
-                token=userToken,
-                name='processing_stdout.txt',
-                dataType='string',
-                dataFormat='text',
-                reference='videoPlugin'
-            ),
-            '_stderr': workerUtils.girderOutputSpec(
-                item,
-                parentType='item',
-                token=userToken,
-                name='processing_stderr.txt',
-                dataType='string',
-                dataFormat='text',
-                reference='videoPlugin'
-            ),
-            'source': workerUtils.girderOutputSpec(
-                item,
-                parentType='item',
-                token=userToken,
-                name='source.webm',
-                dataType='string',
-                dataFormat='text',
-                reference='videoPlugin'
-            ),
-            'meta': workerUtils.girderOutputSpec(
-                item,
-                parentType='item',
-                token=userToken,
-                name='meta.json',
-                dataType='string',
-                dataFormat='text',
-                reference='videoPlugin'
-            ),
-        }
-
-        job['kwargs']['jobInfo'] = workerUtils.jobInfoSpec(
-            job=job,
-            token=jobToken,
-            logPrint=True)
-
-        job['meta'] = job.get('meta', {})
-        job['meta']['video_plugin'] = {
-            'itemId': id,
-            'fileId': fileId
+            removeCreatedFiles(itemVideoData, user, keepFileId=fileId)
+
+        # A job that failed part way through a checkpointed transcode of the
+        # same file is resumed from its checkpoint, so that only the chunks
+        # it had not finished are encoded; its other outputs are discarded.
+        resume = None
+        if (not force and job is not None and settings['checkpoint'] and
+                not segmented and itemVideoData.get('checkpoint') and
+                itemVideoData.get('fileId') == str(fileId)):
+            resume = itemVideoData['checkpoint']
+            removeCreatedFiles(itemVideoData, user, keepFileId=fileId,
+                               keepCheckpoint=True)
+
+        # begin construction of the actual job; its tokens are created when
+        # the scheduler starts it.
+        job = queueJob(buildVideoJob(
+            item, inputFile, user, settings, save=False, jobId=newJobId,
+            resume=resume), priority)
+
+        # The item is updated before the job is scheduled, so that the
+        # outputs of the job cannot be registered before it is.  Removed
+        # files are pulled from the created files rather than the list
+        # being replaced, which would lose concurrent registrations.
+        update = {
+            '$set': {'video.fileId': str(fileId)},
+            '$unset': {'video.cachedFrom': '', 'video.jobStatus': '',
+                       'video.meta': ''}
         }
+        if key is not None:
+            update['$set']['video.cacheKey'] = key
+        else:
+            update['$unset']['video.cacheKey'] = ''
+        removed = createdFiles - set(itemVideoData.get('createdFiles', []))
+        if removed:
+            update['$pull'] = {'video.createdFiles': {'$in': list(removed)}}
+        if force or resume is not None:
+            update['$unset'].update({
+                'video.' + field: '' for field in OUTPUT_FIELDS
+                if field not in itemVideoData})
+        claimed = itemModel.collection.update_one(
+            {'_id': item['_id'], 'video.jobId': str(newJobId)}, update)
+        if not claimed.matched_count:
+            return {
+                'video': {
+                    'jobCreated': False,
+                    'message': 'The item was claimed by another request.'
+                }
+            }
 
+        # The scheduler starts the job once the concurrency limits allow.
         job = jobModel.save(job)
-        jobModel.scheduleJob(job)
-
-        itemVideoData['jobId'] = str(job['_id'])
-        item['video'] = itemVideoData
-        itemModel.save(item)
+        dispatch()
+        if key is None:
+            executor.submit(storeCacheKey, item['_id'], job['_id'],
+                            inputFile['_id'], cacheParams(settings))
 
         result = {
             'video': {
@@ -322,21 +375,208 @@ def createRoutes(item):
 
     @autoDescribeRoute(
         Description('Get a single frame from the given video.')
+        .notes('Frames are decoded from the smallest processed rendition that '
+               'is at least as tall as the requested height, and are cached.')
         .param('id', 'Id of the item.', paramType='path')
         .param('time', 'Point in time from which to sample the frame.',
-               required=True)
+               required=True, dataType='number')
+        .param('width', 'Width of the frame in pixels.', required=False,
+               dataType='integer')
+        .param('height', 'Height of the frame in pixels.', required=False,
+               dataType='integer')
+        .param('format', 'Image format of the frame.', required=False,
+               enum=sorted(FRAME_FORMATS), default='jpeg')
         .errorResponse()
         .errorResponse('Read access was denied on the item.', 403)
     )
     @access.public
     @boundHandler(item)
-    def getVideoFrame(params):
-        pass
+    def getVideoFrame(self, id, time, width, height, format, params):
+        user = getCurrentUser()
+        item = self.model('item').load(id, user=user, level=AccessType.READ)
+
+        if time < 0:
+            raise RestException('time must not be negative.')
+
+        try:
+            data, mimeType = getFrame(item, time, width, height, format)
+        except RuntimeError as exc:
+            raise RestException(str(exc))
+
+        setResponseHeader('Content-Type', mimeType)
+        setRawResponse()
+        return data
+
+    @autoDescribeRoute(
+        Description('Get many frames from the given video at once.')
+        .notes('The requested frames are sorted and deduplicated, and decoded '
+               'in a single forward pass that only seeks across long gaps.  '
+               'Archives hold one image per frame, named after its frame '
+               'number, and a frames.json index; npy is a single array of '
+               'shape (frames, height, width, 3).  The frame numbers are also '
+               'listed in the X-Video-Frames header.  At most %d frames can '
+               'be requested at once.' % MAX_BATCH_FRAMES)
+        .param('id', 'Id of the item.', paramType='path')
+        .jsonParam('times', 'A JSON list of times in seconds.',
+                   paramType='formData', required=False, requireArray=True)
+        .jsonParam('frames', 'A JSON list of frame numbers.',
+                   paramType='formData', required=False, requireArray=True)
+        .param('stride', 'Also extract a frame every this many seconds from '
+               'start to end.', required=False, dataType='number')
+        .param('start', 'Time in seconds at which the stride starts.',
+               required=False, dataType='number', default=0)
+        .param('end', 'Time in seconds at which the stride ends.  Defaults '
+               'to the end of the video.', required=False, dataType='number')
+        .param('width', 'Width of the frames in pixels.', required=False,
+               dataType='integer')
+        .param('height', 'Height of the frames in pixels.', required=False,
+               dataType='integer')
+        .param('format', 'Format of the response.', required=False,
+               enum=sorted(BATCH_FORMATS), default='tar')
+        .param('imageFormat', 'Image format of the frames of an archive.',
+               required=False, enum=sorted(FRAME_FORMATS), default='jpeg')
+        .errorResponse()
+        .errorResponse('Read access was denied on the item.', 403)
+    )
+    @access.public
+    @boundHandler(item)
+    def getVideoFrames(self, id, times, frames, stride, start, end, width,
+                       height, format, imageFormat, params):
+        user = getCurrentUser()
+        item = self.model('item').load(id, user=user, level=AccessType.READ)
+
+        videoMeta = item.get('video', {}).get('meta', {}).get('video', {})
+        try:
+            numbers = batchFrameNumbers(
+                videoMeta.get('frameRate'), videoMeta.get('frameCount'),
+                times, frames, start, end, stride)
+            stream = extractFrames(
+                item, numbers, width, height, format, imageFormat)
+        except (RuntimeError, TypeError, ValueError) as exc:
+            raise RestException(str(exc))
+
+        setResponseHeader('Content-Type', BATCH_FORMATS[format])
+        setResponseHeader('Content-Disposition', 'attachment; '
+                          'filename="frames.%s"' % format)
+        setResponseHeader('X-Video-Frames', ','.join(
+            str(number) for number in numbers))
+        setRawResponse()
+        return stream
+
+    @autoDescribeRoute(
+        Description('Download the DASH manifest or one of its segments.')
+        .notes('Segments are resolved relative to the manifest, so the '
+               'manifest URL can be given directly to a DASH player.')
+        .param('id', 'Id of the item.', paramType='path')
+        .param('name', 'Name of the manifest or segment.', paramType='path')
+        .errorResponse()
+        .errorResponse('Read access was denied on the item.', 403)
+    )
+    @access.public
+    @boundHandler(item)
+    def getDashFile(self, id, name, params):
+        return downloadCreatedFile(self, id, name, 'DASH')
+
+    @autoDescribeRoute(
+        Description('Download the storyboard index or one of its sheets.')
+        .notes('The index is a WebVTT file whose cues refer to tiles of the '
+               'sprite sheets relative to its own URL.')
+        .param('id', 'Id of the item.', paramType='path')
+        .param('name', 'Name of the index (%s) or of a sheet.' %
+               STORYBOARD_INDEX_NAME, paramType='path')
+        .errorResponse()
+        .errorResponse('Read access was denied on the item.', 403)
+    )
+    @access.public
+    @boundHandler(item)
+    def getStoryboardFile(self, id, name, params):
+        return downloadCreatedFile(self, id, name, 'storyboard')
+
+    @autoDescribeRoute(
+        Description('Stream a processed rendition of the given video.')
+        .notes('The smallest rendition that is at least as tall as the '
+               'requested height is served, or the tallest one.  Single '
+               'byte ranges are supported, and responses carry the id of '
+               'the rendition file as their ETag.  With lazy renditions, '
+               'a missing rendition that would better serve the requested '
+               'height is made in the background, and the id of the job '
+               'making it is returned in the X-Video-Rendition-Pending '
+               'header; the best available rendition is served meanwhile.')
+        .param('id', 'Id of the item.', paramType='path')
+        .param('height', 'Minimum height of the rendition.', required=False,
+               dataType='integer')
+        .errorResponse()
+        .errorResponse('Read access was denied on the item.', 403)
+        .errorResponse('The item has no processed renditions.', 404)
+        .errorResponse('The requested range is not satisfiable.', 416)
+    )
+    @access.public
+    @boundHandler(item)
+    def streamVideo(self, id, height, params):
+        user = getCurrentUser()
+        item = self.model('item').load(id, user=user, level=AccessType.READ)
+
+        settingModel = self.model('setting')
+        if height and settingModel.get(PluginSettings.VIDEO_LAZY_RENDITIONS):
+            label = wantedLabel(item, height, settingModel.get(
+                PluginSettings.VIDEO_RENDITIONS))
+            # The rendition is only an improvement; whatever goes wrong in
+            # requesting it, the best available one is still served.
+            pending = None
+            try:
+                pending = requestRendition(item, label) if label else None
+            except Exception:
+                logger.exception('Could not request rendition %s of item %s'
+                                 % (label, id))
+            if pending:
+                setResponseHeader('X-Video-Rendition-Pending', pending)
+
+        fileId = selectRendition(item, height)
+        file = loadRenditionFile(fileId) if fileId is not None else None
+        if file is None:
+            raise RestException(
+                'Item with id=%s has no processed renditions.' % id,
+                code=404)
+        executor.submit(recordAccess, item['_id'], file['_id'])
+
+        etag = '"%s"' % file['_id']
+        headers = cherrypy.request.headers
+        setResponseHeader('ETag', etag)
+        setResponseHeader('Cache-Control', 'private, max-age=%d' %
+                          STREAM_MAX_AGE)
+        if etag in [tag.strip() for tag in
+                    headers.get('If-None-Match', '').split(',')]:
+            cherrypy.response.status = 304
+            setRawResponse()
+            return ''
+
+        # A range only applies to the version of the rendition the client
+        # already has; after reprocessing, the whole file is sent.
+        offset, endByte = 0, None
+        rangeHeader = headers.get('Range')
+        if rangeHeader and headers.get('If-Range', etag) == etag:
+            ranges = cherrypy.lib.httputil.get_ranges(
+                rangeHeader, file.get('size', 0))
+            if ranges == []:
+                setResponseHeader('Content-Range', 'bytes */%d' %
+                                  file.get('size', 0))
+                raise RestException(
+                    'Requested range not satisfiable.', code=416)
+            if ranges:
+                # Only a single range is supported.
+                offset, endByte = ranges[0]
+
+        return self.model('file').download(
+            file, offset, endByte=endByte, contentDisposition='inline')
 
     return {
         'getVideoMetadata': getVideoMetadata,
         'processVideo': processVideo,
         'deleteProcessedVideo': deleteProcessedVideo,
-        'getVideoFrame': getVideoFrame
+        'getVideoFrame': getVideoFrame,
+        'getVideoFrames': getVideoFrames,
+        'streamVideo': streamVideo,
+        'getDashFile': getDashFile,
+        'getStoryboardFile': getStoryboardFile
     }
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import six
+import threading
+
+from girder import logger
+from girder.utility.model_importer import ModelImporter
+
+from .constants import JobStatus, PluginSettings
+from .processing import prepareVideoJob
+
+# Priorities of processing jobs; higher runs first, and jobs of equal
+# priority run in the order they were created.  Jobs of folder batches
+# yield to the ones users request one at a time.
+DEFAULT_PRIORITY = 0
+BATCH_PRIORITY = -10
+
+_dispatchLock = threading.Lock()
+
+
+def queueJob(job, priority=DEFAULT_PRIORITY):
+    """
+    Mark a processing job as waiting for the scheduler.  This must be done
+    before the job is saved or inserted; dispatch then hands the job to the
+    worker when the concurrency limits allow.
+
+    :param job: an inactive processing job.
+    :param priority: the priority of the job.
+    """
+    job['meta']['video_plugin'].update({
+        'pending': True,
+        'priority': priority
+    })
+    return job
+
+
+def activeJobCounts():
+    """
+    Count the processing jobs that are queued on or running in the worker.
+
+    :returns: a dictionary of counts by user id.
+    """
+    jobModel = ModelImporter.model('job', 'jobs')
+    return {group['_id']: group['count'] for group in
+            jobModel.collection.aggregate([
+                {'$match': {
+                    'type': 'video',
+                    'status': {'$in': [JobStatus.QUEUED, JobStatus.RUNNING]}
+                }},
+                {'$group': {'_id': '$userId', 'count': {'$sum': 1}}}])}
+
+
+def saturatedUsers(active, maxUserJobs):
+    """
+    Return the users who may not start another processing job.
+
+    :param active: the counts of active jobs by user, from activeJobCounts.
+    :param maxUserJobs: the per-user limit; 0 means no limit.
+    :returns: a list of user ids.
+    """
+    if not maxUserJobs:
+        return []
+    return [userId for userId, count in six.iteritems(active)
+            if count >= maxUserJobs]
+
+
+def dispatch():
+    """
+    Schedule as many pending processing jobs as the per-user and global
+    concurrency limits allow, highest priority first.  A limit of 0 means
+    no limit.
+
+    Each job is claimed with an atomic update before it is scheduled, so a
+    job is never scheduled twice, even by different server processes;
+    their dispatches may exceed the limits by the jobs they schedule at
+    the same time, though.  Users at their limit are excluded from the
+    query, so however many jobs they have pending, the jobs of other users
+    are still found.  A job is given its tokens as it is scheduled; one
+    that cannot be given them fails.
+
+    :returns: the number of jobs scheduled.
+    """
+    jobModel = ModelImporter.model('job', 'jobs')
+    settingModel = ModelImporter.model('setting')
+    maxJobs = settingModel.get(PluginSettings.VIDEO_MAX_JOBS)
+    maxUserJobs = settingModel.get(PluginSettings.VIDEO_MAX_JOBS_PER_USER)
+
+    scheduled = 0
+    with _dispatchLock:
+        active = activeJobCounts()
+        total = sum(active.values())
+        if maxJobs and total >= maxJobs:
+            return scheduled
+
+        while not maxJobs or total < maxJobs:
+            query = {
+                'type': 'video',
+                'status': JobStatus.INACTIVE,
+                'meta.video_plugin.pending': True
+            }
+            saturated = saturatedUsers(active, maxUserJobs)
+            if saturated:
+                query['userId'] = {'$nin': saturated}
+            job = jobModel.findOne(query, sort=[
+                ('meta.video_plugin.priority', -1), ('created', 1)])
+            if job is None:
+                break
+            userId = job.get('userId')
+
+            claimed = jobModel.collection.find_one_and_update({
+                '_id': job['_id'],
+                'status': JobStatus.INACTIVE,
+                'meta.video_plugin.pending': True
+            }, {'$unset': {'meta.video_plugin.pending': ''}})
+            if claimed is None:
+                continue
+
+            job['meta']['video_plugin'].pop('pending', None)
+            try:
+                prepareVideoJob(job)
+            except Exception as exc:
+                logger.exception(
+                    'Cannot start video processing job %s' % job['_id'])
+                # A worker job can only fail once it is queued.
+                job = jobModel.updateJob(job, status=JobStatus.QUEUED)
+                jobModel.updateJob(
+                    job, status=JobStatus.ERROR,
+                    log='The job could not be started: %s\n' % exc)
+                continue
+            jobModel.scheduleJob(job)
+            active[userId] = active.get(userId, 0) + 1
+            total += 1
+            scheduled += 1
+    return scheduled
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import collections
+import datetime
+import re
+import threading
+import time
+
+from girder.utility.model_importer import ModelImporter
+
+from .constants import RENDITION_NAME_PATTERN
+
+# How long clients may cache a rendition before revalidating it.  A
+# rendition file never changes; reprocessing creates new files, which have
+# new ETags.
+STREAM_MAX_AGE = 24 * 60 * 60
+
+# Number of rendition file documents kept in memory.
+_fileCacheSize = 256
+_fileCache = collections.OrderedDict()
+_fileCacheLock = threading.Lock()
+
+# The last access of a rendition is recorded on its item at most once per
+# this many seconds, by each server process.
+ACCESS_RESOLUTION = 60 * 60
+_accessTimes = {}
+_accessTimesSize = 10000
+_accessTimesLock = threading.Lock()
+
+
+def renditionHeights(item):
+    """
+    Return the height of each rendition of a processed item.  A rendition
+    is labelled with the rung of the ladder it fills, which is usually its
+    height; a source remuxed in place of a rendition, or one shorter than
+    the whole ladder, keeps its own height, as recorded in the metadata.
+
+    :param item: the video item.
+    :returns: a dictionary of heights by rendition label.
+    """
+    itemVideoData = item.get('video', {})
+    recorded = {}
+    for rendition in itemVideoData.get('meta', {}).get('renditions', []):
+        match = re.match(RENDITION_NAME_PATTERN, rendition.get('name', ''))
+        if match and rendition.get('height'):
+            recorded['%sp' % match.group(1)] = rendition['height']
+    return {
+        label: recorded.get(label) or int(
+            re.match(r'^(\d+)p$', label).group(1))
+        for label in itemVideoData.get('renditions', {})
+    }
+
+
+def selectRendition(item, height=None):
+    """
+    Pick a rendition of a processed item: the smallest one that is at least
+    as tall as requested, or the tallest one otherwise.  Only the item is
+    consulted.
+
+    :param item: the video item.
+    :param height: the requested height, if any.
+    :returns: the id of the rendition file, or None if the item has no
+        renditions.
+    """
+    heights = renditionHeights(item)
+    renditions = sorted(
+        (heights[label], fileId)
+        for label, fileId in item.get('video', {}).get(
+            'renditions', {}).items())
+    if not renditions:
+        return None
+    candidates = [r for r in renditions if height and r[0] >= height]
+    return (candidates[0] if candidates else renditions[-1])[1]
+
+
+def loadRenditionFile(fileId):
+    """
+    Load the document of a rendition file.  Renditions are never modified
+    in place, so their documents are cached and streaming a rendition costs
+    a single lookup, of the item.
+
+    :returns: the file document, or None.
+    """
+    with _fileCacheLock:
+        file = _fileCache.pop(fileId, None)
+        if file is not None:
+            _fileCache[fileId] = file
+            return file
+
+    file = ModelImporter.model('file').load(fileId, force=True)
+    if file is None:
+        return None
+
+    with _fileCacheLock:
+        _fileCache[fileId] = file
+        while len(_fileCache) > _fileCacheSize:
+            _fileCache.popitem(last=False)
+    return file
+
+
+def forgetRenditionFile(fileId):
+    """Drop the cached document of a rendition file that was removed."""
+    with _fileCacheLock:
+        _fileCache.pop(str(fileId), None)
+        _fileCache.pop(fileId, None)
+
+
+def recordAccess(itemId, fileId):
+    """
+    Record on an item that one of its renditions was accessed, under
+    video.lastAccess.<file id>, which orders their eviction.  Accesses are
+    only written once per ACCESS_RESOLUTION, so this is cheap to call on
+    every request.
+
+    :returns: whether the access was written.
+    """
+    now = time.time()
+    key = str(fileId)
+    with _accessTimesLock:
+        if now - _accessTimes.get(key, 0) < ACCESS_RESOLUTION:
+            return False
+        if len(_accessTimes) >= _accessTimesSize:
+            _accessTimes.clear()
+        _accessTimes[key] = now
+
+    ModelImporter.model('item').update({'_id': itemId}, {'$set': {
+        'video.lastAccess.' + key: datetime.datetime.utcnow()
+    }}, multi=False)
+    return True